@@ -0,0 +1,213 @@
+''' Trains, evaluates and runs inference for every feature model on synthetic hourly site data with the real schema,
+on CPU against the local storage backend. Reports wall time, throughput, peak RSS and artifact sizes as JSON, so runs
+on different commits can be compared. Run from backend/src with `python -m benchmarks.model`, see --help. '''
+import os
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+# never touch the deployed tables and buckets, this has to be set before utils.storage is imported
+os.environ['FLOWCAST_STORAGE_BACKEND'] = 'local'
+# stage processes inherit the root of the run which spawned them
+if 'FLOWCAST_LOCAL_ROOT' not in os.environ: os.environ['FLOWCAST_LOCAL_ROOT'] = tempfile.mkdtemp(prefix='fc_bench_')
+os.environ.setdefault('FEATURE_STORE_DIR', os.path.join(os.environ['FLOWCAST_LOCAL_ROOT'], 'features'))
+os.environ.setdefault('MODEL_CACHE_DIR', os.path.join(os.environ['FLOWCAST_LOCAL_ROOT'], 'model_cache'))
+
+from utils import constants, featurestore, utils, s3
+
+SITE = 'benchmark'
+HOURS = int(constants.MAX_HISTORY_REACHBACK_YEARS * 365 * 24)
+INFERENCE_RUNS = 10
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+def make_site(hours: int, seed: int = 0):
+  ''' Hourly observations for every model input, with yearly and daily cycles, storms and a snowy winter. '''
+  rng = np.random.default_rng(seed)
+  index = pd.date_range(end=pd.Timestamp('2024-06-01', tz='UTC'), periods=hours, freq=constants.TIMESERIES_FREQUENCY)
+  day_of_year = index.dayofyear.to_numpy() / 365.25 * 2 * np.pi
+  hour_of_day = index.hour.to_numpy() / 24 * 2 * np.pi
+
+  airtemp = 50 - 25 * np.cos(day_of_year) - 8 * np.cos(hour_of_day) + rng.normal(0, 4, hours)
+  cloudcover = np.clip(50 + 40 * np.sin(np.cumsum(rng.normal(0, 0.05, hours))) + rng.normal(0, 10, hours), 0, 100)
+  precip = np.where(rng.random(hours) < 0.08, rng.exponential(0.1, hours), 0.0)
+  snow = np.where(airtemp < 32, precip * 10, 0.0)
+  snowdepth = np.zeros(hours)
+  for i in range(1, hours):
+    snowdepth[i] = max(0.0, snowdepth[i - 1] + snow[i] - max(0.0, airtemp[i] - 32) * 0.01)
+
+  # rivers lag the air, and respond to rain over the following days
+  runoff = np.convolve(precip, np.exp(-np.arange(72) / 24), mode='full')[:hours]
+  watertemp = 33 + np.maximum(0, pd.Series(airtemp).ewm(halflife=72).mean().to_numpy() - 33) + rng.normal(0, 0.3, hours)
+  streamflow = 200 + 150 * np.sin(day_of_year + 1) ** 2 + 800 * runoff + rng.normal(0, 5, hours)
+
+  return pd.DataFrame({
+    'airtemp': airtemp,
+    'cloudcover': cloudcover,
+    'precip': precip,
+    'snow': snow,
+    'snowdepth': snowdepth,
+    'streamflow': streamflow,
+    'watertemp': watertemp
+  }, index=index.rename('timestamp'))
+
+def _peak_rss_mib():
+  # ru_maxrss is in KiB on linux, each stage runs in a fresh process so this is that stage's peak
+  return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+def train_stage(store: dict, feature: str):
+  from handlers import train
+  rows = featurestore.attach(store).shape[0]
+  start = time.perf_counter()
+  train.create_model(store, SITE, feature)
+  wall = time.perf_counter() - start
+  return { 'wall_seconds': round(wall, 2), 'rows_per_second': round(rows / wall, 1), 'peak_rss_mib': _peak_rss_mib() }
+
+def evaluate_stage(store: dict, feature: str):
+  from handlers import train
+  model = s3.load_model(SITE, feature)
+  historical = utils.prep_features(featurestore.attach(store), feature)
+  # the same split as training, so this is the held out evaluation create_model ran
+  _, test = model.split_df(historical, freq='H', valid_p=0.2)
+
+  start = time.perf_counter()
+  metrics = train.evaluate(model, test)
+  wall = time.perf_counter() - start
+  return {
+    'wall_seconds': round(wall, 2),
+    'rows_per_second': round(test.shape[0] / wall, 1),
+    'peak_rss_mib': _peak_rss_mib(),
+    'mae': round(float(metrics['mae'].mean()), 4),
+    'interval_coverage': round(float(metrics['interval_coverage'].mean()), 4)
+  }
+
+def inference_stage(store: dict, engine: str, feature: str):
+  from handlers import forecast
+  forecast.FORECAST_ENGINE = engine
+  if engine == 'auto' and s3.load_inference_engine(SITE, feature) is None:
+    return { 'skipped': 'no inference engine was exported' }
+
+  # the lag window the forecast handler reads, followed by the weather forecast run
+  data = featurestore.attach(store)
+  lags = constants.FORECAST_HORIZON * 2
+  window = data.iloc[-lags - constants.FORECAST_HORIZON:].copy()
+  window.iloc[lags:, [window.columns.get_loc(col) for col in constants.FEATURES_TO_FORECAST]] = np.nan
+  window.index = window.index.tz_convert(None)
+
+  seconds = []
+  for _ in range(INFERENCE_RUNS):
+    start = time.perf_counter()
+    forecast.forecast_feature(window, feature, SITE, False)
+    seconds.append(time.perf_counter() - start)
+
+  # the first run loads the model, as a cold start would
+  warm = seconds[1:]
+  return {
+    'cold_seconds': round(seconds[0], 3),
+    'warm_seconds': round(float(np.median(warm)), 4),
+    'forecasts_per_second': round(len(warm) / sum(warm), 1),
+    'peak_rss_mib': _peak_rss_mib()
+  }
+
+def run_stage(fn, *args):
+  ''' Runs a stage in a fresh process, so imports, caches and peak RSS don't carry over between stages. '''
+  from handlers import train
+  context = multiprocessing.get_context('spawn')
+  with context.Pool(1, initializer=train._init_worker, initargs=(train.available_cpus(),)) as pool:
+    return pool.apply(fn, args)
+
+def artifact_sizes(feature: str):
+  sizes = {}
+  for name, key in [
+    ('model', f'{SITE}_{feature}_model.np'),
+    ('inference_engine', f'{SITE}_{feature}_model.npz'),
+    ('skill', f'{SITE}_{feature}_skill.json')
+  ]:
+    try:
+      sizes[name] = s3.s3_client.head_object(Bucket=s3.MODEL_BUCKET_NAME, Key=key)['ContentLength']
+    except Exception:
+      sizes[name] = None
+  return sizes
+
+def git_commit():
+  try:
+    return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def run(hours: int):
+  site = make_site(hours)
+  store = featurestore.save(SITE, *featurestore.to_arrays(site.assign(timestamp=site.index.as_unit('s').asi8)))
+  print(f'{hours} hourly rows x {len(featurestore.COLUMNS)} columns, n_lags {constants.FORECAST_HORIZON * 2}, horizon {constants.FORECAST_HORIZON}')
+
+  features = {}
+  for feature in constants.FEATURES_TO_FORECAST:
+    res = { 'train': run_stage(train_stage, store, feature) }
+    print(f'{feature} train: {res["train"]}')
+    res['evaluate'] = run_stage(evaluate_stage, store, feature)
+    print(f'{feature} evaluate: {res["evaluate"]}')
+    res['inference'] = { engine: run_stage(inference_stage, store, engine, feature) for engine in ['auto', 'neuralprophet'] }
+    print(f'{feature} inference: {res["inference"]}')
+    res['artifact_bytes'] = artifact_sizes(feature)
+    print(f'{feature} artifacts: {res["artifact_bytes"]}')
+    features[feature] = res
+
+  import torch
+  return {
+    'commit': git_commit(),
+    'created_at': pd.Timestamp.now(tz='UTC').isoformat(),
+    'environment': {
+      'python': platform.python_version(),
+      'machine': platform.machine(),
+      'cpus': os.cpu_count(),
+      'torch': torch.__version__,
+      'numpy': np.__version__,
+      'pandas': pd.__version__
+    },
+    'config': {
+      'hours': hours,
+      'n_lags': constants.FORECAST_HORIZON * 2,
+      'forecast_horizon': constants.FORECAST_HORIZON,
+      'inference_runs': INFERENCE_RUNS
+    },
+    'features': features
+  }
+
+def _flatten(results: dict, prefix: str = ''):
+  flat = {}
+  for key, value in results.items():
+    if isinstance(value, dict): flat.update(_flatten(value, f'{prefix}{key}.'))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool): flat[f'{prefix}{key}'] = value
+  return flat
+
+def compare(baseline: dict, results: dict):
+  ''' Prints every numeric result next to the baseline's, with the relative change. '''
+  before, after = _flatten(baseline['features']), _flatten(results['features'])
+  print(f'compared to {baseline.get("commit")} ({baseline.get("created_at")}):')
+  for key in sorted(before.keys() & after.keys()):
+    change = f'{(after[key] - before[key]) / before[key] * 100:+.1f}%' if before[key] != 0 else ''
+    print(f'  {key:60} {before[key]:>12} -> {after[key]:>12} {change}')
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--hours', type=int, default=HOURS, help='hours of synthetic history')
+  parser.add_argument('--output', help='results file, defaults to benchmarks/results/model_<commit>.json')
+  parser.add_argument('--compare', help='results file of an earlier run to compare against')
+  args = parser.parse_args()
+
+  results = run(args.hours)
+  output = args.output or os.path.join(RESULTS_DIR, f'model_{results["commit"] or "unknown"}.json')
+  os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+  with open(output, 'w') as file:
+    json.dump(results, file, indent=2)
+  print(f'wrote {output}')
+
+  if args.compare:
+    with open(args.compare) as file:
+      compare(json.load(file), results)
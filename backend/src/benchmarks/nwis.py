@@ -0,0 +1,90 @@
+''' Checks usgs._to_frame, the columnar decode of an NWIS instantaneous value response, against the previous frame
+per series decode and times both on an onboarding sized response. Run from backend/src with
+`python -m benchmarks.nwis`. '''
+import json
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from utils import usgs, constants
+
+DAYS = int(constants.MAX_HISTORY_REACHBACK_YEARS * 365)
+
+def make_response(days: int, seed: int = 0):
+  ''' An NWIS iv response for one site, 15 minute samples of every parameter with dropped samples, site local
+  offsets across daylight saving changes, and a second series of a parameter (ie. another sensor) filling gaps. '''
+  rng = np.random.default_rng(seed)
+  end = pd.Timestamp('2024-06-01', tz='UTC')
+  index = pd.date_range(end - pd.Timedelta(days=days), end, freq='15min')
+
+  def series(code: str, keep: float, level: float):
+    kept = index[rng.random(index.shape[0]) < keep]
+    values = level + np.cumsum(rng.normal(0, 0.1, kept.shape[0]))
+    timestamps = kept.tz_convert('America/New_York').strftime('%Y-%m-%dT%H:%M:%S.000%z')
+    return {
+      'variable': { 'variableCode': [{ 'value': code }] },
+      'values': [{ 'value': [
+        { 'value': f'{value:.2f}', 'qualifiers': ['P'], 'dateTime': f'{ts[:-2]}:{ts[-2:]}' }
+        for value, ts in zip(values, timestamps)
+      ] }]
+    }
+
+  return { 'value': { 'timeSeries': [series('00010', 0.97, 15), series('00060', 0.95, 300), series('00060', 0.5, 300)] } }
+
+def legacy_to_frame(series_list: list[dict]):
+  ''' usgs._to_frame before the columnar decode. '''
+  water = pd.DataFrame(columns=constants.WATER_CONDITION_FEATURES.values())
+  for series in series_list:
+    code = series['variable']['variableCode'][0]['value']
+    values = series['values'][0]['value']
+
+    df = pd.DataFrame(values)
+    df = df.set_index(pd.to_datetime(df['dateTime'], utc=True))
+    df = df.drop(['qualifiers', 'dateTime'], axis=1)
+    df['value'] = df['value'].astype('float64')
+    df.index.name = None
+
+    if water.shape[0] == 0:
+      water[constants.WATER_CONDITION_FEATURES[code]] = df['value']
+    else:
+      water[constants.WATER_CONDITION_FEATURES[code]] = water[constants.WATER_CONDITION_FEATURES[code]].combine_first(df['value'])
+
+  return water
+
+def measure(fn, series_list: list[dict], runs: int = 3):
+  ''' Result, best wall seconds and peak traced MiB of decoding the parsed series. Memory is traced in its own run,
+  tracing slows the decode down. '''
+  seconds = []
+  for _ in range(runs):
+    start = time.perf_counter()
+    res = fn(series_list)
+    seconds.append(time.perf_counter() - start)
+
+  tracemalloc.start()
+  fn(series_list)
+  peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+  tracemalloc.stop()
+  return res, min(seconds), peak
+
+def run():
+  payload = json.dumps(make_response(DAYS))
+  start = time.perf_counter()
+  series_list = json.loads(payload)['value']['timeSeries']
+  parse_seconds = time.perf_counter() - start
+  samples = sum(len(series['values'][0]['value']) for series in series_list)
+  print(f'{DAYS} days, {samples} samples, {len(payload) / 2 ** 20:.1f}MiB response parsed in {parse_seconds * 1000:.0f}ms')
+
+  legacy, legacy_seconds, legacy_peak = measure(legacy_to_frame, series_list)
+  columnar, columnar_seconds, columnar_peak = measure(usgs._to_frame, series_list)
+
+  # the legacy frame can hold object columns, and its index unit depends on the pandas version
+  legacy.index = legacy.index.as_unit('ns')
+  pd.testing.assert_frame_equal(columnar, legacy.astype('float64'))
+  print(f'columnar decode matches the legacy frame ({columnar.shape[0]} rows)')
+
+  print(f'legacy: {legacy_seconds * 1000:.0f}ms, peak {legacy_peak:.1f}MiB')
+  print(f'columnar: {columnar_seconds * 1000:.0f}ms, peak {columnar_peak:.1f}MiB')
+
+if __name__ == '__main__':
+  run()
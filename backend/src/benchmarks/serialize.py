@@ -0,0 +1,108 @@
+''' Compares the row serializers in utils.utils against the original iterrows implementations on 2.5 years of
+hourly data, checking the rows match exactly. Run from backend/src with `python -m benchmarks.serialize`. '''
+import time
+import numpy as np
+import pandas as pd
+from decimal import Decimal
+
+from utils import utils, constants
+
+SITE = constants.USGS_SITE
+HOURS = int(constants.MAX_HISTORY_REACHBACK_YEARS * 365 * 24)
+COLUMNS = ['watertemp', 'streamflow', *constants.ATMOSPHERIC_WEATHER_FEATURES.values()]
+
+def legacy_generate_hist_rows(hist_df: pd.DataFrame, usgs_site: str):
+  new_hist = []
+  for ts, row in hist_df.iterrows():
+    new_hist.append({
+        'usgs_site': usgs_site,
+        'type': 'hist',
+        'usgs_site#type': f'{usgs_site}#hist',
+        'timestamp': int(ts.timestamp()),
+        'origin#timestamp': f'{int(ts.timestamp())}#{int(ts.timestamp())}',
+        **row
+    })
+
+  return new_hist
+
+def legacy_generate_fcst_rows(fcst_df: pd.DataFrame, origin_ts: pd.Timestamp, usgs_site: str, skip_meta: bool = False):
+  new_fcst = []
+  for ts, row in fcst_df.iterrows():
+      origin = int(origin_ts.timestamp())
+      timestamp = int(ts.timestamp())
+      horizon = timestamp - origin
+
+      item = {}
+      if not skip_meta:
+        item = {
+          'usgs_site': usgs_site,
+          'type': 'fcst',
+          'usgs_site#type': f'{usgs_site}#fcst',
+          'origin': origin,
+          'timestamp': timestamp,
+          'horizon': horizon,
+          'horizon#timestamp': f'{horizon}#{timestamp}',
+          'origin#timestamp': f'{origin}#{timestamp}',
+          'watertemp': None,
+          'streamflow': None
+        }
+
+      new_fcst.append({
+          **item,
+          **row
+      })
+
+  return new_fcst
+
+def legacy_convert_floats_to_decimals(df: pd.DataFrame):
+  for col in df.columns:
+    if pd.api.types.is_float_dtype(df[col]) or (df[col].shape[0] > 0 and isinstance(df[col].iloc[0], float)):
+      df[col] = df[col].apply(lambda x: Decimal(x).quantize(Decimal('1.0000')))
+
+def make_frame(hours: int, seed: int = 0):
+  rng = np.random.default_rng(seed)
+  index = pd.date_range('2022-01-01', periods=hours, freq=constants.TIMESERIES_FREQUENCY, tz='UTC')
+  df = pd.DataFrame({ col: rng.normal(50, 20, hours) for col in COLUMNS }, index=index)
+  # weather columns are mostly zero, and interpolation leaves plenty of exact ties and negative zeros
+  df[['precip', 'snow', 'snowdepth']] = df[['precip', 'snow', 'snowdepth']].where(rng.random((hours, 3)) < 0.1, 0.0)
+  df.iloc[::50, 0] = -0.0
+  df.iloc[::70, 1] = 0.00005
+  df.iloc[::90, 2] = np.nan
+  return df
+
+def assert_same_rows(expected: list[dict], actual: list[dict]):
+  assert len(expected) == len(actual), f'{len(expected)} != {len(actual)} rows'
+  for e, a in zip(expected, actual):
+    # compare reprs, so types, key order, decimal exponents and signs have to match as well
+    assert list(e.keys()) == list(a.keys()), f'{list(e.keys())} != {list(a.keys())}'
+    assert [repr(v) for v in e.values()] == [repr(v) for v in a.values()], f'{e} != {a}'
+
+def timed(fn, *args):
+  start = time.perf_counter()
+  res = fn(*args)
+  return res, time.perf_counter() - start
+
+def run():
+  df = make_frame(HOURS)
+  print(f'{HOURS} hourly rows x {len(COLUMNS)} columns')
+
+  expected_df, actual_df = df.copy(), df.copy()
+  _, legacy_seconds = timed(legacy_convert_floats_to_decimals, expected_df)
+  _, seconds = timed(utils.convert_floats_to_decimals, actual_df)
+  print(f'convert_floats_to_decimals: {legacy_seconds:.3f}s -> {seconds:.3f}s ({legacy_seconds / seconds:.1f}x)')
+
+  expected, legacy_seconds = timed(legacy_generate_hist_rows, expected_df, SITE)
+  actual, seconds = timed(utils.generate_hist_rows, actual_df, SITE)
+  assert_same_rows(expected, actual)
+  print(f'generate_hist_rows: {legacy_seconds:.3f}s -> {seconds:.3f}s ({legacy_seconds / seconds:.1f}x)')
+
+  fcst_df = actual_df.iloc[-constants.FORECAST_HORIZON - 1:][list(constants.ATMOSPHERIC_WEATHER_FEATURES.values())]
+  origin_ts = fcst_df.index[0]
+  for skip_meta in [False, True]:
+    expected, legacy_seconds = timed(legacy_generate_fcst_rows, fcst_df, origin_ts, SITE, skip_meta)
+    actual, seconds = timed(utils.generate_fcst_rows, fcst_df, origin_ts, SITE, skip_meta)
+    assert_same_rows(expected, actual)
+    print(f'generate_fcst_rows (skip_meta={skip_meta}): {legacy_seconds * 1000:.1f}ms -> {seconds * 1000:.1f}ms')
+
+if __name__ == '__main__':
+  run()
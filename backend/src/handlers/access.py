@@ -19,6 +19,12 @@ def get_forecast():
 
   return '{"forecast": ' + df.to_json(orient='records') + '}', 200
 
+@app.get('/skill')
+def get_skill():
+  query_params = app.current_event.query_string_parameters
+  usgs_site = query_params.get('usgs_site')
+  return { 'skill': forecast.get_skill(usgs_site) }, 200
+
 @app.get('/site')
 def get_site():
   query_params = app.current_event.query_string_parameters
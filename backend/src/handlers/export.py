@@ -1,16 +1,14 @@
-import boto3
 import logging
-import os
 from datetime import datetime, timedelta, timezone
 
-from utils import db, utils
+from utils import db, utils, storage
 
-TABLE_ARN = os.environ['DATA_TABLE_ARN']
-BUCKET_NAME = os.environ['ARCHIVE_BUCKET_NAME']
+TABLE_ARN = storage.env('DATA_TABLE_ARN', 'flowcast-data')
+BUCKET_NAME = storage.env('ARCHIVE_BUCKET_NAME', 'flowcast-archive')
 
 logging.basicConfig(level=logging.INFO)
-ddb_client = boto3.client('dynamodb')
-s3_client = boto3.client('s3')
+ddb_client = storage.lazy_client('dynamodb')
+s3_client = storage.lazy_client('s3')
 
 def get_nested(dictionary, keys, default=None):
   for key in keys:
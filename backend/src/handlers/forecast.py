@@ -1,10 +1,20 @@
 import pandas as pd
 import numpy as np
+import os
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 log = logging.getLogger(__name__)
 
-from utils import s3, db, constants, utils
+from utils import s3, db, constants, utils, featurestore
+
+# 'auto' uses the numpy inference engine when train exported one, 'neuralprophet' always loads the full model
+FORECAST_ENGINE = os.environ.get('FORECAST_ENGINE', 'auto')
+BATCH_FETCH_WORKERS = int(os.environ.get('FORECAST_BATCH_FETCH_WORKERS', 8))
+INFERENCE_WORKERS = int(os.environ.get('FORECAST_INFERENCE_WORKERS', len(constants.FEATURES_TO_FORECAST)))
+MODEL_INPUT_COLS = featurestore.COLUMNS
+# hist rows only feed the model inputs, skip pulling the remaining attributes
+HIST_ATTRIBUTES = ['timestamp', 'type', *MODEL_INPUT_COLS]
 
 def handler(event, _context):
   usgs_site = event['usgs_site']
@@ -14,38 +24,90 @@ def handler(event, _context):
     db.update_site_status(usgs_site, db.SiteStatus.FORECASTING)
     db.push_site_onboarding_log(usgs_site, f'🔮 Started forecasting for site {usgs_site} at {utils.get_current_local_time()}')
 
+  last_hist_entries, last_fcst_entries = fetch_inputs(usgs_site)
+  return forecast_site(usgs_site, last_hist_entries, last_fcst_entries, is_onboarding)
+
+def batch_handler(event, _context):
+  ''' Forecasts several active sites in one invocation, inputs are fetched concurrently while inference runs
+  site by site in this process so imports and loaded models are shared. A failing site doesn't fail the batch. '''
+  usgs_sites = event['usgs_sites']
+  results = {}
+
+  with ThreadPoolExecutor(max_workers=max(1, min(BATCH_FETCH_WORKERS, len(usgs_sites)))) as executor:
+    fetches = { usgs_site: executor.submit(fetch_inputs, usgs_site) for usgs_site in usgs_sites }
+    for usgs_site, fetch in fetches.items():
+      try:
+        results[usgs_site] = forecast_site(usgs_site, *fetch.result(), False)
+      except Exception as e:
+        log.exception(f'failed to forecast site {usgs_site}')
+        results[usgs_site] = { 'statusCode': 500, 'error': repr(e) }
+
+  failed = [usgs_site for usgs_site, res in results.items() if res['statusCode'] != 200]
+  log.info(f'forecasted {len(usgs_sites) - len(failed)}/{len(usgs_sites)} sites' + (f', failed: {failed}' if failed else ''))
+
+  return { 'statusCode': 200, 'results': results, 'failed': failed }
+
+def fetch_inputs(usgs_site: str):
+  ''' Retrieves the most recent historical window and the weather forecast run starting at its last observation. '''
   # get latest hist
   log.info(f'retrieving most recent historical data for site {usgs_site}')
-  # include 10 row buffer in case any rows are invalid
-  last_hist_entries = db.get_n_most_recent_hist_entries(usgs_site, constants.FORECAST_HORIZON*2)
+  last_hist_entries = fetch_stored_hist(usgs_site, constants.FORECAST_HORIZON*2)
+  if last_hist_entries is None:
+    last_hist_entries = db.get_n_most_recent_hist_entries(usgs_site, constants.FORECAST_HORIZON*2, HIST_ATTRIBUTES)
 
   last_hist_origin = last_hist_entries[0]['timestamp']
   log.info(f'retrieving weather forecast data for site {usgs_site} at {last_hist_origin}')
   last_fcst_entries = db.get_entire_fcst(usgs_site, last_hist_origin)
 
+  return last_hist_entries, last_fcst_entries
+
+def fetch_stored_hist(usgs_site: str, n: int):
+  ''' The n most recent hist entries, newest first, from the feature store. None unless the store is up to date
+  with the database. '''
+  handle = featurestore.load(usgs_site)
+  latest = db.get_n_most_recent_hist_entries(usgs_site, 1, ['timestamp'])
+  if handle is None or len(latest) == 0 or featurestore.last_timestamp(handle) != int(latest[0]['timestamp']):
+    log.info(f'feature store of site {usgs_site} is missing or behind, querying hist entries')
+    return None
+
+  window = featurestore.window(handle, n).iloc[::-1]
+  hist = pd.DataFrame(window.to_numpy(dtype=np.float64), columns=window.columns)
+  hist.insert(0, 'timestamp', window.index.as_unit('s').asi8)
+  hist.insert(1, 'type', 'hist')
+  return hist.to_dict('records')
+
+def forecast_site(usgs_site: str, last_hist_entries: list[dict], last_fcst_entries: list[dict], is_onboarding: bool):
+  last_hist_origin = last_hist_entries[0]['timestamp']
   if (last_fcst_entries[0][constants.FEATURES_TO_FORECAST[0]] is not None):
     log.warning(f'forecast already exists for most recent weather data. perhaps the update task failed?')
     return { 'statusCode': 200 }
 
   fcst_df = pd.DataFrame(last_fcst_entries)
   hist_df = pd.DataFrame(last_hist_entries)
-  source_df = pd.concat([fcst_df[fcst_df['timestamp'] > hist_df['timestamp'].max()], hist_df])
+  source_df = pd.concat([fcst_df[pd.to_numeric(fcst_df['timestamp']) > pd.to_numeric(hist_df['timestamp']).max()], hist_df])
   source_df = source_df.set_index(pd.to_datetime(source_df['timestamp'].apply(pd.to_numeric), unit='s')).sort_index()
 
   data = source_df
-  for feature in constants.FEATURES_TO_FORECAST:
-    feature_fcst = forecast_feature(data, feature, usgs_site, is_onboarding)
-    for col in [feature, f'{feature}_5th', f'{feature}_95th']:
-      data[data['type'] == 'fcst'][col] = feature_fcst[feature_fcst['type'] == 'fcst'][col]
+  # convert decimals to floats once, every feature model reads from the same matrix
+  features = data[MODEL_INPUT_COLS].apply(pd.to_numeric, downcast='float')
+
+  # feature models are independent, load and run them side by side
+  with ThreadPoolExecutor(max_workers=max(1, min(INFERENCE_WORKERS, len(constants.FEATURES_TO_FORECAST)))) as executor:
+    predictions = pd.concat(executor.map(
+      lambda feature: forecast_feature(features, feature, usgs_site, is_onboarding),
+      constants.FEATURES_TO_FORECAST
+    ), axis=1)
 
-  mask = data['type'] == 'fcst'
+  is_fcst = data['type'] == 'fcst'
+  data.loc[is_fcst, list(predictions.columns)] = predictions.reindex(data.index[is_fcst])
+
+  mask = is_fcst
   for feature in constants.FEATURES_TO_FORECAST:
     mask &= data[feature].notnull()
   updates = data[mask]
   fcst_rows = utils.generate_fcst_rows(updates, pd.Timestamp.fromtimestamp(int(last_hist_origin)), usgs_site, True)
 
   log.info('pushing new fcst entries to db')
-  logging.getLogger('boto3.dynamodb.table').setLevel(logging.DEBUG)
   db.push_fcst_entries(fcst_rows)
   if (is_onboarding):
     db.push_site_onboarding_log(usgs_site, f'\tfinished forecasting at {utils.get_current_local_time()}')
@@ -53,44 +115,49 @@ def handler(event, _context):
 
   return { 'statusCode': 200 }
 
-def forecast_feature(data: pd.DataFrame, feature: str, usgs_site: str, is_onboarding: bool):
-  if is_onboarding: db.push_site_onboarding_log(usgs_site, f'\predicting {feature} values')
+def forecast_feature(features: pd.DataFrame, feature: str, usgs_site: str, is_onboarding: bool):
+  ''' Returns the forecast and confidence interval of feature, as decimal columns indexed by timestamp. '''
+  if is_onboarding: db.push_site_onboarding_log(usgs_site, f'\tpredicting {feature} values')
 
-  df = data.drop(columns=data.columns.difference(constants.FEATURE_COLS[feature]))
-  df = df.reset_index()
-  df = df.rename(columns={'timestamp': 'ds'})
+  df = utils.prep_features(features, feature)
+  log.info(f'dataset ready for inference:\n{df}')
 
-  # convert decimals to floats
-  df[constants.FEATURE_COLS[feature]] = df[constants.FEATURE_COLS[feature]].apply(pd.to_numeric, downcast='float')
+  yhat = predict(df, feature, usgs_site)
 
-  df = df.rename(columns={feature: 'y'})
-  # todo - remove once neuralprophet issue is resolved
-  df.loc[0, 'snow'] = 0.01
-  df.loc[0, 'snowdepth'] = 0.01
-  log.info(f'dataset ready for inference:\n{df}')
+  yhat = yhat.set_index(yhat['ds'])[['origin-0', 'origin-0 5.0%', 'origin-0 95.0%']]
+  yhat.columns = [feature, f'{feature}_5th', f'{feature}_95th']
+  utils.convert_floats_to_decimals(yhat)
+
+  return yhat
+
+def _limit_torch_threads():
+  # predictions run side by side, split the cores between them instead of each one using all of them
+  import torch
+  torch.set_num_threads(max(1, (os.cpu_count() or 1) // min(INFERENCE_WORKERS, len(constants.FEATURES_TO_FORECAST))))
+
+def predict(df: pd.DataFrame, feature: str, usgs_site: str):
+  history = df[df['y'].notnull()]
+  regressors_df = df[df['y'].isnull()].drop(columns=['y'])
+
+  # the exported numpy engine avoids importing neuralprophet (and torch) entirely
+  engine = s3.load_inference_engine(usgs_site, feature) if FORECAST_ENGINE == 'auto' else None
+  if engine is not None:
+    try:
+      log.info(f'predicting {feature} with numpy inference engine')
+      return engine.predict_latest(history, regressors_df, constants.FORECAST_HORIZON)
+    except ValueError as e:
+      # ie. gaps in the inputs, which neuralprophet imputes
+      log.warning(f'numpy inference engine unable to predict {feature}, falling back to neuralprophet: {e}')
 
   # load model
   model = s3.load_model(usgs_site, feature)
+  _limit_torch_threads()
 
   # prep future
-  future = model.make_future_dataframe(
-    df=df[df['y'].notnull()],
-    regressors_df=df[df['y'].isnull()].drop(columns=['y']),
-    periods=constants.FORECAST_HORIZON
-  )
+  future = model.make_future_dataframe(df=history, regressors_df=regressors_df, periods=constants.FORECAST_HORIZON)
 
   # predict
   # hide py.warnings (noisy pandas warnings during training)
   logging.getLogger('py.warnings').setLevel(logging.ERROR)
   pred = model.predict(df=future)
-  yhat = model.get_latest_forecast(pred)
-
-  yhat = yhat.set_index(yhat['ds'])
-  utils.convert_floats_to_decimals(yhat)
-  data[f'{feature}_5th'] = np.nan
-  data[f'{feature}_95th'] = np.nan
-  data[f'{feature}'] = data[f'{feature}'].combine_first(yhat['origin-0'])
-  data[f'{feature}_5th'] = data[f'{feature}_5th'].combine_first(yhat['origin-0 5.0%'])
-  data[f'{feature}_95th'] = data[f'{feature}_95th'].combine_first(yhat['origin-0 95.0%'])
-
-  return data
+  return model.get_latest_forecast(pred)
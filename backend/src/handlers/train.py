@@ -1,46 +1,99 @@
+import os
+import time
+import resource
+import multiprocessing
 import pandas as pd
-import numpy as np
 import logging
+from contextlib import contextmanager
+from datetime import datetime, timezone
 
 log = logging.getLogger(__name__)
 
-from utils import s3, constants, utils, db
+from utils import s3, constants, utils, db, inference, featurestore, skill
+
+# 'auto' fine-tunes existing models on the observations since they were trained, 'full' always retrains from scratch
+TRAIN_MODE = os.environ.get('TRAIN_MODE', 'auto')
+FULL_RETRAIN_INTERVAL_DAYS = float(os.environ.get('FULL_RETRAIN_INTERVAL_DAYS', 28))
+FINE_TUNE_EPOCHS = int(os.environ.get('FINE_TUNE_EPOCHS', 5))
+MIN_FINE_TUNE_HOURS = constants.FORECAST_HORIZON
+# fine-tuning is skipped for a full retrain once the error on new observations exceeds this multiple of the last full training's
+MAX_VALIDATION_DEGRADATION = float(os.environ.get('MAX_VALIDATION_DEGRADATION', 1.25))
+
+# feature models are trained side by side in separate processes
+TRAIN_WORKERS = int(os.environ.get('TRAIN_WORKERS', len(constants.FEATURES_TO_FORECAST)))
 
 def handler(usgs_site: str, is_onboarding: bool):
   if is_onboarding:
     db.update_site_status(usgs_site, db.SiteStatus.TRAINING_MODELS)
     db.push_site_onboarding_log(usgs_site, f'🧠 Started training feature models for site {usgs_site} at {utils.get_current_local_time()}')
 
-  # load df
-  archive = s3.fetch_archive_data(usgs_site)
-  log.info(f'loaded archive ({archive.shape[0]} obs)')
-  if is_onboarding: db.push_site_onboarding_log(usgs_site, '\tloaded latest snapshot')
-
-  # only use historical observations for training, filter
-  log.info(f'dropping forecasted entries')
-  historical = archive[archive['type'] == 'hist']
+  # only observations stored since the last training are fetched, the workers memory map the store
+  store = featurestore.sync(usgs_site)
+  if is_onboarding: db.push_site_onboarding_log(usgs_site, '\tloaded latest observations')
 
-  # todo remove when neuralprophet fixes empty regressor bug
-  historical['snow'][0] = 0.01
-  historical['snowdepth'][0] = 0.01
+  features = constants.FEATURES_TO_FORECAST
+  report = {}
+  if not is_onboarding and TRAIN_MODE == 'auto':
+    updated, report['fine_tune'] = run_parallel(update_model, [(store, usgs_site, feature) for feature in features])
+    features = [feature for feature, is_updated in zip(features, updated) if not is_updated]
 
-  for feature in constants.FEATURES_TO_FORECAST:
-    if is_onboarding: db.push_site_onboarding_log(usgs_site, f'\tfitting model for {feature}')
-    create_model(pd.DataFrame(historical), usgs_site, feature)
+  if len(features) > 0:
+    if is_onboarding: db.push_site_onboarding_log(usgs_site, f'\tfitting models for {", ".join(features)}')
+    _, report['full'] = run_parallel(create_model, [(store, usgs_site, feature) for feature in features])
 
   if is_onboarding: db.push_site_onboarding_log(usgs_site, f'\tfinished training feature models at {utils.get_current_local_time()}')
 
-  return { 'statusCode': 200 }
+  return { 'statusCode': 200, 'report': report }
 
-def create_model(data: pd.DataFrame, usgs_site: str, feature: str):
-  historical = utils.prep_archive_for_training(data, feature)
-  log.info(f'dataset ready for training: {historical}')
+def available_cpus():
+  ''' vCPUs available to this container, from the cgroup quota when one is set. '''
+  try:
+    with open('/sys/fs/cgroup/cpu.max') as file:
+      quota, period = file.read().split()
+    if quota != 'max': return max(1, int(int(quota) / int(period)))
+  except (OSError, ValueError):
+    pass
+  return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+
+def _init_worker(threads: int):
+  # before torch is imported, so its intra-op pool is sized once
+  os.environ['OMP_NUM_THREADS'] = str(threads)
+  os.environ['MKL_NUM_THREADS'] = str(threads)
+  import torch
+  torch.set_num_threads(threads)
+  logging.basicConfig(level=logging.INFO)
+
+def _measured(fn, args: tuple):
+  start = time.perf_counter()
+  res = fn(*args)
+  # ru_maxrss is in KiB on linux, each worker runs a single task so this is that task's peak
+  peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+  return res, { 'wall_seconds': round(time.perf_counter() - start, 1), 'peak_rss_mib': round(peak_rss) }
+
+def run_parallel(fn, tasks: list[tuple]):
+  ''' Runs fn(*task) for each task in its own process, splitting the container's vCPUs between them. Tasks end with
+  the feature they train, returns the results and the wall clock time and peak RSS per feature. '''
+  workers = max(1, min(TRAIN_WORKERS, len(tasks)))
+  threads = max(1, available_cpus() // workers)
+
+  # spawn rather than fork, torch doesn't survive forking once its thread pools exist
+  context = multiprocessing.get_context('spawn')
+  with context.Pool(workers, initializer=_init_worker, initargs=(threads,), maxtasksperchild=1) as pool:
+    results = pool.starmap(_measured, [(fn, args) for args in tasks])
+
+  report = {}
+  for args, (_, stats) in zip(tasks, results):
+    report[args[-1]] = { **stats, 'threads': threads }
+    log.info(f'{fn.__name__} {args[-1]}: {stats["wall_seconds"]}s wall, {stats["peak_rss_mib"]} MiB peak rss, {threads} threads')
+
+  return [res for res, _ in results], report
 
+def _new_model(feature: str):
+  ''' An unfitted model for feature, with the features which influence it as future regressors. '''
   # this is an expensive import, we'll only do it when this handler is called
   from neuralprophet import NeuralProphet
   from neuralprophet.logger import MetricsLogger
 
-  # create new model
   model = NeuralProphet(
     growth='off',
     yearly_seasonality=True,
@@ -50,10 +103,7 @@ def create_model(data: pd.DataFrame, usgs_site: str, feature: str):
     n_forecasts=constants.FORECAST_HORIZON,
     ar_layers=[64] * 4,
     learning_rate=0.003,
-    quantiles=[
-      round(((1 - constants.CONFIDENCE_INTERVAL) / 2), 2),
-      round((constants.CONFIDENCE_INTERVAL + (1 - constants.CONFIDENCE_INTERVAL) / 2), 2)
-    ],
+    quantiles=list(skill.quantiles()),
     drop_missing=True
   )
   model.metrics_logger = MetricsLogger(save_dir='/tmp/fc')
@@ -61,6 +111,42 @@ def create_model(data: pd.DataFrame, usgs_site: str, feature: str):
   for feat in filter(lambda f: f != feature, constants.FEATURE_COLS[feature]):
     model.add_future_regressor(feat)
 
+  return model
+
+@contextmanager
+def _warm_start(model, previous):
+  ''' Starts the unfitted model's fit from the previous model's weights and normalization. neuralprophet can't
+  continue fitting a fitted model, and reinitializes both on every fit. '''
+  normalization = model.config_normalization
+  init_model = model._init_model
+
+  def init_previous_data_params(*args, **kwargs):
+    # back to the class method before the net copies the config into its (pickled) hyperparameters
+    del normalization.init_data_params
+    normalization.init_data_params(*args, **kwargs)
+    # the weights were fitted in the previous model's scale rather than the new observations'
+    normalization.local_data_params = previous.config_normalization.local_data_params
+    normalization.global_data_params = previous.config_normalization.global_data_params
+
+  def init_previous_model():
+    net = init_model()
+    net.load_state_dict(previous.model.state_dict())
+    return net
+
+  model._init_model, normalization.init_data_params = init_previous_model, init_previous_data_params
+  try:
+    yield model
+  finally:
+    # the model is pickled when saved
+    del model._init_model
+    vars(normalization).pop('init_data_params', None)
+
+def create_model(store: dict, usgs_site: str, feature: str):
+  historical = utils.prep_features(featurestore.attach(store), feature)
+  log.info(f'dataset ready for training: {historical}')
+
+  # create new model
+  model = _new_model(feature)
   train, test = model.split_df(historical, freq='H', valid_p=0.2)
 
   # fit model
@@ -70,16 +156,107 @@ def create_model(data: pd.DataFrame, usgs_site: str, feature: str):
 
   # evaluate model
   log.info('generating metrics...')
-  logging.getLogger('py.warnings').setLevel('ERROR') # hide predict warnings
-  predictions = model.predict(test)
-  metrics = pd.DataFrame(0, index=np.arange(1, constants.FORECAST_HORIZON + 1), columns=['mae', 'mse'])
-  for i in range(1, constants.FORECAST_HORIZON + 1):
-    err = (predictions[f'yhat{i}'] - predictions['y']).dropna()
-    metrics.loc[i, 'mae'] = sum(abs(err)) / err.shape[0]
-    metrics.loc[i, 'mse'] = sum(np.square(err)) / err.shape[0]
-  metrics['rmse'] = np.sqrt(metrics['mse'])
-
+  metrics = evaluate(model, test)
   log.info(f'test metrics by horizon:\n{metrics.loc[metrics.index % 6 == 0]}')
 
   # save model
+  now = datetime.now(timezone.utc).timestamp()
+  trained_through = int(historical['ds'].max().timestamp())
+  s3.save_model(model, usgs_site, feature)
+  export_inference_engine(model, test, usgs_site, feature)
+  s3.save_skill(usgs_site, feature, skill.to_artifact(metrics, 'test', now, trained_through))
+  s3.save_model_meta(usgs_site, feature, {
+    'trained_through': trained_through,
+    'full_trained_at': now,
+    'fine_tuned_at': None,
+    'validation_mae': float(metrics['mae'].mean())
+  })
+
+def evaluate(model, df: pd.DataFrame, after: pd.Timestamp = None):
+  ''' Error and quantile coverage of the model's predictions on df by forecast horizon (see skill.horizon_metrics),
+  optionally only for rows after a timestamp. '''
+  logging.getLogger('py.warnings').setLevel('ERROR') # hide predict warnings
+  predictions = model.predict(df)
+  if after is not None: predictions = predictions[predictions['ds'] > after]
+
+  return skill.horizon_metrics(predictions)
+
+def update_model(store: dict, usgs_site: str, feature: str):
+  ''' Fine-tunes the current model on observations since it was last trained. Returns False if the model needs a
+  full retrain instead, because there is none, one is scheduled, or its error on the new observations degraded. '''
+  meta = s3.load_model_meta(usgs_site, feature)
+  if meta is None:
+    log.info(f'no training metadata for {feature} model, retraining')
+    return False
+
+  now = datetime.now(timezone.utc).timestamp()
+  if now - meta['full_trained_at'] >= FULL_RETRAIN_INTERVAL_DAYS * 24 * 3600:
+    log.info(f'{feature} model was fully trained over {FULL_RETRAIN_INTERVAL_DAYS} days ago, retraining')
+    return False
+
+  model = s3.load_model(usgs_site, feature)
+  if model is None: return False
+
+  # new observations, plus enough preceding ones to fill the lags of the first
+  context_hours = model.n_lags + model.n_forecasts
+  data = featurestore.attach(store)
+  trained_through = pd.Timestamp(meta['trained_through'], unit='s', tz='UTC')
+  new_obs = int((data.index > trained_through).sum())
+  if new_obs < MIN_FINE_TUNE_HOURS:
+    log.info(f'only {new_obs} new observations since {feature} model was trained, keeping it')
+    return True
+
+  historical = utils.prep_features(data[data.index > trained_through - pd.Timedelta(hours=context_hours)], feature)
+  trained_through = trained_through.tz_convert(None)
+
+  # the current model hasn't seen the new observations, so its error on them is a validation error
+  metrics = evaluate(model, historical, after=trained_through)
+  validation_mae = float(metrics['mae'].mean())
+  log.info(f'{feature} model mae on {new_obs} new observations: {validation_mae:.4f} (after full training: {meta["validation_mae"]:.4f})')
+  if validation_mae > meta['validation_mae'] * MAX_VALIDATION_DEGRADATION:
+    log.info(f'{feature} model error degraded past {MAX_VALIDATION_DEGRADATION}x, retraining')
+    return False
+
+  try:
+    tuned = _new_model(feature)
+    with _warm_start(tuned, model):
+      tuned.fit(historical, freq='H', epochs=FINE_TUNE_EPOCHS)
+  except Exception as e:
+    # ie. the model was trained with another configuration, so its weights don't fit
+    log.warning(f'unable to fine-tune {feature} model, retraining: {e}')
+    return False
+  model = tuned
+
+  # the metrics are from before fine-tuning, so the skill report stays out of sample
+  trained_through = int(historical['ds'].max().timestamp())
   s3.save_model(model, usgs_site, feature)
+  export_inference_engine(model, historical, usgs_site, feature)
+  s3.save_skill(usgs_site, feature, skill.to_artifact(metrics, 'new_observations', now, trained_through))
+  s3.save_model_meta(usgs_site, feature, {
+    **meta,
+    'trained_through': trained_through,
+    'fine_tuned_at': now,
+    'last_validation_mae': validation_mae
+  })
+  log.info(f'fine-tuned {feature} model on {new_obs} new observations')
+
+  return True
+
+def export_inference_engine(model, test: pd.DataFrame, usgs_site: str, feature: str):
+  ''' Saves the torch free inference artifact next to the model, only if it reproduces neuralprophet's forecast.
+  Otherwise the stale artifact is removed, so the forecast handler falls back to neuralprophet. '''
+  try:
+    engine = inference.export_model(model)
+    parity = inference.check_parity(model, engine, test)
+  except Exception as e:
+    log.warning(f'unable to export inference engine for {feature}: {e}')
+    s3.delete_inference_engine(usgs_site, feature)
+    return
+
+  log.info(f'inference engine parity for {feature}: {parity:.2e} (tolerance {inference.PARITY_TOLERANCE:.0e})')
+  if parity > inference.PARITY_TOLERANCE:
+    log.warning(f'inference engine for {feature} does not match neuralprophet, not exporting')
+    s3.delete_inference_engine(usgs_site, feature)
+    return
+
+  s3.save_inference_engine(engine, usgs_site, feature)
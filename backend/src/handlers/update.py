@@ -1,12 +1,20 @@
+import os
 import logging
 import pandas as pd
 from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 
-from utils import usgs, weather, db, utils, s3
-from utils.constants import TIMESERIES_FREQUENCY, MAX_HISTORY_REACHBACK_YEARS, FORECAST_HORIZON
+from utils import usgs, weather, db, utils, s3, featurestore, upstream, sites
+from utils.constants import TIMESERIES_FREQUENCY, MAX_HISTORY_REACHBACK_YEARS, FORECAST_HORIZON, \
+    WATER_CONDITION_FEATURES, ATMOSPHERIC_WEATHER_FEATURES
 
 log = logging.getLogger(__name__)
 
+HIST_COLUMNS = [*WATER_CONDITION_FEATURES.values(), *ATMOSPHERIC_WEATHER_FEATURES.values()]
+# the usgs and visual crossing fetches are independent, run them side by side unless disabled
+CONCURRENT_FETCH = os.environ.get('UPDATE_CONCURRENT_FETCH', 'true').lower() in ['1', 'true']
+BATCH_LOOKUP_WORKERS = int(os.environ.get('UPDATE_BATCH_LOOKUP_WORKERS', 8))
+
 def handler(event, _context):
   usgs_site = event['usgs_site']
   is_onboarding = event['is_onboarding']
@@ -15,35 +23,83 @@ def handler(event, _context):
     db.update_site_status(usgs_site, db.SiteStatus.FETCHING_DATA)
     db.push_site_onboarding_log(usgs_site, f'📥 Started data fetching for site {usgs_site} at {utils.get_current_local_time()}')
 
-  # get most recent entry
-  last_obs = db.get_latest_hist_entry(usgs_site)
+  upstream.reset_stats()
+  carry, start_dt = get_start(usgs_site)
+  res = update_site(usgs_site, is_onboarding, carry, start_dt)
+  upstream.log_stats(f'update {usgs_site}')
+
+  return res
+
+def batch_handler(event, _context):
+  ''' Updates several active sites, their usgs observations are fetched together in a few multi-site requests and
+  then merged site by site. A failing site doesn't fail the batch. '''
+  usgs_sites = event['usgs_sites']
+
+  upstream.reset_stats()
+  results = {}
+
+  def lookup_start(usgs_site: str):
+    try:
+      return get_start(usgs_site)
+    except Exception as e:
+      log.exception(f'failed to look up the last observation of site {usgs_site}')
+      results[usgs_site] = { 'statusCode': 500, 'error': repr(e) }
+      return None
+
+  with ThreadPoolExecutor(max_workers=max(1, min(BATCH_LOOKUP_WORKERS, len(usgs_sites)))) as executor:
+    starts = { usgs_site: start for usgs_site, start in zip(usgs_sites, executor.map(lookup_start, usgs_sites)) if start is not None }
+  observations, errors = usgs.fetch_observations_batch({ usgs_site: start_dt for usgs_site, (_, start_dt) in starts.items() })
+
+  for usgs_site, (carry, start_dt) in starts.items():
+    if usgs_site in errors:
+      results[usgs_site] = { 'statusCode': 500, 'error': repr(errors[usgs_site]) }
+      continue
+    try:
+      results[usgs_site] = update_site(usgs_site, False, carry, start_dt, observations[usgs_site])
+    except Exception as e:
+      log.exception(f'failed to update site {usgs_site}')
+      results[usgs_site] = { 'statusCode': 500, 'error': repr(e) }
+  upstream.log_stats(f'update batch of {len(usgs_sites)} sites')
+
+  failed = [usgs_site for usgs_site, res in results.items() if res['statusCode'] != 200]
+  log.info(f'updated {len(usgs_sites) - len(failed)}/{len(usgs_sites)} sites' + (f', failed: {failed}' if failed else ''))
+
+  return { 'statusCode': 200, 'results': results, 'failed': failed }
+
+def get_start(usgs_site: str):
+  ''' The latest stored observation (None if there is none) and the time new observations are fetched from. '''
+  # get most recent entry, its values anchor the interpolation of the new observations
+  last_obs = db.get_latest_hist_entry(usgs_site, attributes=['timestamp', *HIST_COLUMNS])
+  carry = last_obs
   if last_obs is None:
     last_obs = {'timestamp': (datetime.now(timezone.utc) - pd.Timedelta(days=MAX_HISTORY_REACHBACK_YEARS * 365)).timestamp()}
   last_obs_ts = pd.to_datetime(int(last_obs['timestamp']), unit='s', utc=True)
 
-  log.info(f'last observation timestamped {last_obs_ts}')
+  log.info(f'last observation of site {usgs_site} timestamped {last_obs_ts}')
+
+  return carry, last_obs_ts + pd.Timedelta(minutes=1)
 
-  start_dt = last_obs_ts + pd.Timedelta(minutes=1)
+def update_site(usgs_site: str, is_onboarding: bool, carry: dict, start_dt: pd.Timestamp, water_observations: pd.DataFrame = None):
+  ''' Fetches, aligns and stores the observations after start_dt, and the weather forecast from the latest one. The
+  usgs observations are only fetched if they aren't passed in (see batch_handler). '''
   if (datetime.now(timezone.utc) - start_dt).days * 24 > 25000:
     log.warn(f'start date {start_dt} is too far in the past for direct weather queries, checking s3')
     s3.verify_jumpstart_archive_exists(usgs_site, 'hist', int(start_dt.timestamp()))
 
-  # fetch usgs data
-  water_conditions = usgs.fetch_observations(start_dt, usgs_site)
-  # usgs records in celsius, convert watertemp to fahrenheit
-  water_conditions['watertemp'] = water_conditions['watertemp'].apply(lambda c: (c * 9/5) + 32)
-  if is_onboarding: db.push_site_onboarding_log(usgs_site, '\tfinished retrieving water conditions from the USGS')
-
-  # fetch weather data
-  site_location = usgs.get_site_coords(usgs_site)
-  if is_onboarding: db.push_site_onboarding_log(usgs_site, '\tretrieved site metadata from the USGS')
-  atmospheric_conditions_hist, atmospheric_conditions_fcst = weather.fetch_observations(start_dt, site_location, usgs_site)
-  if is_onboarding: db.push_site_onboarding_log(usgs_site, '\tretrieved atmospheric weather data from Visual Crossing')
+  # fetch usgs and weather data
+  if water_observations is not None or not CONCURRENT_FETCH:
+    water_conditions = fetch_water_conditions(start_dt, usgs_site, is_onboarding, water_observations)
+    atmospheric_conditions_hist, atmospheric_conditions_fcst = fetch_atmospheric_conditions(start_dt, usgs_site, is_onboarding)
+  else:
+    with ThreadPoolExecutor(max_workers=2) as executor:
+      water_fetch = executor.submit(fetch_water_conditions, start_dt, usgs_site, is_onboarding)
+      weather_fetch = executor.submit(fetch_atmospheric_conditions, start_dt, usgs_site, is_onboarding)
+      water_conditions = water_fetch.result()
+      atmospheric_conditions_hist, atmospheric_conditions_fcst = weather_fetch.result()
 
-  # merge and resample
-  hist_conditions = utils.merge_dfs([water_conditions, atmospheric_conditions_hist])
-  hist_conditions = utils.resample_df(hist_conditions, TIMESERIES_FREQUENCY)
-  atmospheric_conditions_fcst = utils.resample_df(atmospheric_conditions_fcst, TIMESERIES_FREQUENCY)
+  # merge and resample, only hours after the last stored observation
+  hist_conditions = utils.align_hourly([water_conditions, atmospheric_conditions_hist], TIMESERIES_FREQUENCY, carry=carry)
+  atmospheric_conditions_fcst = utils.align_hourly([atmospheric_conditions_fcst], TIMESERIES_FREQUENCY)
   origin_ts = hist_conditions.index.max() if hist_conditions.shape[0] > 0 else atmospheric_conditions_fcst.index.min() - pd.Timedelta(hours=1)
   atmospheric_conditions_fcst = atmospheric_conditions_fcst[(atmospheric_conditions_fcst.index > origin_ts)
       & (atmospheric_conditions_fcst.index <= origin_ts + pd.Timedelta(hours=FORECAST_HORIZON))]
@@ -57,10 +113,26 @@ def handler(event, _context):
 
   # push to ddb
   log.info('pushing entries to ddb')
-  # a viewing the debug level logs from ddb during upload is helpful
-  logging.getLogger('boto3.dynamodb.table').setLevel(logging.DEBUG)
-  db.push_hist_entries(hist_rows)
+  hist_stats = db.push_hist_entries(hist_rows)
   db.push_fcst_entries(fcst_rows)
-  if is_onboarding: db.push_site_onboarding_log(usgs_site, f'\tsaved new site data to database, finished fetching data at {utils.get_current_local_time()}')
+
+  # keep the feature store current so forecasting reads its lags from it, training creates it when onboarding
+  store = featurestore.load(usgs_site)
+  if store is not None: featurestore.extend(usgs_site, store)
+  if is_onboarding: db.push_site_onboarding_log(usgs_site, f'\tsaved {hist_stats["items"]} new observations to database ({hist_stats["items_per_second"]:.0f}/s), finished fetching data at {utils.get_current_local_time()}')
 
   return { 'statusCode': 200 }
+
+def fetch_water_conditions(start_dt: pd.Timestamp, usgs_site: str, is_onboarding: bool, observations: pd.DataFrame = None):
+  water_conditions = observations if observations is not None else usgs.fetch_observations(start_dt, usgs_site)
+  # usgs records in celsius, convert watertemp to fahrenheit
+  water_conditions['watertemp'] = water_conditions['watertemp'].apply(lambda c: (c * 9/5) + 32)
+  if is_onboarding: db.push_site_onboarding_log(usgs_site, '\tfinished retrieving water conditions from the USGS')
+  return water_conditions
+
+def fetch_atmospheric_conditions(start_dt: pd.Timestamp, usgs_site: str, is_onboarding: bool):
+  site_location = sites.get_site_coords(usgs_site)
+  if is_onboarding: db.push_site_onboarding_log(usgs_site, '\tretrieved site metadata')
+  atmospheric_conditions = weather.fetch_observations(start_dt, site_location, usgs_site)
+  if is_onboarding: db.push_site_onboarding_log(usgs_site, '\tretrieved atmospheric weather data from Visual Crossing')
+  return atmospheric_conditions
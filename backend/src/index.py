@@ -2,7 +2,12 @@ import logging
 import os
 import sys
 import shutil
+import importlib
 from datetime import datetime
+
+from utils import importtime
+importtime.install()
+
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -14,12 +19,21 @@ else:
     logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger(__name__)
 
-import handlers.forecast as forecast
-import handlers.train as train
-import handlers.update as update
-import handlers.access as access
-import handlers.export as export
-import handlers.onboard as onboard
+# entry point -> (module, function), modules are imported on first use so each lambda only loads its own handler
+HANDLERS = {
+  'forecast': ('handlers.forecast', 'handler'),
+  'forecast_batch': ('handlers.forecast', 'batch_handler'),
+  'train': ('handlers.train', 'handler'),
+  'update': ('handlers.update', 'handler'),
+  'update_batch': ('handlers.update', 'batch_handler'),
+  'access': ('handlers.access', 'handler'),
+  'export': ('handlers.export', 'handler'),
+  'onboard_connect': ('handlers.onboard', 'connect'),
+  'onboard_disconnect': ('handlers.onboard', 'disconnect'),
+  'onboard_process_stream': ('handlers.onboard', 'process_stream'),
+  'onboard_failed': ('handlers.onboard', 'register_failure')
+}
+_handlers = {}
 
 TMP_DIR = '/tmp/fc'
 IS_LAMBDA_ENV = 'LAMBDA_TASK_ROOT' in os.environ.keys()
@@ -37,7 +51,15 @@ def garbage_collect():
         shutil.rmtree(entry.path)
   log.info(f'...finished, {len(list(os.scandir(TMP_DIR)))} files remain')
 
-def handle(handler, *args):
+def resolve(name: str):
+  if name not in _handlers:
+    module_name, function_name = HANDLERS[name]
+    _handlers[name] = getattr(importlib.import_module(module_name), function_name)
+    importtime.report(name)
+
+  return _handlers[name]
+
+def handle(name: str, *args):
   exec_start_time = datetime.now()
   log.info(f'starting execution at {exec_start_time}')
 
@@ -45,7 +67,7 @@ def handle(handler, *args):
   else: log.info('non-lambda environment, skipping garbage collection')
 
   try:
-    res = handler(*args)
+    res = resolve(name)(*args)
   except Exception as e:
     log.exception(e)
     res = { 'statusCode': 500, 'error': repr(e) }
@@ -56,37 +78,43 @@ def handle(handler, *args):
   return res
 
 def handle_forecast(event, context):
-  return handle(forecast.handler, event, context)
+  return handle('forecast', event, context)
+
+def handle_forecast_batch(event, context):
+  return handle('forecast_batch', event, context)
 
 # this is run in fargate, and as such has slightly different parameters
 def handle_train(usgs_site: str, is_onboarding: bool):
-  return handle(train.handler, usgs_site, is_onboarding)
+  return handle('train', usgs_site, is_onboarding)
 
 def handle_update(event, context):
-  return handle(update.handler, event, context)
+  return handle('update', event, context)
+
+def handle_update_batch(event, context):
+  return handle('update_batch', event, context)
 
 def handle_access(event, context):
-  return handle(access.handler, event, context)
+  return handle('access', event, context)
 
 def handle_export(event, context):
-  return handle(export.handler, event, context)
+  return handle('export', event, context)
 
 def handle_onboard_connect(event, context):
-  return handle(onboard.connect, event, context)
+  return handle('onboard_connect', event, context)
 
 def handle_onboard_disconnect(event, context):
-  return handle(onboard.disconnect, event, context)
+  return handle('onboard_disconnect', event, context)
 
 def handle_onboard_process_stream(event, context):
-  return handle(onboard.process_stream, event, context)
+  return handle('onboard_process_stream', event, context)
 
 def handle_onboard_failed(event, context):
-  return handle(onboard.register_failure, event, context)
-
-import utils.s3 as s3
-import utils.constants as constants
+  return handle('onboard_failed', event, context)
 
 if __name__ == '__main__':
+  import utils.s3 as s3
+  import utils.constants as constants
+
   target = sys.argv[1]
   if target == 'jumpstart': log.debug(s3.fetch_jumpstart_data(constants.USGS_SITE, 'hist', 1599466380))
   elif target == 'forecast': log.debug(handle_forecast(None, None))
@@ -1,20 +1,13 @@
 import boto3
 import json
 from datetime import datetime
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_aws import ChatBedrock
+from functools import cache
 import pandas as pd
 
 from utils.forecast import get_forecast
-from utils.usgs import get_site_info
+from utils.sites import get_site_info
 from utils.constants import SYSTEM, INSTRUCTION
 
-bedrock = boto3.client(
-    service_name='bedrock-runtime',
-    region_name='us-east-1'
-)
-
 MODEL_ID = 'anthropic.claude-3-sonnet-20240229-v1:0'
 MODEL_KWARGS =  { 
     "max_tokens": 2048,
@@ -24,13 +17,26 @@ MODEL_KWARGS =  {
     "stop_sequences": ["\n\nHuman"],
 }
 
-model = ChatBedrock(
-    client=bedrock,
-    model_id=MODEL_ID,
-    model_kwargs=MODEL_KWARGS
-)
+@cache
+def get_model():
+    # langchain and the bedrock client are only needed once a report is generated
+    from langchain_aws import ChatBedrock
+
+    bedrock = boto3.client(
+        service_name='bedrock-runtime',
+        region_name='us-east-1'
+    )
+
+    return ChatBedrock(
+        client=bedrock,
+        model_id=MODEL_ID,
+        model_kwargs=MODEL_KWARGS
+    )
 
 def get_report(usgs_site: str):
+    from langchain_core.output_parsers import StrOutputParser
+    from langchain_core.prompts import ChatPromptTemplate
+
     forecast = get_forecast(usgs_site)
     forecast = forecast[['snow', 'precip', 'cloudcover', 'timestamp', 'streamflow', 'airtemp', 'watertemp', 'type']]
     forecast['timestamp'] = forecast['timestamp'].apply(lambda x: datetime.fromtimestamp(float(x)))
@@ -46,7 +52,7 @@ def get_report(usgs_site: str):
     ]
     prompt = ChatPromptTemplate.from_messages(messages)
 
-    chain = prompt | model | StrOutputParser()
+    chain = prompt | get_model() | StrOutputParser()
 
     return chain.invoke({
         'TODAYS_DATE': datetime.now().isoformat(),
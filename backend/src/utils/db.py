@@ -1,96 +1,334 @@
 import os
 import json
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import boto3
 from boto3.dynamodb.conditions import Key, Attr
+from botocore.exceptions import ClientError
 from enum import Enum
 
-from utils import usgs
+from utils import usgs, packed, storage, constants
 
-# * ddb
-
-print('initializing ddb client')
+log = logging.getLogger(__name__)
 
-dynamodb = boto3.resource('dynamodb')
-data_table = dynamodb.Table('flowcast-data')
-report_table = dynamodb.Table('flowcast-reports')
-site_table = dynamodb.Table('flowcast-sites')
-
-stepfunctions = boto3.client('stepfunctions')
+# * ddb
 
-def get_latest_hist_entry(usgs_site):
-  res = data_table.query(
+def _create_dynamodb():
+  print('initializing ddb client')
+  return storage.resource('dynamodb')
+
+DATA_TABLE_NAME = 'flowcast-data'
+
+# created on first use
+dynamodb = storage.Lazy(_create_dynamodb)
+data_table = storage.Lazy(lambda: dynamodb.Table(DATA_TABLE_NAME))
+report_table = storage.Lazy(lambda: dynamodb.Table('flowcast-reports'))
+site_table = storage.Lazy(lambda: dynamodb.Table('flowcast-sites'))
+
+stepfunctions = storage.lazy_client('stepfunctions')
+
+# 'rows' stores one item per forecast hour, 'packed' stores one item per forecast run (see utils.packed),
+# reads handle both formats regardless of this setting
+FCST_STORAGE_FORMAT = os.environ.get('FCST_STORAGE_FORMAT', 'rows')
+
+QUERY_WORKERS = int(os.environ.get('DDB_QUERY_WORKERS', 8))
+QUERY_SEGMENT_SECONDS = 4 * 7 * 24 * 3600 # split long time ranges into ~4 week segments
+
+WRITE_WORKERS = int(os.environ.get('DDB_WRITE_WORKERS', 8))
+WRITE_CAPACITY_BUDGET = float(os.environ.get('DDB_WRITE_CAPACITY_BUDGET', 0)) # items/s across all workers, 0 is unbounded
+WRITE_BATCH_SIZE = 25 # BatchWriteItem maximum
+WRITE_MAX_ATTEMPTS = 10
+WRITE_BACKOFF_BASE_SECONDS = 0.05
+WRITE_BACKOFF_MAX_SECONDS = 5
+THROTTLE_ERROR_CODES = ['ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded']
+
+_thread_state = threading.local()
+
+# kept for the life of the process, so their threads' sessions (see _thread_resource) are reused across calls and
+# warm invocations rather than created for every query or write
+_query_executor = storage.Lazy(lambda: ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix='ddb_query'))
+_write_executor = storage.Lazy(lambda: ThreadPoolExecutor(max_workers=WRITE_WORKERS, thread_name_prefix='ddb_write'))
+
+def _thread_resource():
+  # boto3 resources are not thread safe, each worker gets its own session
+  if threading.current_thread() is threading.main_thread(): return dynamodb
+  if not hasattr(_thread_state, 'resource'):
+    _thread_state.resource = storage.resource('dynamodb', new_session=True)
+  return _thread_state.resource
+
+def _thread_table(table_name: str):
+  if threading.current_thread() is threading.main_thread(): return dynamodb.Table(table_name)
+  tables = getattr(_thread_state, 'tables', None)
+  if tables is None:
+    tables = _thread_state.tables = {}
+  if table_name not in tables:
+    tables[table_name] = _thread_resource().Table(table_name)
+  return tables[table_name]
+
+def _table(table):
+  ''' The shared table in the main thread, or the worker's own copy when called from a pool (ie. batch forecasts). '''
+  if threading.current_thread() is threading.main_thread(): return table
+  return _thread_table(table.name)
+
+def _projection(attributes: list[str]):
+  names = {f'#p{i}': attr for i, attr in enumerate(attributes)}
+  return { 'ProjectionExpression': ', '.join(names.keys()), 'ExpressionAttributeNames': names }
+
+def _query_all(table, limit: int = None, attributes: list[str] = None, page_size: int = None, **kwargs):
+  ''' Runs a query, following LastEvaluatedKey until all pages (or `limit` items) are retrieved. Queries with a
+  FilterExpression should set page_size, the Limit of a page counts the items read before they are filtered. '''
+  if attributes is not None: kwargs.update(_projection(attributes))
+
+  items = []
+  while True:
+    if page_size is not None: kwargs['Limit'] = page_size
+    elif limit is not None: kwargs['Limit'] = limit - len(items)
+    res = table.query(**kwargs)
+    items += res['Items']
+
+    if 'LastEvaluatedKey' not in res or (limit is not None and len(items) >= limit):
+      return items if limit is None else items[:limit]
+    kwargs['ExclusiveStartKey'] = res['LastEvaluatedKey']
+
+def _split_range(start_ts: int, end_ts: int):
+  ''' Splits [start_ts, end_ts] into inclusive, non-overlapping sub-ranges of QUERY_SEGMENT_SECONDS. '''
+  return [(lo, min(lo + QUERY_SEGMENT_SECONDS - 1, end_ts))
+      for lo in range(start_ts, end_ts + 1, QUERY_SEGMENT_SECONDS)]
+
+def _query_segments(table_name: str, key_condition, segments: list[tuple[int, int]], **kwargs):
+  ''' Queries each (lo, hi) segment concurrently, returning items merged in segment order. '''
+  def query_segment(segment):
+    return _query_all(_thread_table(table_name), KeyConditionExpression=key_condition(*segment), **kwargs)
+
+  if len(segments) == 1: return query_segment(segments[0])
+
+  pages = _query_executor.map(query_segment, segments)
+  return [item for page in pages for item in page]
+
+def get_latest_hist_entry(usgs_site, attributes: list[str] = None):
+  items = _query_all(
+    _table(data_table),
     KeyConditionExpression=Key('usgs_site#type')
         .eq(f'{usgs_site}#hist'),
     ScanIndexForward=False,
-    Limit=1
+    limit=1,
+    attributes=attributes
   )
 
   try:
-    return res['Items'][0]
+    return items[0]
   except IndexError:
     return None
 
-def get_latest_fcst_entry(usgs_site):
-  res = data_table.query(
-    KeyConditionExpression=Key('usgs_site#type')
-        .eq(f'{usgs_site}#fcst'),
-    FilterExpression=Attr('watertemp').exists(), # avoid retrieving partial forecasts during update
-    ScanIndexForward=False,
-    Limit=1
+def _packed_attributes(attributes: list[str]):
+  if attributes is None: return None
+  return ['usgs_site', 'origin', 'columns', 'timestamps', *(a for a in attributes if a not in packed.ROW_META)]
+
+def _unpack(items: list[dict], attributes: list[str] = None):
+  rows = [row for item in items for row in packed.unpack_fcst_item(item)]
+  if attributes is None: return rows
+  return [{attr: row[attr] for attr in attributes if attr in row} for row in rows]
+
+def get_latest_fcst_entry(usgs_site, attributes: list[str] = None):
+  # the configured format is read first, the other only for sites not forecast since it was changed
+  types = [packed.PACKED_TYPE, 'fcst'] if FCST_STORAGE_FORMAT == 'packed' else ['fcst', packed.PACKED_TYPE]
+  for type in types:
+    is_packed = type == packed.PACKED_TYPE
+    items = _query_all(
+      _table(data_table),
+      KeyConditionExpression=Key('usgs_site#type')
+          .eq(f'{usgs_site}#{type}'),
+      FilterExpression=Attr('watertemp').exists(), # avoid retrieving partial forecasts during update
+      ScanIndexForward=False,
+      limit=1,
+      # a page past the rows of a partial run (one item when packed), rather than a round trip per filtered row
+      page_size=constants.FORECAST_HORIZON + 1 if not is_packed else 2,
+      attributes=_packed_attributes(attributes) if is_packed else attributes
+    )
+    if len(items) > 0: return _unpack(items, attributes)[-1] if is_packed else items[0]
+
+  return None
+
+def _get_packed_fcst(usgs_site, origin, attributes: list[str] = None):
+  res = _table(data_table).get_item(
+    Key={
+      'usgs_site#type': f'{usgs_site}#{packed.PACKED_TYPE}',
+      'origin#timestamp': f'{int(origin)}#{int(origin)}'
+    },
+    **({} if attributes is None else _projection(_packed_attributes(attributes)))
   )
+  return _unpack([res['Item']], attributes) if 'Item' in res else None
 
-  try:
-    return res['Items'][0]
-  except IndexError:
-    return None
+def get_entire_fcst(usgs_site, origin, attributes: list[str] = None):
+  # the configured format is read first, the other only for runs written before it was changed
+  if FCST_STORAGE_FORMAT == 'packed':
+    run = _get_packed_fcst(usgs_site, origin, attributes)
+    if run is not None: return run
 
-def get_entire_fcst(usgs_site, origin):
-  res = data_table.query(
+  rows = _query_all(
+    _table(data_table),
     KeyConditionExpression=Key('usgs_site#type')
         .eq(f'{usgs_site}#fcst') & Key('origin#timestamp')
-        .begins_with(str(origin))
+        .begins_with(str(origin)),
+    attributes=attributes
   )
+  if len(rows) > 0 or FCST_STORAGE_FORMAT == 'packed': return rows
 
-  return res['Items']
+  return _get_packed_fcst(usgs_site, origin, attributes) or []
 
-def get_hist_entries_after(usgs_site, start_ts):
-  res = data_table.query(
-    KeyConditionExpression=Key('usgs_site#type')
-        .eq(f'{usgs_site}#hist') & Key('origin#timestamp').gte(f'{start_ts}'),
-  )
+def get_hist_entries_after(usgs_site, start_ts, attributes: list[str] = None):
+  start_ts = int(float(start_ts))
+  end_ts = int(datetime.now().timestamp())
+  segments = _split_range(start_ts, max(start_ts, end_ts))
+
+  def key_condition(lo, hi):
+    pk = Key('usgs_site#type').eq(f'{usgs_site}#hist')
+    # last segment is left open, hist rows may be stamped slightly past now after resampling
+    if hi == segments[-1][1]: return pk & Key('origin#timestamp').gte(f'{lo}')
+    # sort keys are '{origin}#{timestamp}', '~' sorts after every digit so this covers origins in [lo, hi]
+    return pk & Key('origin#timestamp').between(f'{lo}', f'{hi}#~')
 
-  return res['Items']
+  return _query_segments(DATA_TABLE_NAME, key_condition, segments, attributes=attributes)
 
-def get_n_most_recent_hist_entries(usgs_site, n):
-  res = data_table.query(
+def get_n_most_recent_hist_entries(usgs_site, n, attributes: list[str] = None):
+  return _query_all(
+    _table(data_table),
     KeyConditionExpression=Key('usgs_site#type')
         .eq(f'{usgs_site}#hist'),
     ScanIndexForward=False,
-    Limit=n
+    limit=n,
+    attributes=attributes
   )
 
-  return res['Items']
-
-def get_fcsts_with_horizon_after(usgs_site, horizon, start_ts):
-  res = data_table.query(
-    IndexName='fcst_horizon_aware_index',
-    KeyConditionExpression=Key('usgs_site#type')
-        .eq(f'{usgs_site}#fcst') & Key('horizon#timestamp')
-        .between(f'{horizon}#{start_ts}', f'{horizon}#{datetime.now().timestamp()}')
-  )
-
-  return res['Items']
+def get_fcsts_with_horizon_after(usgs_site, horizon, start_ts, attributes: list[str] = None):
+  horizon = int(horizon)
+  start_ts = int(float(start_ts))
+  end_ts = int(datetime.now().timestamp())
+  segments = _split_range(start_ts, max(start_ts, end_ts))
+  # timestamps are needed to merge both formats in order, dropped again below if not requested
+  query_attributes = attributes and list(dict.fromkeys([*attributes, 'timestamp']))
+
+  def key_condition(lo, hi):
+    return Key('usgs_site#type').eq(f'{usgs_site}#fcst') & Key('horizon#timestamp') \
+        .between(f'{horizon}#{lo}', f'{horizon}#{hi}')
+
+  items = _query_segments(DATA_TABLE_NAME, key_condition, segments,
+      IndexName='fcst_horizon_aware_index', attributes=query_attributes)
+
+  # packed runs are not in the horizon index, pick the horizon out of runs with origins in range instead
+  def packed_key_condition(lo, hi):
+    return Key('usgs_site#type').eq(f'{usgs_site}#{packed.PACKED_TYPE}') & Key('origin#timestamp') \
+        .between(f'{lo - horizon}', f'{hi - horizon}#~')
+
+  runs = _query_segments(DATA_TABLE_NAME, packed_key_condition, segments,
+      attributes=_packed_attributes(query_attributes))
+  if len(runs) < 1: return items
+
+  items += [row for row in _unpack(runs, query_attributes and [*query_attributes, 'horizon'])
+      if row['horizon'] == horizon and start_ts <= row['timestamp'] <= end_ts]
+  items = sorted(items, key=lambda item: int(item['timestamp']))
+  if attributes is None: return items
+  return [{attr: item[attr] for attr in attributes if attr in item} for item in items]
+
+class WriteBudget:
+  ''' Token bucket shared by the write workers, limiting the total item write rate. '''
+  def __init__(self, items_per_second: float):
+    self.rate = items_per_second
+    self.tokens = items_per_second
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self, n: int):
+    if self.rate <= 0: return
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # batches larger than the bucket are let through once it is full
+        if self.tokens >= min(n, self.rate):
+          self.tokens -= n
+          return
+        wait = (min(n, self.rate) - self.tokens) / self.rate
+      time.sleep(wait)
+
+def _backoff(attempt: int):
+  # full jitter, https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+  time.sleep(random.uniform(0, min(WRITE_BACKOFF_MAX_SECONDS, WRITE_BACKOFF_BASE_SECONDS * 2 ** attempt)))
+
+def batch_write(table_name: str, entries: list[dict], workers: int = None, capacity_budget: float = None):
+  ''' Writes entries with concurrent BatchWriteItem calls, retrying unprocessed items with jittered backoff.
+  Returns throughput metrics for the ingest. '''
+  workers = workers or WRITE_WORKERS
+  budget = WriteBudget(WRITE_CAPACITY_BUDGET if capacity_budget is None else capacity_budget)
+  stats = { 'items': len(entries), 'batches': 0, 'retries': 0, 'throttles': 0 }
+  stats_lock = threading.Lock()
+
+  def write_batch(batch: list[dict]):
+    requests = [{ 'PutRequest': { 'Item': entry } } for entry in batch]
+    for attempt in range(WRITE_MAX_ATTEMPTS):
+      budget.acquire(len(requests))
+      try:
+        res = _thread_resource().batch_write_item(RequestItems={ table_name: requests })
+        requests = res.get('UnprocessedItems', {}).get(table_name, [])
+        throttled = False
+      except ClientError as e:
+        if e.response['Error']['Code'] not in THROTTLE_ERROR_CODES: raise
+        throttled = True
+
+      with stats_lock:
+        stats['batches'] += 1
+        if throttled: stats['throttles'] += 1
+        if len(requests) > 0: stats['retries'] += 1
+      if len(requests) == 0: return
+
+      _backoff(attempt)
+
+    raise RuntimeError(f'failed to write {len(requests)} items to {table_name} after {WRITE_MAX_ATTEMPTS} attempts')
+
+  batches = [entries[i:i + WRITE_BATCH_SIZE] for i in range(0, len(entries), WRITE_BATCH_SIZE)]
+  start = time.monotonic()
+  # small writes (ie. an hourly forecast) aren't worth handing to workers
+  if len(batches) <= 1 or workers <= 1:
+    for batch in batches: write_batch(batch)
+  elif workers == WRITE_WORKERS:
+    # list() surfaces any worker exceptions
+    list(_write_executor.map(write_batch, batches))
+  else:
+    with ThreadPoolExecutor(max_workers=min(workers, len(batches))) as executor:
+      list(executor.map(write_batch, batches))
+
+  stats['seconds'] = time.monotonic() - start
+  stats['items_per_second'] = stats['items'] / stats['seconds'] if stats['seconds'] > 0 else 0
+  log.info(f'wrote {stats["items"]} items to {table_name} in {stats["seconds"]:.2f}s '
+      f'({stats["items_per_second"]:.0f} items/s, {stats["throttles"]} throttles, {stats["retries"]} retries)')
+
+  return stats
 
 def push_hist_entries(entries: list[dict]):
-  with data_table.batch_writer() as batch:
-    for entry in entries:
-      batch.put_item(Item=entry)
+  return batch_write(DATA_TABLE_NAME, entries)
+
+def _merge_stored_runs(entries: list[dict]):
+  ''' entries with the stored rows of their runs which they don't replace. A packed item holds the whole run, so
+  writing only some rows (ie. the predicted ones) would otherwise drop the others, which per row items keep. '''
+  runs = {}
+  for entry in entries:
+    runs.setdefault((entry['usgs_site'], int(entry['origin'])), {})[int(entry['timestamp'])] = entry
+
+  merged = []
+  for (usgs_site, origin), rows in runs.items():
+    stored = _get_packed_fcst(usgs_site, origin) or []
+    merged += [row for row in stored if int(row['timestamp']) not in rows]
+    merged += rows.values()
+  return merged
 
 def push_fcst_entries(entries: list[dict]):
-  with data_table.batch_writer() as batch:
-    for entry in entries:
-      batch.put_item(Item=entry)
+  if FCST_STORAGE_FORMAT == 'packed': entries = packed.pack_fcst_rows(_merge_stored_runs(entries))
+
+  return batch_write(DATA_TABLE_NAME, entries)
 
 def get_report(usgs_site: str, date: str):
   res = report_table.query(
@@ -109,7 +347,7 @@ def save_report(usgs_site: str, date: str, report: str):
   )
 
 def get_site(usgs_site):
-  res = site_table.query(
+  res = _table(site_table).query(
     KeyConditionExpression=Key('usgs_site').eq(usgs_site)
   )
 
@@ -137,7 +375,7 @@ class SiteStatus(Enum):
   ''' Site failed to onboard. '''
 
 def register_new_site(usgs_site: str, registration_date=datetime.now(), status=SiteStatus.SCHEDULED):
-  UPDATE_AND_FORECAST_STATE_MACHINE_ARN = os.environ['UPDATE_AND_FORECAST_STATE_MACHINE_ARN']
+  UPDATE_AND_FORECAST_STATE_MACHINE_ARN = storage.env('UPDATE_AND_FORECAST_STATE_MACHINE_ARN', 'local:update_and_forecast')
 
   usgs_site_data = usgs.get_site_info(usgs_site)
   item = {
@@ -150,6 +388,7 @@ def register_new_site(usgs_site: str, registration_date=datetime.now(), status=S
     'latitude': usgs_site_data['lat'],
     'longitude': usgs_site_data['lng'],
     'agency': usgs_site_data['agc'],
+    'site_info_updated_at': int(datetime.now().timestamp()),
     'subscription_ids': set(['placeholder'])
   }
 
@@ -199,6 +438,30 @@ def remove_site_subscription(usgs_site: str, subscription_id: str):
     }
   )
 
+def update_site_info(usgs_site: str, site_info: dict):
+  ''' Refreshes the nwis site metadata saved at registration (see sites.get_site_info). '''
+  _table(site_table).update_item(
+    Key={ 'usgs_site': usgs_site },
+    UpdateExpression='SET #name = :name, #category = :category, #latitude = :latitude, #longitude = :longitude, '
+        '#agency = :agency, #updated_at = :updated_at',
+    ExpressionAttributeValues={
+      ':name': site_info['sna'],
+      ':category': site_info['cat'],
+      ':latitude': site_info['lat'],
+      ':longitude': site_info['lng'],
+      ':agency': site_info['agc'],
+      ':updated_at': int(datetime.now().timestamp())
+    },
+    ExpressionAttributeNames={
+      '#name': 'name',
+      '#category': 'category',
+      '#latitude': 'latitude',
+      '#longitude': 'longitude',
+      '#agency': 'agency',
+      '#updated_at': 'site_info_updated_at'
+    }
+  )
+
 def update_site_status(usgs_site: str, status: SiteStatus):
   site_table.update_item(
     Key={ 'usgs_site': usgs_site },
@@ -212,7 +475,8 @@ def update_site_status(usgs_site: str, status: SiteStatus):
   )
 
 def push_site_onboarding_log(usgs_site: str, new_onboarding_log: str):
-  site_table.update_item(
+  # called from the concurrent fetches of an update as well
+  _table(site_table).update_item(
     Key={ 'usgs_site': usgs_site },
     UpdateExpression='SET #onboarding_logs = list_append(#onboarding_logs, :new_onboarding_log)',
     ExpressionAttributeValues={
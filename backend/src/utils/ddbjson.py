@@ -0,0 +1,79 @@
+import re
+import math
+from array import array
+import numpy as np
+
+# scalar attributes of a flat export item, ie. "airtemp":{"N":"51.2"} or "type":{"S":"hist"}
+ATTRIBUTE_PATTERN = re.compile(r'"((?:[^"\\]|\\.)*)"\s*:\s*\{\s*"(N|S)"\s*:\s*"((?:[^"\\]|\\.)*)"\s*\}')
+
+class ColumnBuffer:
+  ''' Growable typed columns for one (site, type) partition, missing values are NaN. '''
+  def __init__(self):
+    self.rows = 0
+    self.timestamps = array('q')
+    self.columns = {}
+
+  def append(self, timestamp: int, values: dict):
+    for name, value in values.items():
+      column = self.columns.get(name)
+      if column is None:
+        column = self.columns[name] = array('d', [math.nan]) * self.rows
+      column.append(value)
+
+    self.rows += 1
+    self.timestamps.append(timestamp)
+    if len(values) < len(self.columns):
+      for column in self.columns.values():
+        if len(column) < self.rows: column.append(math.nan)
+
+  def to_numpy(self):
+    return {
+      'timestamp': np.frombuffer(self.timestamps, dtype=np.int64).copy(),
+      **{ name: np.frombuffer(column, dtype=np.float64).copy() for name, column in self.columns.items() }
+    }
+
+def decode_lines(lines, usgs_site: str = None, skip_types: list[str] = []):
+  ''' Decodes DynamoDB JSON export lines straight into int64 timestamps and float64 columns per (site, type),
+  without building a dict or Decimal per item. String attributes other than the site and type are dropped. '''
+  partitions = {}
+  site_value = None if usgs_site is None else f'"{usgs_site}"'
+
+  for line in lines:
+    if isinstance(line, bytes): line = line.decode('utf-8')
+    # cheap substring check before parsing, confirmed against the parsed attribute below
+    if site_value is not None and site_value not in line: continue
+
+    site, type, timestamp, values = None, None, None, {}
+    for name, kind, value in ATTRIBUTE_PATTERN.findall(line):
+      if kind == 'N':
+        if name == 'timestamp': timestamp = int(float(value))
+        else: values[name] = float(value)
+      elif name == 'usgs_site': site = value
+      elif name == 'type': type = value
+
+    if site is None or type is None or timestamp is None or type in skip_types: continue
+    if usgs_site is not None and site != usgs_site: continue
+
+    buffer = partitions.get((site, type))
+    if buffer is None: buffer = partitions[(site, type)] = ColumnBuffer()
+    buffer.append(timestamp, values)
+
+  return { key: buffer.to_numpy() for key, buffer in partitions.items() }
+
+def merge_partitions(decoded: list[dict]):
+  ''' Concatenates decoded shards per partition, filling columns a shard didn't have with NaN. '''
+  chunks = {}
+  for shard in decoded:
+    for key, columns in shard.items():
+      chunks.setdefault(key, []).append(columns)
+
+  merged = {}
+  for key, parts in chunks.items():
+    names = sorted(set(name for part in parts for name in part.keys()).difference(['timestamp']))
+    merged[key] = {
+      'timestamp': np.concatenate([part['timestamp'] for part in parts]),
+      **{ name: np.concatenate([part.get(name, np.full(part['timestamp'].shape[0], np.nan)) for part in parts])
+          for name in names }
+    }
+
+  return merged
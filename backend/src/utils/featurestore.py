@@ -0,0 +1,210 @@
+import os
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+from io import BytesIO
+from botocore.exceptions import ClientError
+
+from utils import s3, db, constants
+
+log = logging.getLogger(__name__)
+
+# every column a feature model reads, in the order they are stored
+COLUMNS = sorted(set(col for cols in constants.FEATURE_COLS.values() for col in cols))
+# outside of /tmp/fc, so index.garbage_collect keeps it across warm invocations
+FEATURE_STORE_DIR = os.environ.get('FEATURE_STORE_DIR', '/tmp/fc_features')
+# updates upload only their new rows, as segments next to the store, which are compacted into it when a model is
+# trained or once there are more than this many (so a site without training rewrites its store once a week)
+MAX_SEGMENTS = int(os.environ.get('FEATURE_STORE_MAX_SEGMENTS', 24 * 7))
+
+_lock = threading.Lock()
+
+def _key(usgs_site: str):
+  return f'{usgs_site}_features.npz'
+
+def _segment_prefix(usgs_site: str):
+  return f'{usgs_site}_features/'
+
+def _segment_key(usgs_site: str, last_ts: int):
+  # named by the last observation they hold, zero padded so they list in order
+  return f'{_segment_prefix(usgs_site)}{last_ts:012d}.npz'
+
+def _segment_last_timestamp(key: str):
+  return int(key.rsplit('/', 1)[1].split('.')[0])
+
+def _local_dir(usgs_site: str, etag: str, last_ts: int):
+  return os.path.join(FEATURE_STORE_DIR, f'{usgs_site}.' + etag.strip('"') + f'.{last_ts}')
+
+def _handle(path: str, etag: str, segments: int):
+  return { 'dir': path, 'etag': etag, 'segments': segments, 'columns': COLUMNS, 'index_name': 'timestamp', 'tz': 'UTC' }
+
+def _write_local(usgs_site: str, etag: str, segments: int, timestamps: np.ndarray, values: np.ndarray):
+  ''' Lays the store out as memory mappable arrays, so it can be attached by any process. '''
+  path = _local_dir(usgs_site, etag, int(timestamps[-1]) if timestamps.shape[0] > 0 else 0)
+  if os.path.isdir(path): return _handle(path, etag, segments)
+
+  os.makedirs(FEATURE_STORE_DIR, exist_ok=True)
+  tmp_path = tempfile.mkdtemp(prefix=f'{usgs_site}.', suffix='.tmp', dir=FEATURE_STORE_DIR)
+  np.save(os.path.join(tmp_path, 'index.npy'), timestamps.astype(np.int64) * 1_000_000_000)
+  np.save(os.path.join(tmp_path, 'values.npy'), values)
+
+  with _lock:
+    # replace any stale versions of this store, frames already attached to them keep their mapping
+    for entry in os.scandir(FEATURE_STORE_DIR):
+      if entry.name.startswith(f'{usgs_site}.') and not entry.name.endswith('.tmp'): shutil.rmtree(entry.path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+  return _handle(path, etag, segments)
+
+def _local_copy(usgs_site: str, etag: str):
+  ''' Path of the local copy of the store with the given etag, with whichever segments were applied to it. '''
+  if not os.path.isdir(FEATURE_STORE_DIR): return None
+  prefix = f'{usgs_site}.' + etag.strip('"') + '.'
+  with os.scandir(FEATURE_STORE_DIR) as entries:
+    paths = [entry.path for entry in entries if entry.name.startswith(prefix) and not entry.name.endswith('.tmp')]
+  return paths[0] if len(paths) > 0 else None
+
+def _read_npz(key: str):
+  ''' Timestamps and values of a store or segment object, or None if it is missing or was built with other
+  columns. '''
+  # only a missing object is skipped, any other error is raised rather than overwriting the store with a rebuild
+  try:
+    res = s3.s3_client.get_object(Bucket=s3.MODEL_BUCKET_NAME, Key=key)
+  except ClientError as e:
+    if e.response['Error']['Code'] not in ['404', 'NoSuchKey']: raise
+    log.info(f'feature store object {key} was removed')
+    return None
+  with np.load(BytesIO(res['Body'].read())) as store:
+    if list(store['columns']) != COLUMNS:
+      log.info(f'feature store object {key} has columns {list(store["columns"])}, expected {COLUMNS}')
+      return None
+    return store['timestamp'], store['values'], res['ETag']
+
+def load(usgs_site: str):
+  ''' Handle of the site's feature store (see attach), or None if there is none or it was built with other columns.
+  The store is only fetched from s3 when the local copy is stale, then the segments after it are applied. '''
+  # only a missing store is rebuilt, any other error is raised rather than overwriting the store with a rebuild
+  try:
+    etag = s3.s3_client.head_object(Bucket=s3.MODEL_BUCKET_NAME, Key=_key(usgs_site))['ETag']
+  except ClientError as e:
+    if e.response['Error']['Code'] not in ['404', 'NoSuchKey']: raise
+    log.info(f'no feature store for site {usgs_site}')
+    return None
+  segment_keys = sorted(obj.key for obj in s3.model_bucket.objects.filter(Prefix=_segment_prefix(usgs_site)))
+
+  path = _local_copy(usgs_site, etag)
+  if path is not None:
+    handle = _handle(path, etag, len(segment_keys))
+  else:
+    store = _read_npz(_key(usgs_site))
+    if store is None: return None
+    timestamps, values, etag = store
+    handle = _write_local(usgs_site, etag, len(segment_keys), timestamps, values)
+
+  last_ts = last_timestamp(handle)
+  segments = [_read_npz(key) for key in segment_keys if last_ts is None or _segment_last_timestamp(key) > last_ts]
+  segments = [segment for segment in segments if segment is not None]
+  if len(segments) == 0: return handle
+  return _append_local(usgs_site, handle, np.concatenate([t for t, _, _ in segments]), np.concatenate([v for _, v, _ in segments]))
+
+def _append_local(usgs_site: str, handle: dict, timestamps: np.ndarray, values: np.ndarray):
+  ''' Handle of the local copy of the store with the observations after its last one appended. '''
+  # segments of concurrent updates can overlap
+  timestamps, first = np.unique(timestamps, return_index=True)
+  values = values[first]
+  last_ts = last_timestamp(handle)
+  if last_ts is not None:
+    is_new = timestamps > last_ts
+    timestamps, values = timestamps[is_new], values[is_new]
+  if timestamps.shape[0] == 0: return handle
+
+  stored = attach(handle)
+  return _write_local(usgs_site, handle['etag'], handle['segments'],
+      np.concatenate([stored.index.as_unit('s').asi8, timestamps]), np.concatenate([stored.to_numpy(), values]))
+
+def _encode(timestamps: np.ndarray, values: np.ndarray):
+  data = BytesIO()
+  np.savez(data, timestamp=timestamps, values=values, columns=np.array(COLUMNS))
+  return data.getvalue()
+
+def save(usgs_site: str, timestamps: np.ndarray, values: np.ndarray):
+  ''' Replaces the site's store, compacting the segments it covers. '''
+  res = s3.model_bucket.Object(_key(usgs_site)).put(Body=_encode(timestamps, values))
+  # segments past the store (ie. appended by an update while it was written) are kept
+  last_ts = int(timestamps[-1]) if timestamps.shape[0] > 0 else None
+  segment_keys = [obj.key for obj in s3.model_bucket.objects.filter(Prefix=_segment_prefix(usgs_site))]
+  stale = [key for key in segment_keys if last_ts is not None and _segment_last_timestamp(key) <= last_ts]
+  for key in stale:
+    s3.model_bucket.Object(key).delete()
+  return _write_local(usgs_site, res['ETag'], len(segment_keys) - len(stale), timestamps, values)
+
+def compact(usgs_site: str, handle: dict):
+  ''' Folds the segments into the store, returns its handle. '''
+  if handle['segments'] == 0: return handle
+  stored = attach(handle)
+  log.info(f'compacting {handle["segments"]} segments into feature store of site {usgs_site} ({stored.shape[0]} stored)')
+  return save(usgs_site, stored.index.as_unit('s').asi8, stored.to_numpy())
+
+def attach(handle: dict):
+  ''' Read only, memory mapped float32 frame of the store indexed by utc timestamp. '''
+  index = np.load(os.path.join(handle['dir'], 'index.npy'))
+  values = np.load(os.path.join(handle['dir'], 'values.npy'), mmap_mode='r')
+
+  timestamps = pd.to_datetime(index, unit='ns', utc=handle['tz'] is not None)
+  if handle['tz'] is not None: timestamps = timestamps.tz_convert(handle['tz'])
+
+  return pd.DataFrame(values, index=timestamps.rename(handle['index_name']), columns=handle['columns'], copy=False)
+
+def last_timestamp(handle: dict):
+  ''' Epoch seconds of the latest stored observation, or None if the store is empty. '''
+  index = np.load(os.path.join(handle['dir'], 'index.npy'), mmap_mode='r')
+  return int(index[-1]) // 1_000_000_000 if index.shape[0] > 0 else None
+
+def to_arrays(rows: pd.DataFrame):
+  ''' Epoch seconds and float32 values of hist rows (db entries or archive), sorted and deduplicated. '''
+  timestamps = pd.to_numeric(rows['timestamp']).to_numpy(dtype=np.int64)
+  values = rows.reindex(columns=COLUMNS).apply(pd.to_numeric).to_numpy(dtype=np.float32)
+  timestamps, first = np.unique(timestamps, return_index=True)
+  return timestamps, values[first]
+
+def extend(usgs_site: str, handle: dict):
+  ''' Appends hist rows stored since the latest observation in the store, uploading only them as a segment. Returns
+  the handle of the store with them. '''
+  last_ts = last_timestamp(handle)
+  start_ts = last_ts + 1 if last_ts is not None else int(time.time() - constants.MAX_HISTORY_REACHBACK_YEARS * 365 * 24 * 3600)
+  entries = db.get_hist_entries_after(usgs_site, start_ts, ['timestamp', *COLUMNS])
+  if len(entries) == 0: return handle
+
+  timestamps, values = to_arrays(pd.DataFrame(entries))
+  if last_ts is not None:
+    is_new = timestamps > last_ts
+    timestamps, values = timestamps[is_new], values[is_new]
+  if timestamps.shape[0] == 0: return handle
+
+  log.info(f'appending {timestamps.shape[0]} observations to feature store of site {usgs_site} ({handle["segments"]} segments)')
+  s3.model_bucket.Object(_segment_key(usgs_site, int(timestamps[-1]))).put(Body=_encode(timestamps, values))
+  handle = _append_local(usgs_site, { **handle, 'segments': handle['segments'] + 1 }, timestamps, values)
+
+  if handle['segments'] > MAX_SEGMENTS: return compact(usgs_site, handle)
+  return handle
+
+def build(usgs_site: str):
+  ''' Creates the site's store from the latest archive snapshot. '''
+  archive = s3.fetch_archive_data(usgs_site, 'hist', COLUMNS)
+  log.info(f'building feature store of site {usgs_site} from archive ({archive.shape[0]} obs)')
+  return save(usgs_site, *to_arrays(archive))
+
+def sync(usgs_site: str):
+  ''' Handle of the site's compacted store with every stored observation, building it first if there is none. '''
+  handle = load(usgs_site)
+  if handle is None: handle = build(usgs_site)
+  # training reads the whole store anyway, so the segments are folded into it here
+  return compact(usgs_site, extend(usgs_site, handle))
+
+def window(handle: dict, n: int):
+  ''' The latest n observations in the store, as a float32 frame indexed by utc timestamp. '''
+  return attach(handle).iloc[-n:]
@@ -1,40 +1,154 @@
+import os
+import pickle
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import pandas as pd
 
-from utils import db
+from utils import db, s3, constants
 
+FORECAST_CACHE_SIZE = int(os.environ.get('FORECAST_CACHE_SIZE', 64))
+# history windows are counted by row, the default fits 64 sites' default 10 day window a few times over
+HIST_CACHE_MAX_ROWS = int(os.environ.get('HIST_CACHE_MAX_ROWS', 64 * 24 * 30))
+# optional directory shared between processes, keep this outside of /tmp/fc which is wiped every invocation
+FORECAST_CACHE_DIR = os.environ.get('FORECAST_CACHE_DIR')
+HOUR_SECONDS = 3600
+
+class LRUCache:
+  ''' Small thread safe LRU map, kept alive across warm invocations. Least recently used entries are evicted once
+  the total weight of the entries (1 each by default) exceeds max_size, the latest entry is always kept. '''
+  def __init__(self, max_size: int, weigh=lambda value: 1):
+    self.max_size = max_size
+    self.weigh = weigh
+    self.size = 0
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    with self.lock:
+      if key not in self.entries: return None
+      self.entries.move_to_end(key)
+      return self.entries[key][0]
+
+  def put(self, key, value):
+    weight = self.weigh(value)
+    with self.lock:
+      if key in self.entries: self.size -= self.entries[key][1]
+      self.entries[key] = (value, weight)
+      self.entries.move_to_end(key)
+      self.size += weight
+      while self.size > self.max_size and len(self.entries) > 1:
+        self.size -= self.entries.popitem(last=False)[1][1]
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.size = 0
+
+fcst_cache = LRUCache(FORECAST_CACHE_SIZE)
+hist_cache = LRUCache(HIST_CACHE_MAX_ROWS, weigh=lambda cached: cached['hist'].shape[0])
+
+def _to_df(entries: list[dict]):
+  df = pd.DataFrame(entries)
+  if df.shape[0] == 0: return df
+  return df.set_index(pd.to_datetime(df['timestamp'].apply(pd.to_numeric), unit='s'))
+
+def _cache_file(usgs_site: str, origin: int):
+  return os.path.join(FORECAST_CACHE_DIR, f'{usgs_site}_{origin}_fcst.pkl')
+
+def _load_cached_fcst(usgs_site: str, origin: int):
+  fcst = fcst_cache.get((usgs_site, origin))
+  if fcst is not None or FORECAST_CACHE_DIR is None: return fcst
+
+  try:
+    with open(_cache_file(usgs_site, origin), 'rb') as file:
+      fcst = pickle.load(file)
+  except (OSError, pickle.UnpicklingError, EOFError):
+    return None
+
+  fcst_cache.put((usgs_site, origin), fcst)
+  return fcst
+
+def _save_cached_fcst(usgs_site: str, origin: int, fcst: pd.DataFrame):
+  fcst_cache.put((usgs_site, origin), fcst)
+  if FORECAST_CACHE_DIR is None: return
+
+  os.makedirs(FORECAST_CACHE_DIR, exist_ok=True)
+  # write then rename, so concurrent readers never see a partial file
+  tmp_path = f'{_cache_file(usgs_site, origin)}.{os.getpid()}.{threading.get_ident()}'
+  with open(tmp_path, 'wb') as file:
+    pickle.dump(fcst, file)
+  os.replace(tmp_path, _cache_file(usgs_site, origin))
+
+def get_current_fcst(usgs_site: str):
+  ''' Returns the latest complete forecast run, only the latest origin is looked up if it is already cached. '''
+  last_fcst_entry = db.get_latest_fcst_entry(usgs_site, attributes=['origin'])
+  origin = int(last_fcst_entry['origin'])
+
+  fcst = _load_cached_fcst(usgs_site, origin)
+  if fcst is not None: return fcst
+
+  fcst = _to_df(db.get_entire_fcst(usgs_site, origin))
+  # runs are immutable once every row is filled in, don't cache one which is still being written
+  if fcst.shape[0] > 0 and fcst['watertemp'].notnull().all():
+    _save_cached_fcst(usgs_site, origin, fcst)
+
+  return fcst
+
+def get_hist_after(usgs_site: str, start_ts: int):
+  ''' Returns historical observations after start_ts. Windows are cached from an hour aligned start, so
+  requests starting within a cached window only fetch observations newer than the last cached one. The cached
+  window is trimmed to the requested start, so it moves with the requests rather than growing. '''
+  aligned_start_ts = start_ts - start_ts % HOUR_SECONDS
+
+  cached = hist_cache.get(usgs_site)
+  if cached is None or cached['start_ts'] > aligned_start_ts:
+    hist = _to_df(db.get_hist_entries_after(usgs_site, aligned_start_ts))
+    cached = { 'start_ts': aligned_start_ts, 'hist': hist }
+  else:
+    hist = cached['hist']
+    last_ts = int(pd.to_numeric(hist['timestamp']).max()) if hist.shape[0] > 0 else aligned_start_ts - 1
+    tail = _to_df(db.get_hist_entries_after(usgs_site, last_ts + 1))
+    if tail.shape[0] > 0: hist = pd.concat([hist, tail])
+    if hist.shape[0] > 0: hist = hist[pd.to_numeric(hist['timestamp']) >= aligned_start_ts]
+    cached = { 'start_ts': aligned_start_ts, 'hist': hist }
+
+  hist_cache.put(usgs_site, cached)
+
+  hist = cached['hist']
+  if hist.shape[0] == 0: return hist
+  return hist[pd.to_numeric(hist['timestamp']) >= start_ts]
 
 def get_forecast(usgs_site: str,
-                 start_ts: str = (datetime.now() - timedelta(hours=10 * 24)).timestamp(),
+                 start_ts: str = None,
                  historical_fcst_horizon: str = '0'):
-  start_ts = int(start_ts)
+  # default is resolved per call, warm containers would otherwise keep the import-time window
+  if start_ts is None: start_ts = (datetime.now() - timedelta(hours=10 * 24)).timestamp()
+  start_ts = int(float(start_ts))
   historical_fcst_horizon = int(historical_fcst_horizon)
 
   if start_ts >= datetime.now().timestamp():
     print('start date is in the future, skipping historical query')
-    hist = pd.Dataframe([])
+    hist = pd.DataFrame([])
   else:
-    hist = db.get_hist_entries_after(usgs_site, start_ts)
-    hist = pd.DataFrame(hist)
-    hist = hist.set_index(pd.to_datetime(hist['timestamp'].apply(pd.to_numeric), unit='s'))
+    hist = get_hist_after(usgs_site, start_ts)
     print(f'retrieved {len(hist.index)} historical observations')
 
-  last_fcst_entry = db.get_latest_fcst_entry(usgs_site)
-  fcst = db.get_entire_fcst(usgs_site, last_fcst_entry['origin'])
-  fcst = pd.DataFrame(fcst)
-  fcst = fcst.set_index(pd.to_datetime(fcst['timestamp'].apply(pd.to_numeric), unit='s'))
+  fcst = get_current_fcst(usgs_site)
   print(f'retrieved {len(fcst.index)} current forecasted observations')
 
   historical_fcsts = pd.DataFrame([])
   if (historical_fcst_horizon > 0):
     print('historical forecast horizon provided, fetching historical forecasts')
-    historical_fcsts = db.get_fcsts_with_horizon_after(usgs_site, historical_fcst_horizon, start_ts)
-    historical_fcsts = pd.DataFrame(historical_fcsts)
-    if (historical_fcsts.shape[0] > 0):
-      historical_fcsts = historical_fcsts.set_index(pd.to_datetime(historical_fcsts['timestamp'].apply(pd.to_numeric), unit='s'))
+    historical_fcsts = _to_df(db.get_fcsts_with_horizon_after(usgs_site, historical_fcst_horizon, start_ts))
     print(f'retrieved {len(historical_fcsts.index)} historical forecast observations')
 
   df = pd.concat([hist, fcst, historical_fcsts]).sort_index()
   df = df[df['timestamp'] > start_ts]
 
   return df
+
+def get_skill(usgs_site: str):
+  ''' Skill reports of the site's feature models, saved at training time, by feature. Features without a report
+  (not trained yet, or trained before reports were saved) are None. '''
+  return { feature: s3.load_skill(usgs_site, feature) for feature in constants.FEATURES_TO_FORECAST }
@@ -0,0 +1,54 @@
+import os
+import sys
+import time
+import logging
+import builtins
+import threading
+
+# set FLOWCAST_IMPORT_PROFILE=1 to log what each entry point's cold start spent importing
+IMPORT_PROFILE = os.environ.get('FLOWCAST_IMPORT_PROFILE', '').lower() in ['1', 'true']
+IMPORT_PROFILE_TOP = int(os.environ.get('FLOWCAST_IMPORT_PROFILE_TOP', 25))
+
+log = logging.getLogger(__name__)
+
+# module(s) -> cumulative seconds of their first import, including everything they imported
+_timings = {}
+_lock = threading.Lock()
+_original_import = None
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+  if level > 0: return _original_import(name, globals, locals, fromlist, level)
+
+  # `from package import module` loads the submodules too, attribute the time to whichever ones are new
+  candidates = [name, *(f'{name}.{item}' for item in (fromlist or ()) if item != '*')]
+  new_modules = [module for module in candidates if module not in sys.modules]
+  if len(new_modules) == 0: return _original_import(name, globals, locals, fromlist, level)
+
+  start = time.perf_counter()
+  try:
+    return _original_import(name, globals, locals, fromlist, level)
+  finally:
+    elapsed = time.perf_counter() - start
+    loaded = ', '.join(module for module in new_modules if module in sys.modules)
+    if loaded:
+      with _lock:
+        _timings.setdefault(loaded, elapsed)
+
+def install():
+  ''' Starts timing imports, a no-op unless FLOWCAST_IMPORT_PROFILE is set. '''
+  global _original_import
+  if not IMPORT_PROFILE or _original_import is not None: return
+
+  _original_import = builtins.__import__
+  builtins.__import__ = _timed_import
+
+def report(label: str):
+  ''' Logs the most expensive imports so far, then starts a fresh report for the next entry point. '''
+  if _original_import is None: return
+
+  with _lock:
+    timings = sorted(_timings.items(), key=lambda timing: timing[1], reverse=True)
+    _timings.clear()
+
+  lines = [f'{seconds * 1000:10.1f}ms  {module}' for module, seconds in timings[:IMPORT_PROFILE_TOP]]
+  log.info(f'import profile for {label} ({len(timings)} imports, cumulative times):\n' + '\n'.join(lines))
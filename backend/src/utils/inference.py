@@ -0,0 +1,226 @@
+import json
+import logging
+import numpy as np
+import pandas as pd
+from io import BytesIO
+
+log = logging.getLogger(__name__)
+
+# bumped whenever the forward pass changes, artifacts of other versions are left to neuralprophet until retrained
+ARTIFACT_VERSION = 2
+# max latest-forecast difference to the neuralprophet path, relative to the target's normalization scale
+PARITY_TOLERANCE = 1e-3
+EPOCH = pd.Timestamp('1970-01-01')
+
+def _relu(x):
+  return np.maximum(x, 0)
+
+def _fourier_features(t_days: np.ndarray, period: float, order: int):
+  # same layout as neuralprophet's fourier_series_t, sin/cos interleaved per order
+  return np.column_stack([fun(2.0 * (i + 1) * np.pi * t_days / period) for i in range(order) for fun in (np.sin, np.cos)])
+
+def _per_quantile(features: np.ndarray, params: np.ndarray):
+  # params are (n_quantiles, n_features)
+  return features @ params.T
+
+def _days_since_epoch(ds: pd.DatetimeIndex):
+  # neuralprophet's fourier_series rounds the seconds to float32 first
+  return (ds - EPOCH).total_seconds().to_numpy().astype(np.float32) / (3600 * 24.0)
+
+def _quantiles_from_diffs(diffs: np.ndarray, quantiles: list[float]):
+  ''' Mirrors neuralprophet's quantile assembly in predict mode: the median is predicted directly, the other
+  quantiles as non-negative, non-crossing offsets from it. '''
+  if len(quantiles) == 1: return diffs
+
+  divider = next((i for i, q in enumerate(quantiles) if q > 0.5), len(quantiles))
+  out = diffs.copy()
+
+  upper = diffs[:, divider:].copy()
+  if upper.shape[1] > 0:
+    upper[:, 0] = np.maximum(upper[:, 0], 0)
+    for i in range(upper.shape[1] - 1):
+      upper[:, i + 1] = np.maximum(upper[:, i + 1], upper[:, i])
+    out[:, divider:] = diffs[:, [0]] + upper
+
+  lower = diffs[:, 1:divider].copy()
+  if lower.shape[1] > 0:
+    lower[:, -1] = np.maximum(lower[:, -1], 0)
+    for i in range(lower.shape[1] - 1, 0, -1):
+      lower[:, i - 1] = np.maximum(lower[:, i - 1], lower[:, i])
+    out[:, 1:divider] = diffs[:, [0]] - lower
+
+  return out
+
+class InferenceEngine:
+  ''' NumPy forward pass of a trained NeuralProphet model with a static trend, additive seasonalities, an AR-net
+  and additive future regressors, producing the same output as `model.get_latest_forecast`. '''
+  def __init__(self, arrays: dict, meta: dict):
+    self.arrays = arrays
+    self.meta = meta
+
+  @classmethod
+  def from_bytes(cls, data: bytes):
+    with np.load(BytesIO(data)) as artifact:
+      meta = json.loads(str(artifact['meta']))
+      arrays = { name: artifact[name] for name in artifact.files if name != 'meta' }
+    if meta['version'] != ARTIFACT_VERSION: raise ValueError(f'unsupported inference artifact version {meta["version"]}')
+    return cls(arrays, meta)
+
+  def to_bytes(self):
+    data = BytesIO()
+    np.savez(data, meta=np.array(json.dumps(self.meta)), **self.arrays)
+    return data.getvalue()
+
+  def _normalize(self, col: str, values: np.ndarray):
+    shift, scale = self.meta['normalization'][col]
+    return (values - shift) / scale
+
+  def _forward(self, lags: np.ndarray, regressors: np.ndarray, ds: pd.DatetimeIndex):
+    ''' Mirrors TimeNet.forward for one sample. ds and regressors span the lags and the forecast (n_lags + periods
+    rows), the trend, seasonality and regressor effects over the lags are subtracted from them before the AR-net. '''
+    n_lags, n_forecasts, n_quantiles = self.meta['n_lags'], self.meta['n_forecasts'], len(self.meta['quantiles'])
+
+    nonstationary = np.zeros((len(ds), n_quantiles))
+    if 'trend_bias' in self.arrays: nonstationary = nonstationary + self.arrays['trend_bias'].reshape(1, -1)
+
+    t_days = _days_since_epoch(ds)
+    for name, season in self.meta['seasonalities'].items():
+      nonstationary = nonstationary + _per_quantile(_fourier_features(t_days, season['period'], season['order']), self.arrays[f'season_{name}'])
+
+    if len(self.meta['regressors']) > 0:
+      features = np.column_stack([self._normalize(name, regressors[:, i]) for i, name in enumerate(self.meta['regressors'])])
+      nonstationary = nonstationary + _per_quantile(features, self.arrays['regressor_coefs'])
+
+    # the median quantile is stationarized against
+    x = self._normalize('y', lags) - nonstationary[:n_lags, 0]
+    for i in range(self.meta['ar_layers']):
+      if i > 0: x = _relu(x)
+      x = x @ self.arrays[f'ar_weight_{i}'].T
+      if f'ar_bias_{i}' in self.arrays: x = x + self.arrays[f'ar_bias_{i}']
+
+    return nonstationary[n_lags:] + x.reshape(n_forecasts, n_quantiles)[:len(ds) - n_lags]
+
+  def predict_latest(self, history: pd.DataFrame, regressors_df: pd.DataFrame, periods: int):
+    ''' Forecasts `periods` steps past the last row of history (ds, y and the regressors), given future regressor
+    values by ds. '''
+    n_lags = self.meta['n_lags']
+    history = history.sort_values('ds').iloc[-n_lags:]
+    lags = history['y'].to_numpy(dtype='float64')
+    if lags.shape[0] < n_lags or np.isnan(lags).any():
+      raise ValueError(f'need {n_lags} complete lags to predict, got {np.count_nonzero(~np.isnan(lags))}')
+
+    lag_ds = pd.DatetimeIndex(history['ds'])
+    ds = pd.date_range(lag_ds[-1], periods=periods + 1, freq=self.meta['freq'])[1:]
+    if not lag_ds.equals(pd.date_range(end=lag_ds[-1], periods=n_lags, freq=self.meta['freq'])):
+      raise ValueError('lags are not consecutive')
+
+    names = self.meta['regressors']
+    missing = [name for name in names if name not in history.columns]
+    if len(missing) > 0: raise ValueError(f'missing regressors {missing} in history')
+    regressors = np.concatenate([
+      history[names].to_numpy(dtype='float64'),
+      regressors_df.set_index('ds').reindex(ds)[names].to_numpy(dtype='float64')
+    ]).reshape(n_lags + periods, len(names))
+    if np.isnan(regressors).any(): raise ValueError('missing regressor values')
+
+    out = _quantiles_from_diffs(self._forward(lags, regressors, lag_ds.append(ds)), self.meta['quantiles'])
+    shift, scale = self.meta['normalization']['y']
+    out = out * scale + shift
+
+    yhat = pd.DataFrame({ 'ds': ds, 'origin-0': out[:, 0] })
+    for i, quantile in enumerate(self.meta['quantiles'][1:], start=1):
+      yhat[f'origin-0 {round(quantile * 100, 1)}%'] = out[:, i]
+
+    return yhat
+
+def _data_params(model):
+  config = model.config_normalization
+  try:
+    return config.get_data_params('__df__')
+  except Exception:
+    return config.local_data_params.get('__df__') or config.global_data_params
+
+def export_model(model):
+  ''' Extracts the weights and normalization of a fitted NeuralProphet model into an InferenceEngine. Raises
+  ValueError for components the engine doesn't implement. '''
+  if model.config_seasonality is not None and model.config_seasonality.mode != 'additive':
+    raise ValueError('only additive seasonality is supported')
+
+  params = { name: param.detach().cpu().numpy().astype('float64') for name, param in model.model.named_parameters() }
+  arrays, ar_layers = {}, {}
+  seasonalities = {}
+  regressor_names = []
+
+  for name, value in params.items():
+    parts = name.split('.')
+    # ie. the multiplicative regressor params when every regressor is additive
+    if value.size == 0: continue
+    if parts[0] == 'ar_net':
+      ar_layers.setdefault(int(parts[1]), {})[parts[2]] = value
+    elif parts[0] == 'trend' and parts[-1] == 'bias':
+      arrays['trend_bias'] = value.reshape(-1)
+    elif parts[0] == 'seasonality' and parts[1] == 'season_params':
+      season = model.config_seasonality.periods[parts[2]]
+      seasonalities[parts[2]] = { 'period': float(season.period), 'order': int(season.resolution) }
+      # (n_quantiles, 1, n_features)
+      arrays[f'season_{parts[2]}'] = value.reshape(value.shape[0], -1)
+    elif parts[0] == 'future_regressors' and parts[-1] == 'additive':
+      arrays['regressor_coefs'] = value
+    else:
+      raise ValueError(f'unsupported model parameter {name}')
+
+  # sequential containers interleave activation modules, only the linear layers hold parameters
+  for i, index in enumerate(sorted(ar_layers.keys())):
+    arrays[f'ar_weight_{i}'] = ar_layers[index]['weight']
+    if 'bias' in ar_layers[index]: arrays[f'ar_bias_{i}'] = ar_layers[index]['bias']
+
+  if 'regressor_coefs' in arrays:
+    dims = getattr(getattr(model.model, 'future_regressors', None), 'regressors_dims', None)
+    if dims is not None:
+      regressor_names = sorted(dims.keys(), key=lambda name: dims[name]['regressor_index'])
+    else:
+      regressor_names = sorted(model.config_regressors.regressors.keys())
+
+  data_params = _data_params(model)
+  meta = {
+    'version': ARTIFACT_VERSION,
+    'n_lags': int(model.n_lags),
+    'n_forecasts': int(model.n_forecasts),
+    'quantiles': [float(q) for q in model.model.quantiles],
+    'freq': 'h',
+    'ar_layers': len(ar_layers),
+    'seasonalities': seasonalities,
+    'regressors': regressor_names,
+    'normalization': { col: [float(data_params[col].shift), float(data_params[col].scale)]
+        for col in ['y', *regressor_names] }
+  }
+
+  return InferenceEngine(arrays, meta)
+
+def check_parity(model, engine: InferenceEngine, df: pd.DataFrame):
+  ''' Compares the engine's latest forecast against neuralprophet's on the last usable window of df (ds, y,
+  regressors). Returns the max absolute difference relative to the target's normalization scale. '''
+  periods = engine.meta['n_forecasts']
+  size = engine.meta['n_lags'] + periods
+  df = df.dropna()
+
+  # make_future_dataframe drops regressors that are constant over the frame it's given (ie. no precipitation) from
+  # the model, and predicts without them, so only windows where every regressor varies can be compared
+  for end in range(df.shape[0], size - 1, -1):
+    window = df.iloc[end - size:end]
+    if (window[engine.meta['regressors']].nunique() > 1).all(): break
+  else:
+    raise ValueError('no window where every regressor varies to compare against')
+
+  history = window.iloc[:-periods]
+  regressors_df = window.iloc[-periods:].drop(columns=['y'])
+
+  future = model.make_future_dataframe(df=history, regressors_df=regressors_df, periods=periods)
+  expected = model.get_latest_forecast(model.predict(df=future)).set_index('ds')
+  actual = engine.predict_latest(history, regressors_df, periods).set_index('ds')
+
+  columns = [col for col in actual.columns if col in expected.columns]
+  if len(columns) < len(actual.columns): raise ValueError(f'missing neuralprophet columns {actual.columns.difference(expected.columns)}')
+  diff = (actual[columns] - expected.loc[actual.index, columns].astype('float64')).abs().to_numpy().max()
+
+  return diff / engine.meta['normalization']['y'][1]
@@ -0,0 +1,80 @@
+import numpy as np
+from decimal import Decimal
+from itertools import groupby
+
+from utils import utils
+
+# attributes generated per row by utils.generate_fcst_rows, rebuilt from the origin/timestamp on unpack
+ROW_META = ['usgs_site', 'type', 'usgs_site#type', 'origin', 'timestamp', 'horizon', 'horizon#timestamp', 'origin#timestamp']
+PACKED_TYPE = 'fcstpack'
+
+def _to_float(value):
+  return np.nan if value is None else float(value)
+
+def _to_bytes(value):
+  # boto3 wraps binary attributes in boto3.dynamodb.types.Binary
+  return getattr(value, 'value', value)
+
+def pack_fcst_rows(rows: list[dict]):
+  ''' Packs forecast rows into one item per (site, origin), holding delta-encoded int32 timestamps
+  and a float32 column per feature. '''
+  key = lambda row: (row['usgs_site'], int(row['origin']))
+  items = []
+  for (usgs_site, origin), run in groupby(sorted(rows, key=lambda r: (*key(r), int(r['timestamp']))), key=key):
+    run = list(run)
+    timestamps = np.array([int(row['timestamp']) for row in run], dtype=np.int64)
+    columns = sorted(set(col for row in run for col in row.keys()).difference(ROW_META))
+
+    item = {
+      'usgs_site': usgs_site,
+      'type': PACKED_TYPE,
+      'usgs_site#type': f'{usgs_site}#{PACKED_TYPE}',
+      'origin': origin,
+      'origin#timestamp': f'{origin}#{origin}',
+      'columns': columns,
+      'timestamps': np.diff(timestamps, prepend=origin).astype(np.int32).tobytes()
+    }
+    for col in columns:
+      values = np.array([_to_float(row.get(col)) for row in run], dtype=np.float32)
+      # columns which were never filled in (ie. watertemp before the forecast step) are left off the item
+      if np.isnan(values).all(): continue
+      item[col] = values.tobytes()
+
+    items.append(item)
+
+  return items
+
+def unpack_fcst_item(item: dict):
+  ''' Expands a packed forecast item into the rows utils.generate_fcst_rows would have produced, with Decimal
+  numbers like the items of per row storage. '''
+  usgs_site = item['usgs_site']
+  origin = int(item['origin'])
+  timestamps = origin + np.cumsum(np.frombuffer(_to_bytes(item['timestamps']), dtype=np.int32).astype(np.int64))
+
+  columns = {}
+  for col in item['columns']:
+    if col not in item:
+      columns[col] = [None] * len(timestamps)
+      continue
+    values = np.frombuffer(_to_bytes(item[col]), dtype=np.float32).astype(np.float64)
+    # quantized like utils.convert_floats_to_decimals, which the rows were stored with
+    columns[col] = [None if is_nan else value for value, is_nan in zip(utils._quantize(values).tolist(), np.isnan(values).tolist())]
+
+  rows = []
+  for i, timestamp in enumerate(timestamps.tolist()):
+    horizon = timestamp - origin
+    rows.append({
+      'usgs_site': usgs_site,
+      'type': 'fcst',
+      'usgs_site#type': f'{usgs_site}#fcst',
+      'origin': Decimal(origin),
+      'timestamp': Decimal(timestamp),
+      'horizon': Decimal(horizon),
+      'horizon#timestamp': f'{horizon}#{timestamp}',
+      'origin#timestamp': f'{origin}#{timestamp}',
+      'watertemp': None,
+      'streamflow': None,
+      **{col: values[i] for col, values in columns.items()}
+    })
+
+  return rows
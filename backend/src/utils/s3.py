@@ -1,33 +1,119 @@
-import boto3
-from boto3.dynamodb.types import TypeDeserializer
 import logging
 import json
 import re
 import os
+import time
 import pandas as pd
+import numpy as np
 import gzip
+import shutil
+import tempfile
+import threading
 from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from botocore.exceptions import ClientError
 
-JUMPSTART_BUCKET_NAME = os.environ['JUMPSTART_BUCKET_NAME']
-ARCHIVE_BUCKET_NAME = os.environ['ARCHIVE_BUCKET_NAME']
-MODEL_BUCKET_NAME = os.environ['MODEL_BUCKET_NAME']
+from utils import storage, packed, ddbjson, inference
+from utils.constants import ATMOSPHERIC_WEATHER_FEATURES
 
-TMP_MODEL_DIR = '/tmp/fc/model'
+JUMPSTART_BUCKET_NAME = storage.env('JUMPSTART_BUCKET_NAME', 'flowcast-jumpstart')
+ARCHIVE_BUCKET_NAME = storage.env('ARCHIVE_BUCKET_NAME', 'flowcast-archive')
+MODEL_BUCKET_NAME = storage.env('MODEL_BUCKET_NAME', 'flowcast-model')
+
+# outside of /tmp/fc, so index.garbage_collect keeps it across warm invocations
+MODEL_CACHE_DIR = os.environ.get('MODEL_CACHE_DIR', '/tmp/fc_model_cache')
+MODEL_CACHE_MAX_BYTES = int(os.environ.get('MODEL_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+# per site, per type partitions of each export, written next to it in the archive bucket
+SNAPSHOT_PREFIX = 'snapshot'
+SNAPSHOT_MANIFEST = '_manifest.json'
+EXPORT_DECODE_WORKERS = int(os.environ.get('EXPORT_DECODE_WORKERS', os.cpu_count() or 1))
+
+# jumpstart files are indexed by the time range they cover, see get_jumpstart_index
+JUMPSTART_INDEX_PREFIX = '_index'
+JUMPSTART_INDEX_TTL_SECONDS = 15 * 60
+JUMPSTART_DOWNLOAD_WORKERS = 8
+JUMPSTART_HOURLY_COLUMNS = ['datetimeEpoch', *ATMOSPHERIC_WEATHER_FEATURES.keys(), 'source']
+# observed visual crossing days, see weather.fetch_days
+WEATHER_CACHE_PREFIX = '_weather'
 
 log = logging.getLogger(__name__)
 
-s3 = boto3.resource('s3')
+# created on first use
+s3 = storage.lazy_resource('s3')
+# clients are thread safe, unlike resources
+s3_client = storage.lazy_client('s3')
+
+jumpstart_bucket = storage.Lazy(lambda: s3.Bucket(JUMPSTART_BUCKET_NAME))
+archive_bucket = storage.Lazy(lambda: s3.Bucket(ARCHIVE_BUCKET_NAME))
+model_bucket = storage.Lazy(lambda: s3.Bucket(MODEL_BUCKET_NAME))
+
+# warm container caches, (site, type) -> (loaded at, index) and (key, etag) -> hourly frame
+_jumpstart_indexes = {}
+_jumpstart_hours = {}
+# model key -> (etag, deserialized model)
+_models = {}
+
+def _download_jumpstart_file(key: str):
+  res = s3_client.get_object(Bucket=JUMPSTART_BUCKET_NAME, Key=key)
+  return res['ETag'], json.loads(res['Body'].read().decode('utf-8'))
+
+def _to_hours_frame(days: list[dict]):
+  # one typed column per field instead of a frame per day
+  hours = [hour for day in days for hour in day['hours']]
+  frame = pd.DataFrame({ col: [hour.get(col) for hour in hours] for col in JUMPSTART_HOURLY_COLUMNS })
+  frame['datetimeEpoch'] = frame['datetimeEpoch'].astype('int64')
+  for col in ATMOSPHERIC_WEATHER_FEATURES.keys():
+    frame[col] = pd.to_numeric(frame[col], errors='coerce').astype('float64')
+  frame['source'] = frame['source'].astype('category')
+
+  return frame
+
+def _download_jumpstart_files(keys: list[str]):
+  ''' Downloads jumpstart files concurrently, caching their hourly data by etag. Returns { key: (etag, data) }. '''
+  if len(keys) == 0: return {}
 
-jumpstart_bucket = s3.Bucket(JUMPSTART_BUCKET_NAME)
-archive_bucket = s3.Bucket(ARCHIVE_BUCKET_NAME)
-model_bucket = s3.Bucket(MODEL_BUCKET_NAME)
+  with ThreadPoolExecutor(max_workers=min(JUMPSTART_DOWNLOAD_WORKERS, len(keys))) as executor:
+    files = dict(zip(keys, executor.map(_download_jumpstart_file, keys)))
 
-ddb_deserializer = TypeDeserializer()
+  for key, (etag, data) in files.items():
+    log.info(f'loaded jumpstart file {key}')
+    _jumpstart_hours[(key, etag)] = _to_hours_frame(data['days'])
+
+  return files
+
+def get_jumpstart_index(usgs_site: str, type: str):
+  ''' Returns [{ key, etag, start_ts, end_ts }] for a site's jumpstart files, sorted by start. The index is kept
+  in the bucket and only files missing from it (or changed since) are downloaded to rebuild it. '''
+  memo = _jumpstart_indexes.get((usgs_site, type))
+  if memo is not None and time.monotonic() - memo[0] < JUMPSTART_INDEX_TTL_SECONDS: return memo[1]
+
+  index_object = jumpstart_bucket.Object(f'{JUMPSTART_INDEX_PREFIX}/{usgs_site}_{type}.json')
+  # only a missing index is rebuilt, any other error is raised rather than overwriting the index with a rebuild
+  try:
+    entries = json.loads(index_object.get()['Body'].read())
+  except ClientError as e:
+    if e.response['Error']['Code'] not in ['404', 'NoSuchKey']: raise
+    entries = []
+
+  objects = { obj.key: obj.e_tag for obj in jumpstart_bucket.objects.filter(Prefix=f'{usgs_site}_{type}_') }
+  indexed = { entry['key']: entry for entry in entries if objects.get(entry['key']) == entry['etag'] }
+  missing = [key for key in objects.keys() if key not in indexed]
+
+  if len(missing) > 0 or len(indexed) != len(entries):
+    log.info(f'indexing {len(missing)} jumpstart files for site {usgs_site}')
+    for key, (etag, data) in _download_jumpstart_files(missing).items():
+      hours = _jumpstart_hours[(key, etag)]['datetimeEpoch']
+      indexed[key] = { 'key': key, 'etag': etag, 'start_ts': int(hours.min()), 'end_ts': int(hours.max()) }
+    entries = sorted(indexed.values(), key=lambda entry: (entry['start_ts'], entry['key']))
+    index_object.put(Body=json.dumps(entries))
+
+  _jumpstart_indexes[(usgs_site, type)] = (time.monotonic(), entries)
+  return entries
 
 def get_available_site_data(usgs_site: str, type: str, start_ts: int):
-  available_site_data = list(filter(lambda o: o.key.startswith(f'{usgs_site}_{type}'),
-      jumpstart_bucket.objects.all()))
-  return list(filter(lambda o: int(o.key.split('_')[2].split('.')[0]) <= start_ts, available_site_data))
+  # files which cover any time from start_ts onwards
+  return [entry for entry in get_jumpstart_index(usgs_site, type) if entry['end_ts'] >= start_ts]
 
 def verify_jumpstart_archive_exists(usgs_site: str, type: str, start_ts: int):
   available_site_data = get_available_site_data(usgs_site, type, start_ts)
@@ -35,45 +121,147 @@ def verify_jumpstart_archive_exists(usgs_site: str, type: str, start_ts: int):
     log.error(f'could not load jumpstart data for site {usgs_site}, maybe it doesn\'t exist?')
     raise Exception()
 
+def fetch_jumpstart_hours(usgs_site: str, type: str, start_ts: int):
+  ''' Returns the hourly jumpstart records overlapping start_ts onwards as one columnar frame. '''
+  available_site_data = get_available_site_data(usgs_site, type, start_ts)
+  if len(available_site_data) == 0: raise Exception('missing jumpstart data')
+
+  _download_jumpstart_files([entry['key'] for entry in available_site_data
+      if (entry['key'], entry['etag']) not in _jumpstart_hours])
+  hours = pd.concat([_jumpstart_hours[(entry['key'], entry['etag'])] for entry in available_site_data], ignore_index=True)
+
+  log.info(f'retrieved {hours.shape[0]} hours of jumpstart data')
+  return hours
+
 def fetch_jumpstart_data(usgs_site: str, type: str, start_ts: int):
   available_site_data = get_available_site_data(usgs_site, type, start_ts)
   if len(available_site_data) == 0: raise Exception('missing jumpstart data')
 
+  files = _download_jumpstart_files([entry['key'] for entry in available_site_data])
   data = None
-  for obj in available_site_data:
-    log.info(f'loading jumpstart file {obj.key}')
-    obj_body = obj.get()['Body'].read().decode('utf-8')
-
+  for entry in available_site_data:
     if data is None:
-      data = json.loads(obj_body)
+      data = files[entry['key']][1]
     else:
-      data['days'] += json.loads(obj_body)['days']
+      data['days'] += files[entry['key']][1]['days']
 
   log.info(f'retrieved {len(data["days"])} days of jumpstart data')
   return data
 
-def fetch_archive_data(usgs_site: str):
-  objects = archive_bucket.objects.all()
-  timestamps = list(obj.key.split('/')[0] for obj in objects)
+def load_weather_day(key: str):
+  ''' A cached visual crossing day, or None if it isn't cached. '''
+  try:
+    res = s3_client.get_object(Bucket=JUMPSTART_BUCKET_NAME, Key=f'{WEATHER_CACHE_PREFIX}/{key}')
+  except ClientError as e:
+    if e.response['Error']['Code'] == 'NoSuchKey': return None
+    raise
+  return json.loads(res['Body'].read().decode('utf-8'))
 
-  latest_timestamp = max(timestamps)
-  data_filter = re.compile(f'{latest_timestamp}/AWSDynamoDB/([^/]+)/data/(.+).json.gz')
+def save_weather_day(key: str, day: dict):
+  return s3_client.put_object(Bucket=JUMPSTART_BUCKET_NAME, Key=f'{WEATHER_CACHE_PREFIX}/{key}', Body=json.dumps(day))
+
+def get_latest_export(objects: list):
+  latest_timestamp = max(obj.key.split('/')[0] for obj in objects)
+  data_filter = re.compile(f'{re.escape(latest_timestamp)}/AWSDynamoDB/([^/]+)/data/(.+).json.gz')
   export_keys = list(obj.key for obj in objects if data_filter.match(obj.key))
 
-  data = []
-  for key in export_keys:
-    object = s3.Object(ARCHIVE_BUCKET_NAME, key)
-    with gzip.GzipFile(fileobj=object.get()['Body']) as gzipfile:
-      for line in gzipfile.readlines():
-        data.append(ddb_deserializer.deserialize({'M': json.loads(line)['Item']}))
+  return latest_timestamp, export_keys
+
+def decode_export_shard(key: str, usgs_site: str = None):
+  # streams the shard, only one decompressed line is held at a time
+  object = s3.Object(ARCHIVE_BUCKET_NAME, key)
+  with gzip.GzipFile(fileobj=object.get()['Body']) as gzipfile:
+    # packed forecast runs aren't trained on
+    return ddbjson.decode_lines(gzipfile, usgs_site, skip_types=[packed.PACKED_TYPE])
+
+def _spill_export_shard(key: str, spill_dir: str):
+  ''' Decodes a shard and writes each of its partitions to spill_dir, returning only their (site, type) keys so the
+  decoded columns never pile up in the parent process. '''
+  decoded = decode_export_shard(key)
+  shard = os.path.basename(key).split('.')[0]
+  for (usgs_site, type), columns in decoded.items():
+    partition_dir = os.path.join(spill_dir, usgs_site, type)
+    os.makedirs(partition_dir, exist_ok=True)
+    np.savez(os.path.join(partition_dir, f'{shard}.npz'), **columns)
+  return list(decoded.keys())
+
+def snapshot_key(export_timestamp: str, usgs_site: str, type: str):
+  return f'{export_timestamp}/{SNAPSHOT_PREFIX}/{usgs_site}/{type}.npz'
+
+def build_snapshot(export_timestamp: str, export_keys: list[str]):
+  ''' Splits an export into one columnar (npz) partition per site and type, so training only reads its own site.
+  Shards are decoded concurrently and spilled to /tmp by partition, then each partition is merged and written on its
+  own, so memory is bounded by a shard and a partition rather than the whole table. '''
+  log.info(f'building snapshot from export {export_timestamp} ({len(export_keys)} shards)')
+  spill_dir = tempfile.mkdtemp(prefix='fc_snapshot_')
+  try:
+    workers = min(EXPORT_DECODE_WORKERS, len(export_keys))
+    if workers <= 1:
+      spilled = [_spill_export_shard(key, spill_dir) for key in export_keys]
+    else:
+      # parsing is cpu bound, use processes rather than threads
+      with ProcessPoolExecutor(max_workers=workers) as executor:
+        spilled = list(executor.map(_spill_export_shard, export_keys, [spill_dir] * len(export_keys)))
+
+    partitions = []
+    for usgs_site, type in sorted(set(key for keys in spilled for key in keys)):
+      partition_dir = os.path.join(spill_dir, usgs_site, type)
+      chunks = []
+      for entry in sorted(os.scandir(partition_dir), key=lambda entry: entry.name):
+        with np.load(entry.path) as chunk:
+          chunks.append({ col: chunk[col] for col in chunk.files })
+      columns = ddbjson.merge_partitions([{ (usgs_site, type): chunk } for chunk in chunks])[(usgs_site, type)]
+      del chunks
+
+      order = np.argsort(columns['timestamp'], kind='stable')
+      columns = { col: values[order] for col, values in columns.items() }
+
+      partition_data = BytesIO()
+      np.savez(partition_data, **columns)
+      archive_bucket.Object(snapshot_key(export_timestamp, usgs_site, type)).put(Body=partition_data.getvalue())
+      partitions.append({
+        'usgs_site': usgs_site,
+        'type': type,
+        'rows': int(columns['timestamp'].shape[0]),
+        'columns': sorted(col for col in columns.keys() if col != 'timestamp')
+      })
+      del columns, partition_data
+      shutil.rmtree(partition_dir, ignore_errors=True)
+  finally:
+    shutil.rmtree(spill_dir, ignore_errors=True)
+
+  # written last, marks the snapshot as complete
+  archive_bucket.Object(f'{export_timestamp}/{SNAPSHOT_PREFIX}/{SNAPSHOT_MANIFEST}').put(Body=json.dumps(partitions))
+  log.info(f'wrote {len(partitions)} snapshot partitions')
+
+def load_snapshot_partition(export_timestamp: str, usgs_site: str, type: str, columns: list[str] = None):
+  object = archive_bucket.Object(snapshot_key(export_timestamp, usgs_site, type))
+  try:
+    partition_data = BytesIO(object.get()['Body'].read())
+  except Exception as e:
+    raise Exception(f'missing {type} snapshot for site {usgs_site} in export {export_timestamp}: {e}')
+
+  # npz members are only decoded when accessed, so unused columns are never read
+  with np.load(partition_data) as partition:
+    timestamps = partition['timestamp']
+    selected = [col for col in partition.files if col != 'timestamp' and (columns is None or col in columns)]
+    archive = pd.DataFrame({ col: partition[col] for col in selected })
 
-  archive = pd.DataFrame(data)
-  # select relevant usgs site, todo: optimize?
-  archive = archive[archive['usgs_site'] == usgs_site]
-  archive = archive.set_index(pd.to_datetime(archive['timestamp'].astype(int), unit='s', utc=True))
+  archive['timestamp'] = timestamps
+  archive = archive.set_index(pd.to_datetime(timestamps, unit='s', utc=True).rename('timestamp'))
 
   return archive
 
+def fetch_archive_data(usgs_site: str, type: str = 'hist', columns: list[str] = None):
+  objects = list(archive_bucket.objects.all())
+  export_timestamp, export_keys = get_latest_export(objects)
+
+  manifest_key = f'{export_timestamp}/{SNAPSHOT_PREFIX}/{SNAPSHOT_MANIFEST}'
+  if not any(obj.key == manifest_key for obj in objects):
+    build_snapshot(export_timestamp, export_keys)
+
+  return load_snapshot_partition(export_timestamp, usgs_site, type, columns)
+
 def save_model(model, usgs_site, feature):
   # this is an expensive import, we'll only do it when this method is called
   from neuralprophet import save
@@ -87,16 +275,138 @@ def save_model(model, usgs_site, feature):
   model_object = model_bucket.Object(key=f'{usgs_site}_{feature}_model.np')
   return model_object.put(Body=model_data.getvalue())
 
-def load_model(usgs_site, feature):
-  # this is an expensive import, we'll only do it when this method is called
-  from neuralprophet import load
+def save_model_meta(usgs_site, feature, meta: dict):
+  model_object = model_bucket.Object(key=f'{usgs_site}_{feature}_model.json')
+  return model_object.put(Body=json.dumps(meta))
 
-  os.makedirs(TMP_MODEL_DIR, exist_ok=True)
-  model_object = model_bucket.Object(key=f'{usgs_site}_{feature}_model.np')
+def load_model_meta(usgs_site, feature):
+  ''' Training metadata saved with a model (see handlers.train), or None if there is none. '''
   try:
-    model_data = BytesIO(model_object.get()['Body'].read())
+    res = s3_client.get_object(Bucket=MODEL_BUCKET_NAME, Key=f'{usgs_site}_{feature}_model.json')
+  except Exception as e:
+    log.warning(f'unable to load model metadata: {e}')
+    return None
+  return json.loads(res['Body'].read().decode('utf-8'))
+
+def save_skill(usgs_site, feature, skill: dict):
+  model_object = model_bucket.Object(key=f'{usgs_site}_{feature}_skill.json')
+  return model_object.put(Body=json.dumps(skill, separators=(',', ':')))
+
+def load_skill(usgs_site, feature):
+  ''' Skill report saved by the last training of a model (see utils.skill), or None if there is none. '''
+  return _load_cached_object(f'{usgs_site}_{feature}_skill.json', lambda data: json.loads(data.decode('utf-8')))
+
+# feature models are loaded from several threads, each of them maintains the cache dir
+_model_cache_lock = threading.Lock()
+
+def _model_cache_path(key: str, etag: str):
+  return os.path.join(MODEL_CACHE_DIR, f'{key}.' + etag.strip('"'))
+
+def _cached_files():
+  ''' (path, size, mtime) of the serialized models in the cache, skipping ones still being written. '''
+  files = []
+  with os.scandir(MODEL_CACHE_DIR) as entries:
+    for entry in entries:
+      if not entry.is_file() or entry.name.endswith('.tmp'): continue
+      try:
+        stat = entry.stat()
+      except FileNotFoundError:
+        continue # evicted by another process
+      files.append((entry.path, stat.st_size, stat.st_mtime))
+  return files
+
+def _unlink_cached(path: str):
+  try:
+    os.unlink(path)
+  except FileNotFoundError:
+    pass # already evicted
+
+def _evict_model_cache(keep_path: str):
+  ''' Drops the least recently used serialized models until the cache fits MODEL_CACHE_MAX_BYTES. Called with
+  _model_cache_lock held. '''
+  files = sorted(_cached_files(), key=lambda file: file[2])
+  total = sum(size for _, size, _ in files)
+  for path, size, _ in files:
+    if total <= MODEL_CACHE_MAX_BYTES: break
+    if path == keep_path: continue
+    total -= size
+    _unlink_cached(path)
+
+def _read_model_cache(cache_path: str):
+  ''' The serialized model at cache_path, or None if it isn't cached (or was just evicted). '''
+  try:
+    with open(cache_path, 'rb') as file:
+      model_data = file.read()
+    os.utime(cache_path)
+  except FileNotFoundError:
+    return None
+  log.info(f'using cached model file {cache_path}')
+  return model_data
+
+def _load_cached_object(key: str, deserialize):
+  ''' Loads a model bucket object, reusing deserialized (in memory) or serialized (/tmp) copies whose etag still
+  matches s3. '''
+  # the client rather than the bucket resource, feature models are loaded from several threads
+  try:
+    etag = s3_client.head_object(Bucket=MODEL_BUCKET_NAME, Key=key)['ETag']
   except Exception as e:
     log.warning(f'unable to load existing model: {e}')
     return None
 
-  return load(model_data)
+  cached = _models.get(key)
+  if cached is not None and cached[0] == etag:
+    log.info(f'using in-memory model {key} ({etag})')
+    return cached[1]
+
+  os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+  model_data = _read_model_cache(_model_cache_path(key, etag))
+  if model_data is None:
+    try:
+      res = s3_client.get_object(Bucket=MODEL_BUCKET_NAME, Key=key)
+      model_data = res['Body'].read()
+    except Exception as e:
+      log.warning(f'unable to load existing model: {e}')
+      return None
+    etag = res['ETag']
+    cache_path = _model_cache_path(key, etag)
+
+    # per thread, the same model can be loaded concurrently
+    tmp_path = f'{cache_path}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as file:
+      file.write(model_data)
+    with _model_cache_lock:
+      # replace any stale versions of this model
+      for path, _, _ in _cached_files():
+        if os.path.basename(path).startswith(f'{key}.'): _unlink_cached(path)
+      os.replace(tmp_path, cache_path)
+      _evict_model_cache(cache_path)
+
+  model = deserialize(model_data)
+  _models[key] = (etag, model)
+  return model
+
+def load_model(usgs_site, feature):
+  def deserialize(model_data: bytes):
+    # this is an expensive import, we'll only do it when a model needs to be deserialized
+    from neuralprophet import load
+    return load(BytesIO(model_data))
+
+  return _load_cached_object(f'{usgs_site}_{feature}_model.np', deserialize)
+
+def save_inference_engine(engine, usgs_site, feature):
+  model_object = model_bucket.Object(key=f'{usgs_site}_{feature}_model.npz')
+  return model_object.put(Body=engine.to_bytes())
+
+def delete_inference_engine(usgs_site, feature):
+  key = f'{usgs_site}_{feature}_model.npz'
+  _models.pop(key, None)
+  return model_bucket.Object(key=key).delete()
+
+def load_inference_engine(usgs_site, feature):
+  ''' Loads the torch free inference artifact exported next to a model, or None if there isn't a usable one. '''
+  try:
+    return _load_cached_object(f'{usgs_site}_{feature}_model.npz', inference.InferenceEngine.from_bytes)
+  except ValueError as e:
+    # ie. exported by an older engine, neuralprophet predicts until the model is retrained
+    log.warning(f'unable to load inference engine: {e}')
+    return None
@@ -0,0 +1,62 @@
+import os
+import time
+import logging
+import threading
+
+from utils import db, usgs
+
+log = logging.getLogger(__name__)
+
+# in process, kept across warm invocations
+SITE_INFO_CACHE_SECONDS = float(os.environ.get('SITE_INFO_CACHE_SECONDS', 60 * 60))
+# metadata saved in the site table is refreshed from nwis once it is older than this
+SITE_INFO_MAX_AGE_DAYS = float(os.environ.get('SITE_INFO_MAX_AGE_DAYS', 30))
+
+# usgs site -> (cached at, site info)
+_site_info = {}
+_lock = threading.Lock()
+
+def _from_site_item(item: dict):
+  ''' Site info in the shape usgs.get_site_info returns it, from the fields register_new_site saved. '''
+  return {
+    'sno': item['usgs_site'],
+    'sna': item['name'],
+    'cat': item['category'],
+    'lat': item['latitude'],
+    'lng': item['longitude'],
+    'agc': item['agency']
+  }
+
+def _load_site_info(usgs_site: str):
+  item = db.get_site(usgs_site)
+  if item is None:
+    log.info(f'site {usgs_site} is not registered, querying nwis')
+    return usgs.get_site_info(usgs_site)
+
+  updated_at = float(item.get('site_info_updated_at', item['registration_date']))
+  if time.time() - updated_at < SITE_INFO_MAX_AGE_DAYS * 24 * 3600:
+    return _from_site_item(item)
+
+  log.info(f'site info of {usgs_site} is over {SITE_INFO_MAX_AGE_DAYS} days old, refreshing from nwis')
+  try:
+    site_info = usgs.get_site_info(usgs_site)
+  except Exception as e:
+    log.warning(f'unable to refresh site info of {usgs_site}, using the saved info: {e}')
+    return _from_site_item(item)
+  db.update_site_info(usgs_site, site_info)
+  return site_info
+
+def get_site_info(usgs_site: str):
+  ''' NWIS site metadata, from memory, the site table or nwis, in that order. '''
+  with _lock:
+    cached = _site_info.get(usgs_site)
+  if cached is not None and time.time() - cached[0] < SITE_INFO_CACHE_SECONDS: return cached[1]
+
+  site_info = _load_site_info(usgs_site)
+  with _lock:
+    _site_info[usgs_site] = (time.time(), site_info)
+  return site_info
+
+def get_site_coords(usgs_site: str):
+  site_info = get_site_info(usgs_site)
+  return (site_info['lat'], site_info['lng'])
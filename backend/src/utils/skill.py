@@ -0,0 +1,80 @@
+import math
+import numpy as np
+import pandas as pd
+
+from utils import constants
+
+SKILL_VERSION = 1
+SKILL_METRICS = ['mae', 'rmse', 'bias', 'lower_coverage', 'upper_coverage', 'interval_coverage', 'count']
+# per horizon values are rounded in the artifact, the skill report is for display and trend checks only
+SKILL_DECIMALS = 4
+
+def quantiles():
+  ''' The lower and upper quantiles the feature models are trained with. '''
+  lower = round((1 - constants.CONFIDENCE_INTERVAL) / 2, 2)
+  return lower, round(constants.CONFIDENCE_INTERVAL + lower, 2)
+
+def _horizon_matrix(predictions: pd.DataFrame, suffix: str = ''):
+  cols = [f'yhat{i}{suffix}' for i in range(1, constants.FORECAST_HORIZON + 1)]
+  return predictions.reindex(columns=cols).to_numpy(dtype=np.float64)
+
+def horizon_metrics(predictions: pd.DataFrame):
+  ''' Error and quantile coverage of neuralprophet predictions (y, yhat1..yhatN and their quantile columns) by
+  forecast horizon, computed over the whole (rows, horizons) matrix at once. Coverage is the fraction of
+  observations at or below each band, and within both. '''
+  lower, upper = quantiles()
+  y = predictions['y'].to_numpy(dtype=np.float64)[:, np.newaxis]
+  yhat = _horizon_matrix(predictions)
+  yhat_lower = _horizon_matrix(predictions, f' {round(lower * 100, 1)}%')
+  yhat_upper = _horizon_matrix(predictions, f' {round(upper * 100, 1)}%')
+
+  err = yhat - y
+  valid = ~np.isnan(err)
+  count = valid.sum(axis=0)
+  err = np.where(valid, err, 0)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    mae = np.abs(err).sum(axis=0) / count
+    mse = np.square(err).sum(axis=0) / count
+    bias = err.sum(axis=0) / count
+
+    # nan comparisons are false, so rows without a band are excluded from both counts
+    banded = valid & ~np.isnan(yhat_lower) & ~np.isnan(yhat_upper)
+    below_lower = banded & (y <= yhat_lower)
+    below_upper = banded & (y <= yhat_upper)
+    banded_count = banded.sum(axis=0)
+    lower_coverage = below_lower.sum(axis=0) / banded_count
+    upper_coverage = below_upper.sum(axis=0) / banded_count
+    interval_coverage = (below_upper & ~below_lower).sum(axis=0) / banded_count
+
+  return pd.DataFrame({
+    'mae': mae,
+    'mse': mse,
+    'rmse': np.sqrt(mse),
+    'bias': bias,
+    'lower_coverage': lower_coverage,
+    'upper_coverage': upper_coverage,
+    'interval_coverage': interval_coverage,
+    'count': count
+  }, index=pd.RangeIndex(1, constants.FORECAST_HORIZON + 1, name='horizon'))
+
+def _compact(values):
+  return [None if math.isnan(v) else round(float(v), SKILL_DECIMALS) for v in values]
+
+def to_artifact(metrics: pd.DataFrame, source: str, evaluated_at: float, evaluated_through: int):
+  ''' JSON serializable skill report, per horizon arrays of each metric plus their mean over horizons. source is
+  what the metrics were computed on, 'test' for the held out split of a full training or 'new_observations' for the
+  observations a model had not been trained on before fine-tuning. '''
+  lower, upper = quantiles()
+  return {
+    'version': SKILL_VERSION,
+    'source': source,
+    'evaluated_at': evaluated_at,
+    'evaluated_through': evaluated_through,
+    'quantiles': [lower, upper],
+    'horizons': metrics.shape[0],
+    'summary': dict(zip(SKILL_METRICS, _compact(metrics[SKILL_METRICS].mean(skipna=True)))),
+    'by_horizon': {
+      **{ metric: _compact(metrics[metric]) for metric in SKILL_METRICS if metric != 'count' },
+      'count': [int(c) for c in metrics['count']]
+    }
+  }
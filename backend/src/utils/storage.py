@@ -0,0 +1,487 @@
+import os
+import re
+import json
+import gzip
+import uuid
+import base64
+import pickle
+import sqlite3
+import hashlib
+import logging
+import threading
+from datetime import datetime, timezone
+import boto3
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer, Binary
+from botocore.exceptions import ClientError
+
+log = logging.getLogger(__name__)
+
+# 'aws' uses DynamoDB/S3 through boto3, 'local' stands in a SQLite database and a directory per bucket
+BACKEND = os.environ.get('FLOWCAST_STORAGE_BACKEND', 'aws')
+LOCAL_ROOT = os.environ.get('FLOWCAST_LOCAL_ROOT', os.path.join(os.getcwd(), '.flowcast'))
+
+# key layouts of the tables in infra/lib/flowcast.ts
+TABLE_SCHEMAS = {
+  'flowcast-data': {
+    'pk': 'usgs_site#type',
+    'sk': 'origin#timestamp',
+    'indexes': { 'fcst_horizon_aware_index': 'horizon#timestamp' }
+  },
+  'flowcast-reports': { 'pk': 'usgs_site', 'sk': 'date', 'indexes': {} },
+  'flowcast-sites': { 'pk': 'usgs_site', 'sk': None, 'indexes': {} }
+}
+
+EXPORT_ITEMS_PER_FILE = 10000
+
+def is_local():
+  return BACKEND == 'local'
+
+def env(name: str, local_default: str):
+  ''' Reads required configuration, falling back to a default only for the local backend. '''
+  return os.environ.get(name, local_default) if is_local() else os.environ[name]
+
+def resource(service_name: str, new_session: bool = False):
+  if not is_local():
+    return (boto3.session.Session() if new_session else boto3).resource(service_name)
+
+  if service_name == 'dynamodb': return LocalDynamoDB(os.path.join(LOCAL_ROOT, 'dynamodb.sqlite3'))
+  if service_name == 's3': return LocalS3(os.path.join(LOCAL_ROOT, 's3'))
+  raise ValueError(f'no local stand-in for resource {service_name}')
+
+def client(service_name: str, **kwargs):
+  if not is_local(): return boto3.client(service_name, **kwargs)
+
+  if service_name == 'dynamodb': return LocalDynamoDBClient(LocalDynamoDB(os.path.join(LOCAL_ROOT, 'dynamodb.sqlite3')))
+  if service_name == 's3': return LocalS3Client(LocalS3(os.path.join(LOCAL_ROOT, 's3')))
+  if service_name == 'stepfunctions': return LocalStepFunctions()
+  raise ValueError(f'no local stand-in for client {service_name}')
+
+class Lazy:
+  ''' Stands in for a client/resource/table, creating it on first attribute access so importing a module doesn't
+  create clients its entry point never uses. '''
+  def __init__(self, factory):
+    self._factory = factory
+    self._target = None
+    self._lock = threading.Lock()
+
+  def get(self):
+    if self._target is None:
+      with self._lock:
+        if self._target is None: self._target = self._factory()
+    return self._target
+
+  def __getattr__(self, name: str):
+    return getattr(self.get(), name)
+
+def lazy_resource(service_name: str):
+  return Lazy(lambda: resource(service_name))
+
+def lazy_client(service_name: str, **kwargs):
+  return Lazy(lambda: client(service_name, **kwargs))
+
+def _client_error(code: str, operation: str, message: str = ''):
+  return ClientError({ 'Error': { 'Code': code, 'Message': message } }, operation)
+
+# * dynamodb
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+def _normalize(item: dict):
+  # round trip through the wire format so stored items look exactly like boto3 results (Decimals, sets, Binary)
+  return _deserializer.deserialize(_serializer.serialize(item))
+
+def _resolve(token: str, names: dict, values: dict = None):
+  if token.startswith('#'): return names[token]
+  if token.startswith(':'): return values[token]
+  return token
+
+def _evaluate(condition, item: dict):
+  ''' Evaluates a boto3.dynamodb.conditions expression against an item. '''
+  expression = condition.get_expression()
+  operator, values = expression['operator'], expression['values']
+
+  if operator == 'AND': return all(_evaluate(v, item) for v in values)
+  if operator == 'OR': return any(_evaluate(v, item) for v in values)
+  if operator == 'NOT': return not _evaluate(values[0], item)
+
+  name = values[0].name
+  if operator == 'attribute_exists': return name in item
+  if operator == 'attribute_not_exists': return name not in item
+  if name not in item: return False
+
+  value = item[name]
+  if operator == '=': return value == values[1]
+  if operator == '<>': return value != values[1]
+  if operator == '<': return value < values[1]
+  if operator == '<=': return value <= values[1]
+  if operator == '>': return value > values[1]
+  if operator == '>=': return value >= values[1]
+  if operator == 'BETWEEN': return values[1] <= value <= values[2]
+  if operator == 'begins_with': return value.startswith(values[1])
+  raise NotImplementedError(f'unsupported condition operator {operator}')
+
+def _evaluate_string(expression: str, item: dict, names: dict, values: dict):
+  ''' Evaluates the flat AND/OR condition strings used with put_item, ie. `attribute_not_exists(a) OR #b = :c`. '''
+  def term(text: str):
+    text = text.strip()
+    match = re.fullmatch(r'(attribute_exists|attribute_not_exists)\(\s*([#\w]+)\s*\)', text)
+    if match:
+      exists = _resolve(match.group(2), names) in item
+      return exists if match.group(1) == 'attribute_exists' else not exists
+
+    match = re.fullmatch(r'([#\w]+)\s*(=|<>)\s*([:#\w]+)', text)
+    if not match: raise NotImplementedError(f'unsupported condition expression {text}')
+    lhs = item.get(_resolve(match.group(1), names))
+    rhs = _resolve(match.group(3), names, values)
+    return (lhs == rhs) if match.group(2) == '=' else (lhs != rhs)
+
+  return any(all(term(t) for t in re.split(r'\s+AND\s+', clause)) for clause in re.split(r'\s+OR\s+', expression))
+
+def _project(item: dict, projection: str, names: dict):
+  if projection is None: return item
+  attributes = [_resolve(p.strip(), names or {}) for p in projection.split(',')]
+  return { attr: item[attr] for attr in attributes if attr in item }
+
+class LocalDynamoDB:
+  ''' SQLite backed stand-in for the subset of the DynamoDB resource API used by utils.db. '''
+  def __init__(self, path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    self.path = path
+    self.lock = threading.Lock()
+    self.conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+    self.conn.execute('PRAGMA journal_mode=WAL')
+    for name in TABLE_SCHEMAS.keys(): self._create(name)
+
+  def _create(self, name: str):
+    schema = TABLE_SCHEMAS[name]
+    index_cols = ''.join(f', "{index}" TEXT' for index in schema['indexes'].keys())
+    with self.lock, self.conn:
+      self.conn.execute(f'CREATE TABLE IF NOT EXISTS "{name}" (pk TEXT NOT NULL, sk TEXT NOT NULL{index_cols}, item BLOB NOT NULL, PRIMARY KEY (pk, sk))')
+      for index in schema['indexes'].keys():
+        self.conn.execute(f'CREATE INDEX IF NOT EXISTS "{name}_{index}" ON "{name}" (pk, "{index}", sk)')
+
+  def Table(self, name: str):
+    return LocalTable(self, name)
+
+  def batch_write_item(self, RequestItems: dict):
+    for table_name, requests in RequestItems.items():
+      table = self.Table(table_name)
+      rows = []
+      for request in requests:
+        if 'PutRequest' in request: rows.append(table._row(_normalize(request['PutRequest']['Item'])))
+        else: table.delete_item(Key=request['DeleteRequest']['Key'])
+      table._write(rows)
+
+    return { 'UnprocessedItems': {} }
+
+class LocalBatchWriter:
+  def __init__(self, table):
+    self.table = table
+    self.rows = []
+
+  def put_item(self, Item: dict):
+    self.rows.append(self.table._row(_normalize(Item)))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *_args):
+    self.table._write(self.rows)
+
+class LocalTable:
+  def __init__(self, db: LocalDynamoDB, name: str):
+    self.db = db
+    self.name = name
+    self.schema = TABLE_SCHEMAS[name]
+
+  def _key(self, item: dict):
+    return item[self.schema['pk']], item[self.schema['sk']] if self.schema['sk'] else ''
+
+  def _row(self, item: dict):
+    return (*self._key(item), *(item.get(attr) for attr in self.schema['indexes'].values()), pickle.dumps(item))
+
+  def _write(self, rows: list[tuple]):
+    if len(rows) == 0: return
+    placeholders = ', '.join('?' * len(rows[0]))
+    with self.db.lock, self.db.conn:
+      self.db.conn.executemany(f'INSERT OR REPLACE INTO "{self.name}" VALUES ({placeholders})', rows)
+
+  def _get(self, key: tuple):
+    with self.db.lock:
+      row = self.db.conn.execute(f'SELECT item FROM "{self.name}" WHERE pk = ? AND sk = ?', key).fetchone()
+    return None if row is None else pickle.loads(row[0])
+
+  def get_item(self, Key: dict, ProjectionExpression: str = None, ExpressionAttributeNames: dict = None):
+    item = self._get(self._key(Key))
+    return {} if item is None else { 'Item': _project(item, ProjectionExpression, ExpressionAttributeNames) }
+
+  def put_item(self, Item: dict, ConditionExpression=None, ExpressionAttributeNames: dict = None, ExpressionAttributeValues: dict = None):
+    item = _normalize(Item)
+    if ConditionExpression is not None:
+      existing = self._get(self._key(item)) or {}
+      passed = _evaluate_string(ConditionExpression, existing, ExpressionAttributeNames or {}, ExpressionAttributeValues or {}) \
+          if isinstance(ConditionExpression, str) else _evaluate(ConditionExpression, existing)
+      if not passed: raise _client_error('ConditionalCheckFailedException', 'PutItem', 'The conditional request failed')
+
+    self._write([self._row(item)])
+    return {}
+
+  def delete_item(self, Key: dict):
+    with self.db.lock, self.db.conn:
+      self.db.conn.execute(f'DELETE FROM "{self.name}" WHERE pk = ? AND sk = ?', self._key(Key))
+    return {}
+
+  def update_item(self, Key: dict, UpdateExpression: str, ExpressionAttributeNames: dict = None, ExpressionAttributeValues: dict = None):
+    ''' Supports the SET (including list_append), ADD and DELETE actions used by utils.db. '''
+    names, values = ExpressionAttributeNames or {}, ExpressionAttributeValues or {}
+    item = self._get(self._key(Key)) or dict(Key)
+
+    sections = re.split(r'\b(SET|ADD|DELETE|REMOVE)\b', UpdateExpression)
+    for action, body in zip(sections[1::2], sections[2::2]):
+      if action == 'SET':
+        for match in re.finditer(r'([#\w]+)\s*=\s*(?:list_append\(\s*([#:\w]+)\s*,\s*([#:\w]+)\s*\)|([#:\w]+))', body):
+          name = _resolve(match.group(1), names)
+          if match.group(4) is not None:
+            item[name] = _resolve(match.group(4), names, values)
+          else:
+            first, second = (_resolve(token, names, values) for token in match.group(2, 3))
+            item[name] = (item.get(first, []) if isinstance(first, str) else first) \
+                + (item.get(second, []) if isinstance(second, str) else second)
+      elif action == 'REMOVE':
+        for token in body.split(','):
+          item.pop(_resolve(token.strip(), names), None)
+      else:
+        for match in re.finditer(r'([#\w]+)\s+(:\w+)', body):
+          name, value = _resolve(match.group(1), names), values[match.group(2)]
+          if action == 'ADD' and isinstance(value, set):
+            item[name] = item.get(name, set()) | value
+          elif action == 'ADD':
+            item[name] = item.get(name, 0) + value
+          else:
+            remaining = (item.get(name) or set()) - value
+            # dynamodb does not store empty sets
+            if len(remaining) > 0: item[name] = remaining
+            else: item.pop(name, None)
+
+    self._write([self._row(_normalize(item))])
+    return {}
+
+  def batch_writer(self):
+    return LocalBatchWriter(self)
+
+  def query(self, KeyConditionExpression, FilterExpression=None, IndexName: str = None, ScanIndexForward: bool = True,
+            Limit: int = None, ExclusiveStartKey: dict = None, ProjectionExpression: str = None,
+            ExpressionAttributeNames: dict = None, **_kwargs):
+    sk_name = self.schema['indexes'][IndexName] if IndexName else self.schema['sk']
+    sk_col = f'"{IndexName}"' if IndexName else 'sk'
+
+    conditions = KeyConditionExpression.get_expression()
+    conditions = conditions['values'] if conditions['operator'] == 'AND' else [KeyConditionExpression]
+
+    where, params = [], []
+    for condition in conditions:
+      expression = condition.get_expression()
+      operator, values = expression['operator'], expression['values']
+      col = 'pk' if values[0].name == self.schema['pk'] else sk_col
+      if operator == 'BETWEEN':
+        where.append(f'{col} BETWEEN ? AND ?')
+        params += [str(values[1]), str(values[2])]
+      elif operator == 'begins_with':
+        where.append(f'{col} >= ? AND {col} < ?')
+        params += [str(values[1]), f'{values[1]}\U0010ffff']
+      elif operator in ['=', '<', '<=', '>', '>=']:
+        where.append(f'{col} {operator} ?')
+        params.append(str(values[1]))
+      else:
+        raise NotImplementedError(f'unsupported key condition operator {operator}')
+    if IndexName: where.append(f'{sk_col} IS NOT NULL') # indexes are sparse
+
+    order = 'ASC' if ScanIndexForward else 'DESC'
+    if ExclusiveStartKey is not None:
+      comparison = '>' if ScanIndexForward else '<'
+      if IndexName:
+        where.append(f'({sk_col}, sk) {comparison} (?, ?)')
+        params += [ExclusiveStartKey[sk_name], ExclusiveStartKey[self.schema['sk']]]
+      else:
+        where.append(f'sk {comparison} ?')
+        params.append(ExclusiveStartKey[sk_name])
+
+    sql = f'SELECT item FROM "{self.name}" WHERE {" AND ".join(where)} ORDER BY {sk_col} {order}'
+    if IndexName: sql += f', sk {order}'
+    if Limit is not None: sql += f' LIMIT {int(Limit) + 1}'
+
+    with self.db.lock:
+      rows = self.db.conn.execute(sql, params).fetchall()
+
+    evaluated = [pickle.loads(row[0]) for row in rows[:Limit]]
+    res = {
+      'Items': [_project(item, ProjectionExpression, ExpressionAttributeNames) for item in evaluated
+          if FilterExpression is None or _evaluate(FilterExpression, item)],
+      'ScannedCount': len(evaluated)
+    }
+    res['Count'] = len(res['Items'])
+
+    # as with dynamodb, Limit counts evaluated (pre-filter) items
+    if Limit is not None and len(rows) > Limit:
+      last = evaluated[-1]
+      key_attrs = [self.schema['pk'], self.schema['sk'], sk_name]
+      res['LastEvaluatedKey'] = { attr: last[attr] for attr in key_attrs if attr is not None }
+
+    return res
+
+def _export_default(value):
+  # dynamodb json encodes binary attributes as base64
+  if isinstance(value, Binary): return base64.b64encode(value.value).decode('ascii')
+  if isinstance(value, bytes): return base64.b64encode(value).decode('ascii')
+  raise TypeError(f'cannot export {type(value)}')
+
+class LocalDynamoDBClient:
+  ''' Stand-in for the table export calls in handlers/export.py, exports complete synchronously. '''
+  def __init__(self, db: LocalDynamoDB):
+    self.db = db
+    self.exports = {}
+
+  def export_table_to_point_in_time(self, TableArn: str, S3Bucket: str, S3Prefix: str, ExportTime: datetime = None, ExportFormat: str = 'DYNAMODB_JSON'):
+    table_name = TableArn.split('/')[-1]
+    export_id = uuid.uuid4().hex
+    data_dir = os.path.join(LOCAL_ROOT, 's3', S3Bucket, S3Prefix, 'AWSDynamoDB', export_id, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+
+    with self.db.lock:
+      rows = self.db.conn.execute(f'SELECT item FROM "{table_name}"').fetchall()
+
+    for part, start in enumerate(range(0, len(rows), EXPORT_ITEMS_PER_FILE)):
+      with gzip.open(os.path.join(data_dir, f'{part:05d}.json.gz'), 'wt') as file:
+        for row in rows[start:start + EXPORT_ITEMS_PER_FILE]:
+          item = _serializer.serialize(pickle.loads(row[0]))['M']
+          file.write(json.dumps({ 'Item': item }, default=_export_default, separators=(',', ':')) + '\n')
+
+    log.info(f'exported {len(rows)} items from {table_name} to {data_dir}')
+    description = { 'ExportArn': f'local:export/{export_id}', 'ExportStatus': 'COMPLETED', 'ItemCount': len(rows) }
+    self.exports[description['ExportArn']] = description
+    return { 'ExportDescription': description }
+
+  def describe_export(self, ExportArn: str):
+    return { 'ExportDescription': self.exports.get(ExportArn, { 'ExportArn': ExportArn, 'ExportStatus': 'COMPLETED' }) }
+
+class LocalStepFunctions:
+  def start_execution(self, stateMachineArn: str, input: str = '{}', **_kwargs):
+    log.info(f'local backend, not starting execution of {stateMachineArn} with input {input}')
+    return { 'executionArn': f'{stateMachineArn}:local-{uuid.uuid4().hex}' }
+
+# * s3
+
+def _etag(path: str):
+  md5 = hashlib.md5()
+  with open(path, 'rb') as file:
+    for chunk in iter(lambda: file.read(1 << 20), b''):
+      md5.update(chunk)
+  return f'"{md5.hexdigest()}"'
+
+class LocalS3:
+  ''' Filesystem backed stand-in for the subset of the S3 resource API used by utils.s3, one directory per bucket. '''
+  def __init__(self, root: str):
+    self.root = root
+
+  def Bucket(self, name: str):
+    return LocalBucket(self, name)
+
+  def Object(self, bucket_name: str, key: str):
+    return LocalObject(self, bucket_name, key)
+
+class LocalObjectCollection:
+  def __init__(self, bucket):
+    self.bucket = bucket
+
+  def filter(self, Prefix: str = ''):
+    bucket_dir = os.path.join(self.bucket.s3.root, self.bucket.name)
+    keys = []
+    for dirpath, _dirnames, filenames in os.walk(bucket_dir):
+      for filename in filenames:
+        key = os.path.relpath(os.path.join(dirpath, filename), bucket_dir).replace(os.sep, '/')
+        if key.startswith(Prefix): keys.append(key)
+
+    # s3 lists keys in lexicographic order
+    return [self.bucket.Object(key) for key in sorted(keys)]
+
+  def all(self):
+    return self.filter()
+
+class LocalBucket:
+  def __init__(self, s3: LocalS3, name: str):
+    self.s3 = s3
+    self.name = name
+    self.objects = LocalObjectCollection(self)
+
+  def Object(self, key: str):
+    return LocalObject(self.s3, self.name, key)
+
+class LocalObject:
+  def __init__(self, s3: LocalS3, bucket_name: str, key: str):
+    self.bucket_name = bucket_name
+    self.key = key
+    self.path = os.path.join(s3.root, bucket_name, *key.split('/'))
+
+  def _require(self, operation: str):
+    if not os.path.isfile(self.path): raise _client_error('NoSuchKey' if operation == 'GetObject' else '404', operation, self.key)
+
+  @property
+  def e_tag(self):
+    self._require('HeadObject')
+    return _etag(self.path)
+
+  @property
+  def content_length(self):
+    self._require('HeadObject')
+    return os.path.getsize(self.path)
+
+  @property
+  def size(self):
+    return self.content_length
+
+  def load(self):
+    self._require('HeadObject')
+
+  def get(self, **_kwargs):
+    self._require('GetObject')
+    return { 'Body': open(self.path, 'rb'), 'ETag': _etag(self.path), 'ContentLength': os.path.getsize(self.path) }
+
+  def put(self, Body, **_kwargs):
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    data = Body.encode('utf-8') if isinstance(Body, str) else Body if isinstance(Body, bytes) else Body.read()
+    with open(self.path, 'wb') as file:
+      file.write(data)
+    return { 'ETag': _etag(self.path) }
+
+  def delete(self):
+    if os.path.isfile(self.path): os.unlink(self.path)
+    return {}
+
+class LocalS3Client:
+  def __init__(self, s3: LocalS3):
+    self.s3 = s3
+
+  def list_objects_v2(self, Bucket: str, Prefix: str = '', **_kwargs):
+    objects = self.s3.Bucket(Bucket).objects.filter(Prefix=Prefix)
+    contents = [{
+      'Key': obj.key,
+      'Size': obj.size,
+      'LastModified': datetime.fromtimestamp(os.path.getmtime(obj.path), timezone.utc)
+    } for obj in objects]
+    res = { 'KeyCount': len(contents), 'IsTruncated': False }
+    if len(contents) > 0: res['Contents'] = contents
+    return res
+
+  def head_object(self, Bucket: str, Key: str, **_kwargs):
+    obj = self.s3.Object(Bucket, Key)
+    return { 'ETag': obj.e_tag, 'ContentLength': obj.content_length }
+
+  def get_object(self, Bucket: str, Key: str, **_kwargs):
+    return self.s3.Object(Bucket, Key).get()
+
+  def put_object(self, Bucket: str, Key: str, Body=b'', **_kwargs):
+    return self.s3.Object(Bucket, Key).put(Body=Body)
+
+  def delete_object(self, Bucket: str, Key: str, **_kwargs):
+    return self.s3.Object(Bucket, Key).delete()
@@ -0,0 +1,102 @@
+import os
+import time
+import logging
+import threading
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+log = logging.getLogger(__name__)
+
+# (connect, read) seconds, visual crossing can take a while to assemble long ranges
+CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 60))
+RETRIES = int(os.environ.get('HTTP_RETRIES', 3))
+# waits backoff * 2^(retry - 1) seconds between retries, unless the upstream sends a Retry-After
+RETRY_BACKOFF = float(os.environ.get('HTTP_RETRY_BACKOFF', 0.5))
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 16))
+
+_session = None
+_session_lock = threading.Lock()
+
+# upstream host -> counters, kept across warm invocations until reset
+_stats = {}
+_stats_lock = threading.Lock()
+
+def session():
+  ''' The shared session, its connections are kept alive between requests and invocations. '''
+  global _session
+  if _session is None:
+    with _session_lock:
+      if _session is None:
+        retry = Retry(
+          total=RETRIES,
+          backoff_factor=RETRY_BACKOFF,
+          status_forcelist=RETRY_STATUSES,
+          allowed_methods=['GET'],
+          respect_retry_after_header=True,
+          # the last response is returned, get raises for it
+          raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+        new_session = requests.Session()
+        new_session.mount('https://', adapter)
+        new_session.mount('http://', adapter)
+        _session = new_session
+  return _session
+
+class RateLimiter:
+  ''' Spaces out calls to wait so they start at most rate times per second, across threads. '''
+  def __init__(self, rate: float):
+    self.interval = 1 / rate if rate > 0 else 0
+    self.next_at = 0
+    self.lock = threading.Lock()
+
+  def wait(self):
+    with self.lock:
+      now = time.monotonic()
+      start_at = max(now, self.next_at)
+      self.next_at = start_at + self.interval
+    if start_at > now: time.sleep(start_at - now)
+
+def _record(host: str, seconds: float, size: int, failed: bool):
+  with _stats_lock:
+    stats = _stats.setdefault(host, { 'requests': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'bytes': 0 })
+    stats['requests'] += 1
+    stats['errors'] += int(failed)
+    stats['seconds'] += seconds
+    stats['max_seconds'] = max(stats['max_seconds'], seconds)
+    stats['bytes'] += size
+
+def get(url: str, **kwargs):
+  ''' GETs url through the shared session with timeouts and retries, raising for error statuses. '''
+  host = urlsplit(url).hostname
+  start = time.perf_counter()
+  try:
+    res = session().get(url, timeout=kwargs.pop('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT)), **kwargs)
+    res.raise_for_status()
+  except requests.RequestException as e:
+    response = getattr(e, 'response', None)
+    _record(host, time.perf_counter() - start, 0 if response is None else len(response.content), True)
+    raise
+
+  seconds = time.perf_counter() - start
+  _record(host, seconds, len(res.content), False)
+  log.debug(f'GET {host} {res.status_code} in {seconds * 1000:.0f}ms ({len(res.content)} bytes)')
+  return res
+
+def stats():
+  ''' Requests, errors, total and slowest latency in seconds and bytes received, per upstream host. '''
+  with _stats_lock:
+    return { host: dict(counters) for host, counters in _stats.items() }
+
+def reset_stats():
+  with _stats_lock:
+    _stats.clear()
+
+def log_stats(label: str):
+  for host, counters in stats().items():
+    log.info(f'{label} {host}: {counters["requests"]} requests ({counters["errors"]} failed), '
+        f'{counters["seconds"]:.2f}s total, {counters["max_seconds"]:.2f}s slowest, {counters["bytes"] / 1024:.0f} KiB')
@@ -1,18 +1,29 @@
+import os
+import numpy as np
 import pandas as pd
-import requests
 import math
 import logging
 from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
 import xml.etree.ElementTree as ET
 
+from utils import upstream
 from utils.constants import WATER_CONDITION_FEATURES
 
 log = logging.getLogger(__name__)
 
+# nwis iv accepts a comma separated list of sites, see fetch_observations_batch
+NWIS_SITES_PER_REQUEST = int(os.environ.get('NWIS_SITES_PER_REQUEST', 50))
+NWIS_FETCH_WORKERS = int(os.environ.get('NWIS_FETCH_WORKERS', 4))
+# longer lookbacks (ie. onboarding) are requested as is
+NWIS_MAX_ROUNDED_PERIOD_HOURS = 7 * 24
+# '2024-06-01T10:15:00.000-04:00'
+NWIS_TIMESTAMP_WIDTH = 29
+
 def get_site_info(usgs_site: str):
   url = f'https://nwis.waterservices.usgs.gov/nwis/site/?sites={usgs_site}&format=mapper'
   log.info(f'querying usgs site at {url}')
-  res = requests.get(url)
+  res = upstream.get(url)
 
   root = ET.fromstring(res.content)
   site = root.find('sites')[0]
@@ -26,38 +37,123 @@ def get_site_info(usgs_site: str):
     'agc': site.get('agc')
   }
 
-def get_site_coords(usgs_site: str):
-  site_info = get_site_info(usgs_site)
-  return (site_info['lat'], site_info['lng'])
+def _hours_since(start_dt: datetime):
+  return (int) (math.ceil((datetime.now(timezone.utc) - start_dt).total_seconds() / 3600) + 1)
 
-def fetch_observations(start_dt: datetime, usgs_site: str):
-  hours_to_retrieve = (int) (math.ceil((datetime.now(timezone.utc) - start_dt).total_seconds() / 3600) + 1)
+def _period_hours(hours: int):
+  ''' Rounds short lookbacks up to a power of two, so sites updated around the same time share a request. '''
+  if hours > NWIS_MAX_ROUNDED_PERIOD_HOURS: return hours
+  return 1 << max(0, hours - 1).bit_length()
 
-  # fetch most recent available obs from nwis
-  url = f'https://nwis.waterservices.usgs.gov/nwis/iv/?format=json&sites={usgs_site}&parameterCd={",".join(WATER_CONDITION_FEATURES.keys())}&siteStatus=all&period=PT{hours_to_retrieve}H'
-  log.info(f'querying usgs instantaneous values at {url}')
-  res = requests.get(url)
+def parse_timestamps(timestamps: list[str]):
+  ''' UTC datetime64[ns] of nwis timestamps ('2024-06-01T10:15:00.000-04:00'), parsed with array operations since
+  they are fixed width. Falls back to pandas for anything else. '''
+  try:
+    chars = np.array(timestamps, dtype=f'S{NWIS_TIMESTAMP_WIDTH}')
+  except UnicodeEncodeError:
+    chars = None
+  if chars is not None and chars.shape[0] > 0:
+    # longer timestamps are truncated and shorter ones padded, either way the offset's separators won't line up
+    codes = chars.view(np.uint8).reshape(-1, NWIS_TIMESTAMP_WIDTH)
+    signs = codes[:, 23]
+    if ((signs == ord('+')) | (signs == ord('-'))).all() and (codes[:, 26] == ord(':')).all() and (codes[:, 19] == ord('.')).all():
+      # only the offset's digits, 'hh:mm' after the sign
+      digits = codes[:, [24, 25, 27, 28]].astype(np.int64) - ord('0')
+      offset_minutes = (digits[:, 0] * 10 + digits[:, 1]) * 60 + digits[:, 2] * 10 + digits[:, 3]
+      offset_minutes = np.where(signs == ord('-'), -offset_minutes, offset_minutes).astype('timedelta64[m]')
+      local = chars.astype('S23').astype('datetime64[ms]')
+      return (local - offset_minutes).astype('datetime64[ns]')
+
+  return pd.to_datetime(timestamps, utc=True).tz_convert(None).as_unit('ns').to_numpy()
 
-  water = pd.DataFrame(columns=WATER_CONDITION_FEATURES.values())
-  data = res.json()
-  for series in data['value']['timeSeries']:
+def _align(index: np.ndarray, timestamps: np.ndarray, values: np.ndarray):
+  ''' values at each of index's timestamps (nan where there is none), by a sorted merge. '''
+  order = np.argsort(timestamps, kind='stable')
+  timestamps, values = timestamps[order], values[order]
+  positions = np.minimum(np.searchsorted(timestamps, index), timestamps.shape[0] - 1)
+  aligned = np.full(index.shape[0], np.nan)
+  matched = timestamps[positions] == index
+  aligned[matched] = values[positions[matched]]
+  return aligned
+
+def _to_frame(series_list: list[dict]):
+  ''' One column per parameter on the timestamps of the first (non-empty) series, later series only fill gaps. '''
+  index = None
+  columns = {}
+  for series in series_list:
     code = series['variable']['variableCode'][0]['value']
     values = series['values'][0]['value']
+    if len(values) == 0: continue
+
+    timestamps = parse_timestamps([value['dateTime'] for value in values])
+    observed = np.array([value['value'] for value in values], dtype=np.float64)
+    if index is None: index = timestamps
 
-    df = pd.DataFrame(values)
-    df = df.set_index(pd.to_datetime(df['dateTime'], utc=True))
-    df = df.drop(['qualifiers', 'dateTime'], axis=1)
-    df['value'] = df['value'].astype('float64')
-    df.index.name = None
+    col = WATER_CONDITION_FEATURES[code]
+    aligned = _align(index, timestamps, observed)
+    columns[col] = aligned if col not in columns else np.where(np.isnan(columns[col]), aligned, columns[col])
 
-    if water.shape[0] == 0:
-      water[WATER_CONDITION_FEATURES[code]] = df['value']
-    else:
-      water[WATER_CONDITION_FEATURES[code]] = water[WATER_CONDITION_FEATURES[code]].combine_first(df['value'])
+  if index is None: return pd.DataFrame(columns=WATER_CONDITION_FEATURES.values())
+  return pd.DataFrame(
+    { col: columns.get(col, np.full(index.shape[0], np.nan)) for col in WATER_CONDITION_FEATURES.values() },
+    index=pd.DatetimeIndex(index).tz_localize('UTC')
+  )
+
+def _fetch_series(usgs_sites: list[str], hours: int):
+  ''' Instantaneous value series of several sites in one request, by site. '''
+  url = f'https://nwis.waterservices.usgs.gov/nwis/iv/?format=json&sites={",".join(usgs_sites)}&parameterCd={",".join(WATER_CONDITION_FEATURES.keys())}&siteStatus=all&period=PT{hours}H'
+  log.info(f'querying usgs instantaneous values at {url}')
+  res = upstream.get(url)
 
-  # trim offset
-  water = water[water.index >= start_dt]
+  series_by_site = { usgs_site: [] for usgs_site in usgs_sites }
+  for series in res.json()['value']['timeSeries']:
+    usgs_site = series['sourceInfo']['siteCode'][0]['value']
+    series_by_site.setdefault(usgs_site, []).append(series)
 
-  log.info(f'retrieved {water.shape[0]} new usgs obs')
+  return series_by_site
 
-  return water
+def fetch_observations_batch(start_dts: dict[str, datetime]):
+  ''' Observations of each site after its start, { site: frame }, and the error of each site whose observations
+  couldn't be retrieved, { site: exception }. Sites needing a similar lookback are grouped into requests of up to
+  NWIS_SITES_PER_REQUEST sites, a failed request only fails its own sites. '''
+  groups = {}
+  for usgs_site, start_dt in start_dts.items():
+    groups.setdefault(_period_hours(_hours_since(start_dt)), []).append(usgs_site)
+  batches = [(usgs_sites[i:i + NWIS_SITES_PER_REQUEST], hours)
+      for hours, usgs_sites in groups.items() for i in range(0, len(usgs_sites), NWIS_SITES_PER_REQUEST)]
+  log.info(f'fetching usgs observations of {len(start_dts)} sites in {len(batches)} requests')
+
+  def fetch_batch(batch: tuple[list[str], int]):
+    try:
+      return _fetch_series(*batch), None
+    except Exception as e:
+      log.exception(f'failed to fetch usgs observations of sites {batch[0]}')
+      return None, e
+
+  with ThreadPoolExecutor(max_workers=max(1, min(NWIS_FETCH_WORKERS, len(batches)))) as executor:
+    fetched = list(executor.map(fetch_batch, batches))
+
+  observations, errors = {}, {}
+  for (usgs_sites, _), (series_by_site, error) in zip(batches, fetched):
+    if error is not None:
+      errors.update({ usgs_site: error for usgs_site in usgs_sites })
+      continue
+
+    for usgs_site, series_list in series_by_site.items():
+      if usgs_site not in start_dts: continue
+      try:
+        water = _to_frame(series_list)
+      except Exception as e:
+        log.exception(f'failed to decode usgs observations of site {usgs_site}')
+        errors[usgs_site] = e
+        continue
+      # trim offset
+      observations[usgs_site] = water[water.index >= start_dts[usgs_site]]
+      log.info(f'retrieved {observations[usgs_site].shape[0]} new usgs obs for site {usgs_site}')
+
+  return observations, errors
+
+def fetch_observations(start_dt: datetime, usgs_site: str):
+  observations, errors = fetch_observations_batch({ usgs_site: start_dt })
+  if usgs_site in errors: raise errors[usgs_site]
+  return observations[usgs_site]
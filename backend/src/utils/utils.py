@@ -1,4 +1,5 @@
 from zoneinfo import ZoneInfo
+import numpy as np
 import pandas as pd
 from decimal import Decimal
 from datetime import datetime, timezone
@@ -59,69 +60,127 @@ def resample_df(df: pd.DataFrame, freq: str):
 
   return df
 
+def _as_utc(ts: int, tz):
+  dt = pd.Timestamp(int(ts), unit='s', tz='UTC')
+  return dt.tz_convert(tz) if tz is not None else dt.tz_localize(None)
+
+def align_hourly(frames: list[pd.DataFrame], freq: str, carry: dict = None):
+  ''' Equivalent to resample_df(merge_dfs(frames), freq), but when given the last stored row as carry
+  ({ 'timestamp': epoch seconds, col: value }) only rows after it are produced, and interpolation towards the new
+  samples starts from it instead of clamping to the first new sample. Rows past a column's last new sample are left
+  for a later update rather than extrapolated, since the carry moves past every row returned. '''
+  columns = [col for frame in frames for col in frame.columns]
+  indexes = [frame.index for frame in frames if frame.shape[0] > 0]
+  tz = indexes[0].tz if len(indexes) > 0 else 'UTC'
+  empty = pd.DataFrame(columns=columns, index=pd.DatetimeIndex([], tz=tz), dtype='float64')
+  if len(indexes) == 0: return empty
+
+  start = min(index.min() for index in indexes).round(freq)
+  end = max(index.max() for index in indexes).round(freq)
+  carry_ns = None
+  if carry is not None:
+    carry_ts = _as_utc(carry['timestamp'], tz)
+    carry_ns = carry_ts.as_unit('ns').value
+    start = carry_ts + pd.Timedelta(freq)
+
+  samples = {}
+  for frame in frames:
+    for col in frame.columns:
+      values = pd.to_numeric(frame[col]).astype('float64').dropna()
+      x, y = values.index.as_unit('ns').asi8, values.to_numpy()
+      if carry_ns is not None:
+        after = x > carry_ns
+        x, y = x[after], y[after]
+        # nothing new to interpolate towards, every row would hold the carried value
+        if x.shape[0] == 0: return empty
+        end = min(end, pd.Timestamp(x.max(), tz='UTC').tz_convert(tz).floor(freq))
+        if carry.get(col) is not None: x, y = np.concatenate([[carry_ns], x]), np.concatenate([[float(carry[col])], y])
+      # a column without any samples would leave every row incomplete
+      if x.shape[0] == 0: return empty
+      samples[col] = (x, y)
+
+  grid = pd.date_range(start, end, freq=freq)
+  if len(grid) == 0: return empty
+  # interpolate on int64 nanoseconds like pandas' 'time' method, np.interp holds the end values like limit_direction='both'
+  grid_ns = grid.as_unit('ns').asi8
+
+  aligned = { col: np.interp(grid_ns, x, y) for col, (x, y) in samples.items() }
+  return pd.DataFrame(aligned, index=grid, columns=columns)
+
+def _epoch_seconds(index: pd.DatetimeIndex):
+  # int(ts.timestamp()) for a whole index, naive timestamps are treated as utc
+  ns = index.as_unit('ns').asi8
+  return np.where(ns < 0, -(-ns // 10**9), ns // 10**9).tolist()
+
+def _records(df: pd.DataFrame):
+  # same values as iterating iterrows(), built column by column
+  if len(df.columns) == 0: return [{} for _ in range(df.shape[0])]
+  columns = list(df.columns)
+  return [dict(zip(columns, values)) for values in zip(*(df[col].tolist() for col in columns))]
+
 def generate_hist_rows(hist_df: pd.DataFrame, usgs_site: str):
-  new_hist = []
-  for ts, row in hist_df.iterrows():
-    new_hist.append({
-        'usgs_site': usgs_site,
-        'type': 'hist',
-        'usgs_site#type': f'{usgs_site}#hist',
-        'timestamp': int(ts.timestamp()),
-        'origin#timestamp': f'{int(ts.timestamp())}#{int(ts.timestamp())}',
-        **row
-    })
-
-  return new_hist
+  timestamps = _epoch_seconds(hist_df.index)
+
+  return [{
+      'usgs_site': usgs_site,
+      'type': 'hist',
+      'usgs_site#type': f'{usgs_site}#hist',
+      'timestamp': timestamp,
+      'origin#timestamp': f'{timestamp}#{timestamp}',
+      **row
+    } for timestamp, row in zip(timestamps, _records(hist_df))]
 
 def generate_fcst_rows(fcst_df: pd.DataFrame, origin_ts: pd.Timestamp, usgs_site: str, skip_meta: bool = False):
-  new_fcst = []
-  for ts, row in fcst_df.iterrows():
-      origin = int(origin_ts.timestamp())
-      timestamp = int(ts.timestamp())
-      horizon = timestamp - origin
-
-      item = {}
-      if not skip_meta:
-        item = {
-          'usgs_site': usgs_site,
-          'type': 'fcst',
-          'usgs_site#type': f'{usgs_site}#fcst',
-          'origin': origin,
-          'timestamp': timestamp,
-          'horizon': horizon,
-          'horizon#timestamp': f'{horizon}#{timestamp}',
-          'origin#timestamp': f'{origin}#{timestamp}',
-          'watertemp': None,
-          'streamflow': None
-        }
-
-      new_fcst.append({
-          **item,
-          **row
-      })
-
-  return new_fcst
+  rows = _records(fcst_df)
+  if skip_meta: return rows
+
+  origin = int(origin_ts.timestamp())
+  timestamps = _epoch_seconds(fcst_df.index)
+
+  return [{
+      'usgs_site': usgs_site,
+      'type': 'fcst',
+      'usgs_site#type': f'{usgs_site}#fcst',
+      'origin': origin,
+      'timestamp': timestamp,
+      'horizon': timestamp - origin,
+      'horizon#timestamp': f'{timestamp - origin}#{timestamp}',
+      'origin#timestamp': f'{origin}#{timestamp}',
+      'watertemp': None,
+      'streamflow': None,
+      **row
+    } for timestamp, row in zip(timestamps, rows)]
+
+def _quantize(values: np.ndarray):
+  ''' Decimal(x).quantize(Decimal('1.0000')) for each value, converting each distinct value once. '''
+  # unique by bit pattern, so -0.0 keeps its sign like it does in Decimal
+  bits, inverse = np.unique(values.astype(np.float64).view(np.int64), return_inverse=True)
+  # '%.4f' rounds the exact binary value half to even, the same as quantize
+  decimals = np.array([Decimal(f'{value:.4f}') for value in bits.view(np.float64).tolist()], dtype=object)
+  return decimals[inverse.reshape(-1)]
 
 def convert_floats_to_decimals(df: pd.DataFrame):
   for col in df.columns:
-    if pd.api.types.is_float_dtype(df[col]) or (df[col].shape[0] > 0 and isinstance(df[col][0], float)):
+    if pd.api.types.is_float_dtype(df[col]):
+      df[col] = pd.Series(_quantize(df[col].to_numpy()), index=df.index, dtype=object)
+    elif df[col].shape[0] > 0 and isinstance(df[col].iloc[0], float):
       df[col] = df[col].apply(lambda x: Decimal(x).quantize(Decimal('1.0000')))
 
-def prep_archive_for_training(archive: pd.DataFrame, feature: str) -> pd.DataFrame:
-  # ! temporarily drop streamflow to simplify (eventually will need two models,
-  # one targeting streamflow, one targeting watertemp, then will need a two part forecast step)
-  log.info('dropping non-feature columns, reindexing, renaming ds col')
-  training = archive.drop(columns=archive.columns.difference(constants.FEATURE_COLS[feature]))
-  training = training.reset_index()
-  training = training.rename(columns={'timestamp': 'ds'})
-  training['ds'] = pd.to_datetime(training['ds']).dt.tz_convert(None)
-
-  # convert decimals to floats
-  training[constants.FEATURE_COLS[feature]] = training[constants.FEATURE_COLS[feature]].apply(pd.to_numeric, downcast='float')
-
-  training = training.rename(columns={feature: 'y'})
-
-  return training
+def prep_features(features: pd.DataFrame, feature: str) -> pd.DataFrame:
+  ''' Model input frame for feature (ds, y and its regressors) from a float feature matrix indexed by timestamp, ie.
+  the feature store. '''
+  cols = constants.FEATURE_COLS[feature]
+  ds = features.index if features.index.tz is None else features.index.tz_convert(None)
+  df = pd.DataFrame(features[cols].to_numpy(), columns=cols)
+  df.insert(0, 'ds', ds)
+
+  # todo remove when neuralprophet fixes empty regressor bug, regressors which don't vary (ie. snow all summer) fail.
+  # it checks the observed rows, so a regressor varying only in the forecast rows still fails
+  observed = df[df[feature].notnull()]
+  for col in cols:
+    if col != feature and observed.shape[0] > 0 and observed[col].nunique() <= 1: df.loc[observed.index[0], col] = 0.01
+
+  return df.rename(columns={feature: 'y'})
 
 def timestamp_exists_in_timezone(posix_timestamp, tz_name):
   try:
@@ -1,42 +1,162 @@
-# import json
 import os
+import json
+import hashlib
 import logging
+import numpy as np
 import pandas as pd
 from datetime import datetime, timezone, timedelta
-import requests
+from concurrent.futures import ThreadPoolExecutor
 
-import utils.utils as utils
 import utils.s3 as s3
+import utils.upstream as upstream
 from utils.constants import ATMOSPHERIC_WEATHER_FEATURES, FORECAST_HORIZON
 
 log = logging.getLogger(__name__)
 
 VISUAL_CROSSING_API_KEY = os.environ['VISUAL_CROSSING_API_KEY']
+TIMELINE_PARAMS = 'unitGroup=us&include=hours'
+HOURLY_COLUMNS = ['datetimeEpoch', *ATMOSPHERIC_WEATHER_FEATURES.keys(), 'source']
+
+# long ranges are requested as day aligned chunks, side by side but at most WEATHER_REQUESTS_PER_SECOND
+WEATHER_CHUNK_DAYS = int(os.environ.get('WEATHER_CHUNK_DAYS', 30))
+WEATHER_FETCH_WORKERS = int(os.environ.get('WEATHER_FETCH_WORKERS', 4))
+WEATHER_REQUESTS_PER_SECOND = float(os.environ.get('WEATHER_REQUESTS_PER_SECOND', 2))
+# observed days are cached once visual crossing is unlikely to revise them, locally and in the jumpstart bucket
+WEATHER_CACHE_DIR = os.environ.get('WEATHER_CACHE_DIR', '/tmp/fc_weather_cache')
+WEATHER_CACHE_SETTLE_HOURS = float(os.environ.get('WEATHER_CACHE_SETTLE_HOURS', 48))
+WEATHER_CACHE_WORKERS = 16
+# a location's utc offset is within this of its solar time (longitude / 15), covering dst and how far time zones stray
+WEATHER_TZ_MARGIN_HOURS = 4
+
+_rate_limiter = upstream.RateLimiter(WEATHER_REQUESTS_PER_SECOND)
+
+def _day_key(location: tuple[float, float], date: str):
+  ''' Content address of a day's hours at a location, anything which changes the response is part of it. '''
+  identity = f'{float(location[0]):.4f},{float(location[1]):.4f}/{date}?{TIMELINE_PARAMS}'
+  return hashlib.sha256(identity.encode('utf-8')).hexdigest() + '.json'
+
+def decode_days(days: list[dict]):
+  ''' Visual crossing days as { date: { column: values } }, one array per hourly field rather than a frame per day. '''
+  decoded = {}
+  for day in days:
+    hours = day.get('hours') or []
+    columns = { col: np.array([hour.get(col) for hour in hours], dtype=np.float64) for col in ATMOSPHERIC_WEATHER_FEATURES.keys() }
+    columns['datetimeEpoch'] = np.array([hour['datetimeEpoch'] for hour in hours], dtype=np.int64)
+    columns['source'] = np.array([hour.get('source') for hour in hours], dtype=object)
+    decoded[day['datetime']] = columns
+  return decoded
+
+def _is_settled(columns: dict):
+  if columns['datetimeEpoch'].shape[0] == 0 or not (columns['source'] == 'obs').all(): return False
+  return columns['datetimeEpoch'].max() + 3600 <= datetime.now(timezone.utc).timestamp() - WEATHER_CACHE_SETTLE_HOURS * 3600
+
+def _load_cached_day(location: tuple[float, float], date: str):
+  key = _day_key(location, date)
+  path = os.path.join(WEATHER_CACHE_DIR, key)
+  try:
+    with open(path) as file:
+      day = json.load(file)
+  except (OSError, ValueError):
+    day = s3.load_weather_day(key)
+    if day is None: return None
+    _save_local_day(key, day)
+
+  columns = { col: np.array(day[col], dtype=np.float64) for col in ATMOSPHERIC_WEATHER_FEATURES.keys() }
+  columns['datetimeEpoch'] = np.array(day['datetimeEpoch'], dtype=np.int64)
+  columns['source'] = np.array(day['source'], dtype=object)
+  return columns
+
+def _save_local_day(key: str, day: dict):
+  os.makedirs(WEATHER_CACHE_DIR, exist_ok=True)
+  path = os.path.join(WEATHER_CACHE_DIR, key)
+  with open(f'{path}.{os.getpid()}.tmp', 'w') as file:
+    json.dump(day, file)
+  os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+def _save_cached_day(location: tuple[float, float], date: str, columns: dict):
+  key = _day_key(location, date)
+  day = { col: values.tolist() for col, values in columns.items() }
+  _save_local_day(key, day)
+  s3.save_weather_day(key, day)
+
+def _fetch_chunk(location: tuple[float, float], first_date: str, last_date: str):
+  _rate_limiter.wait()
+  url = f'https://weather.visualcrossing.com/VisualCrossingWebServices/rest/services/timeline/{location[0]}%2C{location[1]}/{first_date}/{last_date}?{TIMELINE_PARAMS}&key={VISUAL_CROSSING_API_KEY}&contentType=json'
+  log.info(f'querying visual crossing for {first_date} to {last_date}')
+  return decode_days(upstream.get(url).json()['days'])
+
+def _chunks(dates: list[str]):
+  ''' Splits sorted dates into runs of consecutive days, at most WEATHER_CHUNK_DAYS long. '''
+  chunks = []
+  for date in dates:
+    is_next_day = len(chunks) > 0 and pd.Timestamp(date) - pd.Timestamp(chunks[-1][-1]) == pd.Timedelta(days=1)
+    if is_next_day and len(chunks[-1]) < WEATHER_CHUNK_DAYS: chunks[-1].append(date)
+    else: chunks.append([date])
+  return chunks
+
+def _utc_offset_bounds(location: tuple[float, float]):
+  ''' Earliest and latest utc offset the location could be on, from its longitude. '''
+  solar_hours = float(location[1]) / 15
+  return (timedelta(hours=max(-12, solar_hours - WEATHER_TZ_MARGIN_HOURS)),
+      timedelta(hours=min(14, solar_hours + WEATHER_TZ_MARGIN_HOURS)))
+
+def fetch_days(location: tuple[float, float], start_dt: datetime, end_dt: datetime):
+  ''' The days covering start_dt to end_dt at a location in its local time, { date: { column: values } }. Settled
+  observed days come from the cache, the rest is requested in concurrent chunks. '''
+  # days are local to the location, only the local dates the range could fall on are requested
+  earliest_offset, latest_offset = _utc_offset_bounds(location)
+  first_date, last_date = (start_dt + earliest_offset).date(), (end_dt + latest_offset).date()
+  dates = [date.date().isoformat() for date in pd.date_range(first_date, last_date, freq='D')]
+
+  # only days which ended long enough ago can be cached, the local day ends at most 14h after the utc one
+  settled_before = datetime.now(timezone.utc) - timedelta(hours=WEATHER_CACHE_SETTLE_HOURS + 14 + 24)
+  cacheable = [date for date in dates if pd.Timestamp(date, tz='UTC') <= settled_before]
+  days = {}
+  if len(cacheable) > 0:
+    with ThreadPoolExecutor(max_workers=min(WEATHER_CACHE_WORKERS, len(cacheable))) as executor:
+      cached = executor.map(lambda date: _load_cached_day(location, date), cacheable)
+      days = { date: columns for date, columns in zip(cacheable, cached) if columns is not None }
+
+  chunks = _chunks([date for date in dates if date not in days])
+  log.info(f'{len(days)}/{len(dates)} days of weather cached, fetching the rest in {len(chunks)} requests')
+  if len(chunks) > 0:
+    with ThreadPoolExecutor(max_workers=min(WEATHER_FETCH_WORKERS, len(chunks))) as executor:
+      fetched = list(executor.map(lambda chunk: _fetch_chunk(location, chunk[0], chunk[-1]), chunks))
+
+    for chunk in fetched: days.update(chunk)
+    settled = [date for chunk in fetched for date, columns in chunk.items() if _is_settled(columns)]
+    if len(settled) > 0:
+      with ThreadPoolExecutor(max_workers=min(WEATHER_CACHE_WORKERS, len(settled))) as executor:
+        list(executor.map(lambda date: _save_cached_day(location, date, days[date]), settled))
+
+  return { date: days[date] for date in sorted(days.keys()) }
+
+def _to_hours_frame(days: dict):
+  if len(days) == 0: return pd.DataFrame({ col: [] for col in HOURLY_COLUMNS })
+  return pd.DataFrame({ col: np.concatenate([columns[col] for columns in days.values()]) for col in HOURLY_COLUMNS })
 
 def fetch_observations(start_dt: datetime, location: tuple[float, float], usgs_site: str):
   end_dt = datetime.now(timezone.utc) + timedelta(hours=FORECAST_HORIZON)
 
-  data = []
+  hours = []
   query_start_dt = start_dt
   if (end_dt - start_dt).days * 24 > 25000:
     log.info(f'retrieving jumpstart data')
-    data = s3.fetch_jumpstart_data(usgs_site, 'hist', int(start_dt.timestamp()))['days']
-    query_start_dt = datetime.fromtimestamp(data[-1]['datetimeEpoch'], timezone.utc)
+    jumpstart = s3.fetch_jumpstart_hours(usgs_site, 'hist', int(start_dt.timestamp()))
+    hours.append(jumpstart)
+    query_start_dt = datetime.fromtimestamp(int(jumpstart['datetimeEpoch'].max()), timezone.utc)
 
-  url = f'https://weather.visualcrossing.com/VisualCrossingWebServices/rest/services/timeline/{location[0]}%2C{location[1]}/{utils.to_iso(query_start_dt)}/{utils.to_iso(end_dt)}?unitGroup=us&include=hours&key={VISUAL_CROSSING_API_KEY}&contentType=json'
-  log.info(f'querying visual crossing at {url}')
-  res = requests.get(url)
-  data += res.json()['days']
+  hours.append(_to_hours_frame(fetch_days(location, query_start_dt, end_dt)))
 
-  atmos = pd.concat(pd.DataFrame(day['hours']) for day in data)
-  atmos = atmos[~atmos['datetimeEpoch'].duplicated(keep='first')] # above op may duplicate entries, drop
+  atmos = pd.concat(hours, ignore_index=True)
+  atmos = atmos[~atmos['datetimeEpoch'].duplicated(keep='first')] # jumpstart and requested days overlap, drop
 
-  atmos = atmos.set_index(pd.to_datetime(atmos['datetimeEpoch'], unit='s', utc=True))
+  atmos = atmos.set_index(pd.to_datetime(atmos['datetimeEpoch'].astype('int64'), unit='s', utc=True))
   atmos = atmos.drop(columns=atmos.columns.difference(list(ATMOSPHERIC_WEATHER_FEATURES.keys()) + ['source']))
   atmos = atmos.rename(columns=ATMOSPHERIC_WEATHER_FEATURES)
   atmos.index.name = None
 
-  # visual crossing always returns starting at the beginning of the day, trim to target range
+  # days are requested whole, trim to target range
   atmos = atmos[atmos.index >= start_dt]
 
   atmos_hist = atmos[atmos['source'] == 'obs'].drop(columns=['source'])
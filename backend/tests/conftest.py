@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# the handlers import from src as the lambda runtime does, and never touch the deployed tables and buckets
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+os.environ['FLOWCAST_STORAGE_BACKEND'] = 'local'
+os.environ.setdefault('FLOWCAST_LOCAL_ROOT', tempfile.mkdtemp(prefix='fc_test_'))
+os.environ.setdefault('FEATURE_STORE_DIR', os.path.join(os.environ['FLOWCAST_LOCAL_ROOT'], 'features'))
+os.environ.setdefault('MODEL_CACHE_DIR', os.path.join(os.environ['FLOWCAST_LOCAL_ROOT'], 'model_cache'))
+os.environ.setdefault('VISUAL_CROSSING_API_KEY', 'test')
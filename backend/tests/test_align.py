@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+
+from utils import utils, constants
+
+FREQ = constants.TIMESERIES_FREQUENCY
+LAST = pd.Timestamp('2024-06-01 00:00', tz='UTC')
+CARRY = { 'timestamp': int(LAST.timestamp()), 'watertemp': 50.0, 'airtemp': 60.0 }
+
+def water(start: str, end: str, value: float = 52.0):
+  index = pd.date_range(start, end, freq='15min', tz='UTC')
+  return pd.DataFrame({ 'watertemp': np.full(index.shape[0], value) }, index=index)
+
+def weather(start: str, end: str, value: float = 62.0):
+  index = pd.date_range(start, end, freq='1h', tz='UTC')
+  return pd.DataFrame({ 'airtemp': np.full(index.shape[0], value) }, index=index)
+
+def test_column_without_new_samples_is_not_flat_filled():
+  # usgs hasn't reported since the last stored row, the weather has
+  aligned = utils.align_hourly([water('2024-05-31 20:00', '2024-06-01 00:00'), weather('2024-06-01 01:00', '2024-06-01 05:00')],
+      FREQ, carry=CARRY)
+  assert aligned.shape[0] == 0
+
+def test_rows_stop_at_a_columns_last_sample():
+  aligned = utils.align_hourly([water('2024-06-01 00:15', '2024-06-01 02:30'), weather('2024-06-01 01:00', '2024-06-01 05:00')],
+      FREQ, carry=CARRY)
+  assert list(aligned.index) == list(pd.date_range('2024-06-01 01:00', '2024-06-01 02:00', freq=FREQ, tz='UTC'))
+  assert (aligned['watertemp'] == 52.0).all()
+  # interpolated from the carried value towards the first new sample
+  assert aligned['airtemp'].iloc[0] == 62.0
+
+def test_carry_interpolates_towards_new_samples():
+  aligned = utils.align_hourly([water('2024-06-01 02:00', '2024-06-01 02:00', 54.0), weather('2024-06-01 02:00', '2024-06-01 02:00', 64.0)],
+      FREQ, carry=CARRY)
+  assert aligned['watertemp'].tolist() == [52.0, 54.0]
+  assert aligned['airtemp'].tolist() == [62.0, 64.0]
+
+def test_without_carry_matches_resample():
+  frames = [water('2024-06-01 00:15', '2024-06-01 02:30'), weather('2024-06-01 00:00', '2024-06-01 05:00')]
+  expected = utils.resample_df(utils.merge_dfs(frames), FREQ)
+  aligned = utils.align_hourly(frames, FREQ)
+  pd.testing.assert_frame_equal(aligned, expected, check_freq=False, check_index_type=False)
@@ -0,0 +1,62 @@
+import shutil
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import featurestore, s3, db
+
+SITE = 'T0000002'
+
+def rows(start_ts: int, hours: int):
+  timestamps = start_ts + 3600 * np.arange(hours)
+  return pd.DataFrame({ 'timestamp': timestamps, **{ col: timestamps / 3600.0 + i for i, col in enumerate(featurestore.COLUMNS) } })
+
+def segment_keys():
+  return [obj.key for obj in s3.model_bucket.objects.filter(Prefix=f'{SITE}_features/')]
+
+@pytest.fixture
+def hist(monkeypatch):
+  ''' hist rows in the db, only the ones after start_ts are returned like the query. '''
+  stored = []
+  def get_hist_entries_after(usgs_site, start_ts, attributes=None):
+    df = pd.concat(stored) if len(stored) > 0 else pd.DataFrame(columns=['timestamp'])
+    return df[df['timestamp'] >= int(start_ts)].to_dict('records')
+  monkeypatch.setattr(db, 'get_hist_entries_after', get_hist_entries_after)
+  yield stored
+  for key in segment_keys(): s3.model_bucket.Object(key).delete()
+
+def test_updates_append_segments_which_training_compacts(hist):
+  base = rows(1_700_000_000, 48)
+  handle = featurestore.save(SITE, *featurestore.to_arrays(base))
+  stored_object = s3.s3_client.head_object(Bucket=s3.MODEL_BUCKET_NAME, Key=f'{SITE}_features.npz')['ETag']
+
+  # two hourly updates, each uploading only its new rows
+  for i in range(2):
+    hist.append(rows(1_700_000_000 + 3600 * (48 + i), 1))
+    handle = featurestore.extend(SITE, handle)
+  assert len(segment_keys()) == 2
+  assert s3.s3_client.head_object(Bucket=s3.MODEL_BUCKET_NAME, Key=f'{SITE}_features.npz')['ETag'] == stored_object
+
+  expected = pd.concat([base, *hist])
+  assert featurestore.attach(handle).shape[0] == 50
+
+  # a cold container rebuilds the store from the object and its segments
+  shutil.rmtree(featurestore.FEATURE_STORE_DIR)
+  loaded = featurestore.load(SITE)
+  assert loaded['segments'] == 2
+  values = featurestore.attach(loaded).to_numpy()
+  np.testing.assert_array_equal(values, expected[featurestore.COLUMNS].to_numpy(dtype=np.float32))
+
+  compacted = featurestore.sync(SITE)
+  assert compacted['segments'] == 0 and segment_keys() == []
+  shutil.rmtree(featurestore.FEATURE_STORE_DIR)
+  np.testing.assert_array_equal(featurestore.attach(featurestore.load(SITE)).to_numpy(), values)
+
+def test_segments_are_compacted_past_the_bound(hist, monkeypatch):
+  monkeypatch.setattr(featurestore, 'MAX_SEGMENTS', 2)
+  handle = featurestore.save(SITE, *featurestore.to_arrays(rows(1_700_000_000, 24)))
+  for i in range(3):
+    hist.append(rows(1_700_000_000 + 3600 * (24 + i), 1))
+    handle = featurestore.extend(SITE, handle)
+    assert len(segment_keys()) == [1, 2, 0][i]
+  assert featurestore.last_timestamp(handle) == 1_700_000_000 + 3600 * 26
@@ -0,0 +1,42 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import inference
+
+def fit_small_model():
+  ''' A small model with every component the engine implements, fitted on a synthetic site. '''
+  neuralprophet = pytest.importorskip('neuralprophet')
+  from neuralprophet.logger import MetricsLogger
+  neuralprophet.set_random_seed(0)
+
+  n = 24 * 60
+  rng = np.random.default_rng(0)
+  ds = pd.date_range('2023-01-01', periods=n, freq='h')
+  airtemp = 50 - 20 * np.cos(ds.dayofyear.to_numpy() / 365.25 * 2 * np.pi) + rng.normal(0, 3, n)
+  precip = np.where(rng.random(n) < 0.1, rng.exponential(0.2, n), 0.0)
+  y = 300 + 3 * airtemp + 200 * np.convolve(precip, np.exp(-np.arange(48) / 12), 'full')[:n] + rng.normal(0, 5, n)
+  df = pd.DataFrame({ 'ds': ds, 'y': y, 'airtemp': airtemp, 'precip': precip })
+
+  model = neuralprophet.NeuralProphet(growth='off', yearly_seasonality=True, weekly_seasonality=False,
+    daily_seasonality=False, n_lags=24, n_forecasts=12, ar_layers=[16, 16], quantiles=[0.05, 0.95],
+    learning_rate=0.01, drop_missing=True, epochs=2)
+  model.metrics_logger = MetricsLogger(save_dir=os.path.join(os.environ['FLOWCAST_LOCAL_ROOT'], 'logs'))
+  model.add_future_regressor('airtemp')
+  model.add_future_regressor('precip')
+  model.fit(df, freq='H', progress=None)
+  return model, df
+
+def test_engine_matches_neuralprophet():
+  model, df = fit_small_model()
+  engine = inference.InferenceEngine.from_bytes(inference.export_model(model).to_bytes())
+
+  # the seasonality and regressors over the lags differ between windows
+  for end in [df.shape[0], df.shape[0] - 500]:
+    assert inference.check_parity(model, engine, df.iloc[:end]) < inference.PARITY_TOLERANCE
+
+def test_other_artifact_versions_are_rejected():
+  engine = inference.InferenceEngine({ 'trend_bias': np.zeros(1) }, { 'version': inference.ARTIFACT_VERSION - 1 })
+  with pytest.raises(ValueError):
+    inference.InferenceEngine.from_bytes(engine.to_bytes())
@@ -0,0 +1,54 @@
+from decimal import Decimal
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import db, utils, constants
+
+SITE = 'T0000003'
+ORIGIN = pd.Timestamp('2024-06-01 00:00')
+HOURS = constants.FORECAST_HORIZON + 24
+
+def weather_run():
+  ''' The rows update stores for a run, weather without predictions. '''
+  index = pd.date_range(ORIGIN + pd.Timedelta(hours=1), periods=HOURS, freq='h')
+  weather = pd.DataFrame({ 'airtemp': np.linspace(50, 60, HOURS), 'precip': np.zeros(HOURS) }, index=index)
+  utils.convert_floats_to_decimals(weather)
+  return utils.generate_fcst_rows(weather, ORIGIN, SITE)
+
+def predicted(rows: list[dict]):
+  ''' The rows the forecast handler writes back, the predicted hours with the run's weather. '''
+  return [{ **row, 'watertemp': Decimal('55.1234'), 'streamflow': Decimal('300.5000') }
+      for row in rows[:constants.FORECAST_HORIZON]]
+
+def assert_decimals(rows: list[dict]):
+  for row in rows:
+    for col in ['origin', 'timestamp', 'horizon', 'airtemp', 'precip', 'watertemp', 'streamflow']:
+      assert row[col] is None or isinstance(row[col], Decimal), col
+
+@pytest.fixture
+def packed(monkeypatch):
+  monkeypatch.setattr(db, 'FCST_STORAGE_FORMAT', 'packed')
+
+def test_forecast_write_keeps_the_stored_run(packed):
+  db.push_fcst_entries(weather_run())
+  stored = db.get_entire_fcst(SITE, int(ORIGIN.timestamp()))
+  db.push_fcst_entries(predicted(stored))
+
+  run = db.get_entire_fcst(SITE, int(ORIGIN.timestamp()))
+  assert len(run) == HOURS
+  assert_decimals(run)
+  assert [row['airtemp'] for row in run] == [row['airtemp'] for row in weather_run()]
+  assert all(row['watertemp'] == Decimal('55.1234') for row in run[:constants.FORECAST_HORIZON])
+  assert all(row['watertemp'] is None for row in run[constants.FORECAST_HORIZON:])
+
+def test_packed_runs_can_be_written_back_as_rows(packed, monkeypatch):
+  db.push_fcst_entries(weather_run())
+  db.push_fcst_entries(predicted(db.get_entire_fcst(SITE, int(ORIGIN.timestamp()))))
+  run = db.get_entire_fcst(SITE, int(ORIGIN.timestamp()))
+
+  # boto3 rejects float attributes, the unpacked rows are Decimals like per row items
+  monkeypatch.setattr(db, 'FCST_STORAGE_FORMAT', 'rows')
+  db.push_fcst_entries(run)
+  rows = db.get_entire_fcst(SITE, int(ORIGIN.timestamp()))
+  assert rows == run
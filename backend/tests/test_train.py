@@ -0,0 +1,89 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from datetime import datetime, timezone
+
+from utils import constants, featurestore, s3, utils
+
+SITE = 'T0000001'
+FEATURE = 'watertemp'
+HOURS = 24 * 45
+NEW_HOURS = 24 * 10
+
+def make_store():
+  ''' A feature store of hourly observations, the last NEW_HOURS of them after the model was trained. '''
+  rng = np.random.default_rng(0)
+  index = pd.date_range('2024-01-01', periods=HOURS, freq='h', tz='UTC')
+  doy = index.dayofyear.to_numpy() / 365.25 * 2 * np.pi
+  columns = {
+    'airtemp': 50 - 20 * np.cos(doy) + rng.normal(0, 3, HOURS),
+    'precip': np.where(rng.random(HOURS) < 0.1, rng.exponential(0.2, HOURS), 0.0),
+    'cloudcover': rng.uniform(0, 100, HOURS),
+    'snow': np.zeros(HOURS),
+    'snowdepth': np.zeros(HOURS),
+    'streamflow': 300 + rng.normal(0, 5, HOURS)
+  }
+  columns['watertemp'] = 40 + 0.5 * columns['airtemp'] + rng.normal(0, 0.5, HOURS)
+  values = np.column_stack([columns[col] for col in featurestore.COLUMNS]).astype(np.float32)
+  return featurestore.save(SITE, (index.asi8 // 1_000_000_000), values), index[-NEW_HOURS - 1]
+
+def save_previous(model, store: dict, trained_through: pd.Timestamp):
+  historical = utils.prep_features(featurestore.attach(store), FEATURE)
+  model.fit(historical[historical['ds'] <= trained_through.tz_convert(None)], freq='H', epochs=1, progress=None)
+  s3.save_model(model, SITE, FEATURE)
+  s3.save_model_meta(SITE, FEATURE, {
+    'trained_through': int(trained_through.timestamp()),
+    'full_trained_at': datetime.now(timezone.utc).timestamp(),
+    'fine_tuned_at': None,
+    # the previous model is barely trained, so its error on the new observations can't count as degraded
+    'validation_mae': 1e6
+  })
+
+def ar_distance(a, b):
+  return sum(float(((p - q) ** 2).sum()) for (name, p), q in zip(a.named_parameters(), b.parameters()) if name.startswith('ar_net'))
+
+@pytest.fixture
+def train(monkeypatch):
+  pytest.importorskip('neuralprophet')
+  from handlers import train
+  monkeypatch.setattr(train, 'FINE_TUNE_EPOCHS', 1)
+  return train
+
+def test_update_model_fine_tunes_from_the_previous_weights(train):
+  store, trained_through = make_store()
+  previous = train._new_model(FEATURE)
+  save_previous(previous, store, trained_through)
+
+  assert train.update_model(store, SITE, FEATURE) is True
+
+  meta = s3.load_model_meta(SITE, FEATURE)
+  assert meta['fine_tuned_at'] is not None
+  assert meta['trained_through'] == int(featurestore.attach(store).index.max().timestamp())
+
+  tuned = s3.load_model(SITE, FEATURE)
+  # kept the scale the previous weights were fitted in
+  for col in ['y', *previous.config_regressors.regressors.keys()]:
+    assert tuned.config_normalization.global_data_params[col].scale == previous.config_normalization.global_data_params[col].scale
+
+  # a step away from the previous weights, rather than from a new initialization
+  fresh = train._new_model(FEATURE)
+  save_previous(fresh, store, trained_through)
+  assert ar_distance(tuned.model, previous.model) < ar_distance(fresh.model, previous.model)
+
+def test_update_model_retrains_models_it_cant_warm_start(train, caplog):
+  from neuralprophet import NeuralProphet
+  from neuralprophet.logger import MetricsLogger
+
+  store, trained_through = make_store()
+  # trained with another architecture
+  previous = NeuralProphet(growth='off', yearly_seasonality=True, weekly_seasonality=False, daily_seasonality=False,
+    n_lags=constants.FORECAST_HORIZON * 2, n_forecasts=constants.FORECAST_HORIZON, ar_layers=[8], drop_missing=True)
+  previous.metrics_logger = MetricsLogger(save_dir=os.path.join(os.environ['FLOWCAST_LOCAL_ROOT'], 'logs'))
+  for feat in filter(lambda f: f != FEATURE, constants.FEATURE_COLS[FEATURE]):
+    previous.add_future_regressor(feat)
+  save_previous(previous, store, trained_through)
+
+  assert train.update_model(store, SITE, FEATURE) is False
+  assert 'unable to fine-tune' in caplog.text
+  assert s3.load_model_meta(SITE, FEATURE)['fine_tuned_at'] is None
@@ -0,0 +1,28 @@
+import numpy as np
+import pandas as pd
+
+from utils import utils, constants
+
+FEATURE = 'watertemp'
+
+def features(observed: int, future: int):
+  ''' A feature matrix of observed rows followed by forecast rows without the feature, snow only falls in the
+  forecast. '''
+  index = pd.date_range('2024-01-01', periods=observed + future, freq='h', tz='UTC')
+  df = pd.DataFrame({ col: np.linspace(0, 1, index.shape[0]) for col in constants.FEATURE_COLS[FEATURE] }, index=index)
+  df.loc[df.index[observed:], FEATURE] = np.nan
+  df['snow'] = 0.0
+  df.loc[df.index[observed:], 'snow'] = 1.0
+  df['snowdepth'] = 0.0
+  return df
+
+def test_regressors_constant_over_the_observations_are_perturbed():
+  df = utils.prep_features(features(48, 24), FEATURE)
+  observed = df[df['y'].notnull()]
+  for col in ['snow', 'snowdepth']:
+    assert observed[col].nunique() > 1
+    assert observed[col].iloc[0] == 0.01
+
+  # varying regressors and the forecast rows are left as they were
+  assert (df['airtemp'] == np.linspace(0, 1, 72)).all()
+  assert (df['snow'].iloc[48:] == 1.0).all()
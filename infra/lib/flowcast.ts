@@ -299,6 +299,10 @@ export class FlowcastStack extends Stack {
     archiveBucket.grantReadWrite(trainRole);
     modelBucket.grantReadWrite(trainRole);
     modelBucket.grantReadWrite(forecast);
+    // the feature store is extended on every update
+    modelBucket.grantReadWrite(update);
+    // skill reports saved next to the models are served by the api
+    modelBucket.grantRead(access);
 
     onboardProcessStream.addToRolePolicy(new iam.PolicyStatement({
       actions: ['execute-api:ManageConnections'],
@@ -318,6 +322,8 @@ export class FlowcastStack extends Stack {
     archiveBucket.grantReadWrite(exportFunc);
 
     sitesDb.grantFullAccess(trainRole);
+    // incremental training reads the observations since the last training straight from the table
+    db.grantReadData(trainRole);
 
     // * sfn
 